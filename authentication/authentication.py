@@ -0,0 +1,127 @@
+"""
+JWT authentication backed by a short-lived cache of the token's user.
+
+simplejwt's JWTAuthentication loads the user row on every request. Here the
+fields requests need are cached for AUTH_USER_CACHE_TIMEOUT seconds under
+the user id, and the user is rebuilt from them without a query; any other
+field is loaded from the database on first access. The entry is dropped
+whenever the user is saved or deleted (profile updates, password changes,
+deactivation), now and again once the transaction commits. Hits and misses
+are counted so the lookups avoided can be read off auth_cache_stats().
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db import router, transaction
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+USER_KEY = 'auth:user:{user_id}'
+STATS_KEY = 'auth:user_cache:{name}'
+# Enough for permission checks, ownership filters and the user's identity
+CACHED_FIELDS = (
+    'id', 'email', 'username', 'first_name', 'last_name',
+    'is_active', 'is_staff', 'is_superuser', 'is_verified',
+)
+
+
+def get_cache_timeout():
+    """Return how long a user is served from the cache, in seconds"""
+    return getattr(settings, 'AUTH_USER_CACHE_TIMEOUT', 60)
+
+
+def user_key(user_id):
+    return USER_KEY.format(user_id=user_id)
+
+
+def invalidate_user(user_id):
+    """
+    Drop a user's cached entry now and once the current transaction
+    commits, so a request that cached the old row in between is not served
+    afterwards. Call it after queryset updates, which send no signals.
+    """
+    cache.delete(user_key(user_id))
+    transaction.on_commit(lambda: cache.delete(user_key(user_id)))
+
+
+def record(name):
+    """Increment a hit or miss counter"""
+    key = STATS_KEY.format(name=name)
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, timeout=None):
+            cache.incr(key)
+
+
+def auth_cache_stats():
+    """Return the user cache counters; every hit is a database lookup avoided"""
+    hits = cache.get(STATS_KEY.format(name='hits'), 0)
+    misses = cache.get(STATS_KEY.format(name='misses'), 0)
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'lookups_avoided': hits,
+        'hit_rate': hits / total if total else 0.0,
+    }
+
+
+def reset_auth_cache_stats():
+    cache.delete_many([STATS_KEY.format(name=name) for name in ('hits', 'misses')])
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """JWTAuthentication that resolves the token's user from the cache"""
+
+    def get_cached_fields(self):
+        """Return the cached fields in model order, as Model.from_db expects them"""
+        return tuple(
+            field.attname for field in self.user_model._meta.concrete_fields
+            if field.attname in CACHED_FIELDS
+        )
+
+    def load_entry(self, user_id):
+        """Read the cached fields of a user, and their password fingerprint if tokens carry one"""
+        cached = self.get_cached_fields()
+        fields = cached + (('password',) if api_settings.CHECK_REVOKE_TOKEN else ())
+        row = (
+            self.user_model.objects.filter(**{api_settings.USER_ID_FIELD: user_id})
+            .values_list(*fields).first()
+        )
+        if row is None:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found")
+        # Only a hash of the password hash is ever cached
+        password = get_md5_hash_password(row[-1]) if api_settings.CHECK_REVOKE_TOKEN else None
+        return row[:len(cached)], password
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+
+        key = user_key(user_id)
+        entry = cache.get(key)
+        if entry is None:
+            record('misses')
+            entry = self.load_entry(user_id)
+            cache.set(key, entry, get_cache_timeout())
+        else:
+            record('hits')
+        values, password = entry
+
+        user = self.user_model.from_db(router.db_for_read(self.user_model), self.get_cached_fields(), values)
+        if not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+
+        if api_settings.CHECK_REVOKE_TOKEN:
+            if validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != password:
+                raise AuthenticationFailed(
+                    _("The user's password has been changed."), code="password_changed"
+                )
+
+        return user
+
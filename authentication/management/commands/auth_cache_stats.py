@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from authentication.authentication import auth_cache_stats, reset_auth_cache_stats
+
+
+class Command(BaseCommand):
+    """Report how many user lookups the JWT authentication cache has avoided"""
+    help = "Show hits, misses and database lookups avoided by the authentication user cache"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Clear the counters after reporting')
+
+    def handle(self, *args, **options):
+        stats = auth_cache_stats()
+        self.stdout.write(
+            f"hits={stats['hits']} misses={stats['misses']} "
+            f"lookups_avoided={stats['lookups_avoided']} hit_rate={stats['hit_rate']:.1%}"
+        )
+        if options['reset']:
+            reset_auth_cache_stats()
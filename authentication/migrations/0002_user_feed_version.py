@@ -0,0 +1,18 @@
+# Generated by Django 5.0.1 on 2026-10-17 13:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='feed_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -13,6 +13,8 @@ class User(AbstractUser):
     phone_number = models.CharField(max_length=15, blank=True)
     is_verified = models.BooleanField(default=False)
     notification_preferences = models.JSONField(default=dict)
+    # Bumped to revoke the iCalendar feed URL handed out so far
+    feed_version = models.PositiveIntegerField(default=0)
     
     # Make email required and unique
     USERNAME_FIELD = 'email'
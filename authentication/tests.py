@@ -3,6 +3,11 @@ from django.urls import reverse
 from rest_framework.test import APIClient
 from rest_framework import status
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from rest_framework.test import APIRequestFactory
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.tokens import AccessToken
+from .authentication import CachedJWTAuthentication, auth_cache_stats
 
 User = get_user_model()
 
@@ -60,4 +65,73 @@ class AuthenticationTests(TestCase):
         self.assertIn('access', response.data)
         self.assertIn('refresh', response.data)
         self.assertIn('user_id', response.data)
-        self.assertIn('email', response.data)
\ No newline at end of file
+        self.assertIn('email', response.data)
+
+
+class CachedJWTAuthenticationTests(TestCase):
+    """Test suite for resolving JWT users from the cache"""
+    
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='test@example.com',
+            password='StrongPass123!',
+            first_name='Test',
+            school='Test School'
+        )
+        self.token = str(AccessToken.for_user(self.user))
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {self.token}')
+    
+    def authenticate(self):
+        request = APIRequestFactory().get('/', HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        user, _ = CachedJWTAuthentication().authenticate(request)
+        return user
+    
+    def test_cached_user_needs_no_query(self):
+        """Test only the first request for a user reads the database"""
+        with self.assertNumQueries(1):
+            self.authenticate()
+        with self.assertNumQueries(0):
+            user = self.authenticate()
+        
+        self.assertEqual(user, self.user)
+        self.assertEqual((user.email, user.first_name, user.is_active), ('test@example.com', 'Test', True))
+        self.assertEqual(auth_cache_stats()['lookups_avoided'], 1)
+        self.assertEqual(auth_cache_stats()['misses'], 1)
+        # Fields outside the cached set are loaded on first use
+        with self.assertNumQueries(1):
+            self.assertEqual(user.school, 'Test School')
+    
+    def test_profile_update_invalidates(self):
+        """Test a profile update is seen by the next request"""
+        self.authenticate()
+        response = self.client.patch(reverse('user_profile'), {'first_name': 'Renamed'}, format='json')
+        
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['school'], 'Test School')
+        self.assertEqual(self.authenticate().first_name, 'Renamed')
+    
+    def test_password_change_invalidates(self):
+        """Test changing the password drops the cached user"""
+        self.authenticate()
+        response = self.client.put(reverse('change_password'), {
+            'old_password': 'StrongPass123!',
+            'new_password': 'NewStrongPass456!',
+            'new_password2': 'NewStrongPass456!',
+        }, format='json')
+        
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(User.objects.get(pk=self.user.pk).check_password('NewStrongPass456!'))
+        with self.assertNumQueries(1):
+            self.authenticate()
+    
+    def test_deactivated_user_is_rejected(self):
+        """Test deactivating an account takes effect on the next request"""
+        self.authenticate()
+        self.user.is_active = False
+        self.user.save()
+        
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate()
@@ -32,7 +32,8 @@ class UserProfileView(generics.RetrieveUpdateAPIView):
     permission_classes = (permissions.IsAuthenticated,)
     
     def get_object(self):
-        return self.request.user
+        # request.user only carries the cached authentication fields
+        return User.objects.get(pk=self.request.user.pk)
 
 
 class ChangePasswordView(generics.UpdateAPIView):
@@ -41,7 +42,8 @@ class ChangePasswordView(generics.UpdateAPIView):
     permission_classes = (permissions.IsAuthenticated,)
     
     def get_object(self):
-        return self.request.user
+        # request.user only carries the cached authentication fields
+        return User.objects.get(pk=self.request.user.pk)
     
     def update(self, request, *args, **kwargs):
         user = self.get_object()
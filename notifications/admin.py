@@ -1,11 +1,11 @@
 from django.contrib import admin
-from .models import Notification
+from .models import EmailOutbox, Notification
 
 
 @admin.register(Notification)
 class NotificationAdmin(admin.ModelAdmin):
     list_display = ('user', 'message', 'time', 'read', 'type')
-    list_filter = ('read', 'type', 'time')
+    list_filter = ('read', 'type', 'kind', 'time')
     search_fields = ('user__username', 'user__email', 'message')
     date_hierarchy = 'time'
     readonly_fields = ('time',)
@@ -16,4 +16,16 @@ class NotificationAdmin(admin.ModelAdmin):
         ('Status', {
             'fields': ('read', 'email_sent', 'time')
         }),
-    )
\ No newline at end of file
+        ('Deduplication', {
+            'fields': ('kind', 'occurrence_date', 'offset_minutes'),
+            'classes': ('collapse',)
+        }),
+    )
+
+
+@admin.register(EmailOutbox)
+class EmailOutboxAdmin(admin.ModelAdmin):
+    list_display = ('recipient', 'subject', 'status', 'attempts', 'next_attempt_at', 'sent_at')
+    list_filter = ('status', 'created_at')
+    search_fields = ('recipient', 'subject', 'last_error')
+    readonly_fields = ('created_at', 'sent_at', 'claim_token', 'leased_until', 'last_error')
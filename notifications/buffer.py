@@ -0,0 +1,127 @@
+"""
+Notifications raised by model signals, written once the transaction commits.
+
+Signal handlers append to a buffer for the current transaction instead of
+inserting rows, so the writes that trigger them do not also pay for the
+notification inserts, and a transaction that touches many lessons ends in
+one bulk_create. Notifications appended inside a savepoint get their own
+on_commit callback, so a savepoint that rolls back discards them with it.
+
+Notifications for a user who is being deleted in the same transaction are
+dropped, which keeps a teacher's cascading delete from writing one "lesson
+deleted" notification per lesson. Ones whose lesson is gone by the time
+they are written are dropped too.
+
+With NOTIFICATION_SIGNAL_DELIVERY = 'celery' the buffered notifications are
+handed to a Celery task on commit instead of being written in-process.
+"""
+import threading
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.utils.dateparse import parse_date
+
+from timetable_app.models import Lesson
+from .models import Notification
+from .services import create_notifications
+
+DELIVERY_MODES = ('commit', 'celery')
+TASK_FIELDS = ('user_id', 'lesson_id', 'message', 'type', 'kind', 'occurrence_date', 'offset_minutes')
+
+_local = threading.local()
+
+
+def get_delivery_mode():
+    """Return whether buffered notifications are written on commit or by a Celery task"""
+    mode = getattr(settings, 'NOTIFICATION_SIGNAL_DELIVERY', 'commit')
+    return mode if mode in DELIVERY_MODES else 'commit'
+
+
+class PendingNotifications:
+    """The notifications buffered by one transaction, per savepoint"""
+
+    def __init__(self, using, hooks):
+        self.using = using
+        # Django replaces the connection's on-commit list when a transaction
+        # commits or rolls back, so its identity tells transactions apart
+        self.hooks = hooks
+        self.batches = {}
+        self.suppressed = set()
+
+    def add(self, notification, savepoints):
+        if notification.user_id in self.suppressed:
+            return
+        batch = self.batches.get(savepoints)
+        if batch is None:
+            batch = self.batches[savepoints] = []
+            transaction.on_commit(lambda: self.flush(savepoints), using=self.using, robust=True)
+        batch.append(notification)
+
+    def flush(self, savepoints):
+        notifications = [
+            notification for notification in self.batches.pop(savepoints, ())
+            if notification.user_id not in self.suppressed
+        ]
+        deliver(notifications)
+
+
+def get_pending(using):
+    connection = transaction.get_connection(using)
+    buffers = _local.__dict__.setdefault('buffers', {})
+    pending = buffers.get(using)
+    if pending is None or pending.hooks is not connection.run_on_commit:
+        pending = buffers[using] = PendingNotifications(using, connection.run_on_commit)
+    return pending
+
+
+def notify_on_commit(notification, using=DEFAULT_DB_ALIAS):
+    """Write an unsaved notification once the current transaction commits"""
+    connection = transaction.get_connection(using)
+    if not connection.in_atomic_block:
+        deliver([notification])
+        return
+    get_pending(using).add(notification, tuple(connection.savepoint_ids))
+
+
+def suppress_notifications(user_id, using=DEFAULT_DB_ALIAS):
+    """Drop the current transaction's buffered notifications for a user being deleted"""
+    if transaction.get_connection(using).in_atomic_block:
+        get_pending(using).suppressed.add(user_id)
+
+
+def existing(notifications):
+    """Leave out notifications whose lesson has been deleted since they were raised"""
+    lesson_ids = {notification.lesson_id for notification in notifications if notification.lesson_id}
+    if not lesson_ids:
+        return notifications
+    found = set(Lesson.objects.filter(id__in=lesson_ids).values_list('id', flat=True))
+    return [
+        notification for notification in notifications
+        if notification.lesson_id is None or notification.lesson_id in found
+    ]
+
+
+def to_row(notification):
+    row = {name: getattr(notification, name) for name in TASK_FIELDS}
+    if row['occurrence_date'] is not None:
+        row['occurrence_date'] = row['occurrence_date'].isoformat()
+    return row
+
+
+def from_row(row):
+    row = dict(row)
+    if row.get('occurrence_date'):
+        row['occurrence_date'] = parse_date(row['occurrence_date'])
+    return Notification(**row)
+
+
+def deliver(notifications):
+    """Write buffered notifications now or hand them to Celery"""
+    if not notifications:
+        return
+    if get_delivery_mode() == 'celery':
+        # Imported here because the task module imports this one
+        from .tasks import create_notifications_task
+        create_notifications_task.delay([to_row(notification) for notification in notifications])
+        return
+    create_notifications(existing(notifications))
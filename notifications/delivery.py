@@ -0,0 +1,329 @@
+"""
+Pooled email delivery.
+
+Each worker process keeps a single open connection to the email backend
+and reuses it for every message it sends, instead of opening a new TLS
+session per ``send_mail`` call. Messages are sent in batches, throttled to
+``EMAIL_RATE_LIMIT`` messages per second, and the connection is reopened
+after ``EMAIL_CONNECTION_IDLE_TIMEOUT`` seconds of inactivity or when the
+server drops it.
+
+With ``EMAIL_DELIVERY_BACKEND = 'async'`` messages are instead sent over up
+to ``EMAIL_CONCURRENCY`` connections at once from an asyncio event loop,
+so a worker waiting on a slow mail server keeps several messages in flight
+instead of one.
+"""
+import asyncio
+import logging
+import os
+import smtplib
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from celery.signals import worker_process_shutdown
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+
+logger = logging.getLogger(__name__)
+
+# Errors that reject a single message but leave the connection usable
+MESSAGE_ERRORS = (
+    smtplib.SMTPRecipientsRefused,
+    smtplib.SMTPSenderRefused,
+    smtplib.SMTPDataError,
+)
+
+
+class MailDelivery:
+    """Reusable email connection with batching, idle reconnects and rate limiting"""
+
+    def __init__(self, backend=None, batch_size=None, rate_limit=None, idle_timeout=None, **backend_kwargs):
+        self.backend = backend
+        self.batch_size = batch_size or getattr(settings, 'EMAIL_BATCH_SIZE', 50)
+        self.rate_limit = rate_limit if rate_limit is not None else getattr(settings, 'EMAIL_RATE_LIMIT', 0)
+        self.idle_timeout = (
+            idle_timeout if idle_timeout is not None
+            else getattr(settings, 'EMAIL_CONNECTION_IDLE_TIMEOUT', 60)
+        )
+        self.backend_kwargs = backend_kwargs
+        self.connection = None
+        self.connections_opened = 0
+        self.last_used = 0.0
+        self.next_send_at = 0.0
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+
+    def open(self):
+        """Return the shared connection, reopening it if it has been idle too long"""
+        if self.pid != os.getpid():
+            # Connections inherited from a parent process must not be shared
+            self.connection = None
+            self.pid = os.getpid()
+        if self.connection is not None and time.monotonic() - self.last_used > self.idle_timeout:
+            self.close()
+        if self.connection is None:
+            connection = get_connection(self.backend, fail_silently=False, **self.backend_kwargs)
+            connection.open()
+            self.connection = connection
+            self.connections_opened += 1
+        return self.connection
+
+    def close(self):
+        """Close the shared connection, ignoring errors from a dead socket"""
+        if self.connection is None:
+            return
+        try:
+            self.connection.close()
+        except Exception:
+            logger.debug("Error closing email connection", exc_info=True)
+        self.connection = None
+
+    def throttle(self, count):
+        """Sleep as needed to keep sending under the configured rate limit"""
+        if not self.rate_limit:
+            return
+        now = time.monotonic()
+        if self.next_send_at > now:
+            time.sleep(self.next_send_at - now)
+        self.next_send_at = max(now, self.next_send_at) + count / self.rate_limit
+
+    def send_one(self, connection, message):
+        try:
+            connection.send_messages([message])
+        except smtplib.SMTPServerDisconnected:
+            # The server closed the connection since it was last used; retry once
+            self.close()
+            self.open().send_messages([message])
+
+    def send(self, messages):
+        """
+        Send messages over the shared connection, batch by batch. Each
+        message is handed to the backend on its own so a refused recipient
+        only fails that message. Returns a list of (message, exception)
+        pairs for the messages that could not be sent.
+        """
+        failed = []
+        with self.lock:
+            for start in range(0, len(messages), self.batch_size):
+                batch = messages[start:start + self.batch_size]
+                self.throttle(len(batch))
+                for message in batch:
+                    try:
+                        self.send_one(self.open(), message)
+                    except Exception as exc:
+                        logger.warning("Failed to send email to %s: %s", message.to, exc)
+                        if not isinstance(exc, MESSAGE_ERRORS):
+                            self.close()
+                        failed.append((message, exc))
+                    self.last_used = time.monotonic()
+        return failed
+
+
+class AsyncMailDelivery:
+    """
+    Email delivery over a pool of concurrent connections. At most
+    concurrency messages are in flight, each given timeout seconds from
+    when a thread starts sending it. Django's email backends block, so
+    every send runs on a thread of the pool's own executor while the event
+    loop waits on it; a send that runs out of time has its socket shut down
+    and keeps its slot until the thread has returned.
+    """
+
+    def __init__(self, backend=None, concurrency=None, timeout=None, rate_limit=None,
+                 idle_timeout=None, **backend_kwargs):
+        self.backend = backend
+        self.concurrency = concurrency or getattr(settings, 'EMAIL_CONCURRENCY', 4)
+        self.timeout = timeout or getattr(settings, 'EMAIL_SEND_TIMEOUT', 30)
+        self.rate_limit = rate_limit if rate_limit is not None else getattr(settings, 'EMAIL_RATE_LIMIT', 0)
+        self.idle_timeout = (
+            idle_timeout if idle_timeout is not None
+            else getattr(settings, 'EMAIL_CONNECTION_IDLE_TIMEOUT', 60)
+        )
+        # The socket timeout also ends a send the event loop gave up on
+        backend_kwargs.setdefault('timeout', self.timeout)
+        self.backend_kwargs = backend_kwargs
+        self.idle = []
+        self.connections_opened = 0
+        self.next_send_at = 0.0
+        self.executor = None
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+
+    def get_executor(self):
+        if self.pid != os.getpid():
+            # Threads and connections do not survive a fork
+            self.executor = None
+            self.idle = []
+            self.pid = os.getpid()
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.concurrency, thread_name_prefix='email')
+        return self.executor
+
+    def open(self):
+        connection = get_connection(self.backend, fail_silently=False, **self.backend_kwargs)
+        connection.open()
+        self.connections_opened += 1
+        return connection
+
+    def close_connection(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            logger.debug("Error closing email connection", exc_info=True)
+
+    def close(self):
+        """Close the idle connections"""
+        idle, self.idle = self.idle, []
+        for connection, _ in idle:
+            self.close_connection(connection)
+
+    def checkout(self):
+        """Return an idle connection that has not timed out, or None"""
+        while self.idle:
+            connection, last_used = self.idle.pop()
+            if time.monotonic() - last_used <= self.idle_timeout:
+                return connection
+            self.close_connection(connection)
+        return None
+
+    def send_blocking(self, attempt, message):
+        """
+        Send one message on a worker thread. attempt holds the connection
+        in use, so the event loop can abort it. Returns the connection to
+        reuse, or None, and the error if the message was not sent.
+        """
+        connection = attempt['connection']
+        try:
+            if connection is None:
+                connection = attempt['connection'] = self.open()
+            try:
+                connection.send_messages([message])
+            except smtplib.SMTPServerDisconnected:
+                # The server closed the connection since it was last used; retry once
+                self.close_connection(connection)
+                connection = attempt['connection'] = self.open()
+                connection.send_messages([message])
+        except MESSAGE_ERRORS as exc:
+            return connection, exc
+        except Exception as exc:
+            if connection is not None:
+                self.close_connection(connection)
+            return None, exc
+        return connection, None
+
+    def abort(self, attempt):
+        """Shut down the socket of a send that ran out of time, so its thread returns"""
+        sock = getattr(getattr(attempt['connection'], 'connection', None), 'sock', None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    async def throttle(self):
+        """Wait for this message's slot under the configured rate limit"""
+        if not self.rate_limit:
+            return
+        now = time.monotonic()
+        start = max(now, self.next_send_at)
+        self.next_send_at = start + 1 / self.rate_limit
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    async def send_one(self, semaphore, message):
+        loop = asyncio.get_running_loop()
+        async with semaphore:
+            await self.throttle()
+            attempt = {'connection': self.checkout()}
+            started = loop.create_future()
+
+            def run():
+                loop.call_soon_threadsafe(lambda: started.done() or started.set_result(None))
+                return self.send_blocking(attempt, message)
+
+            future = self.get_executor().submit(run)
+            result = asyncio.wrap_future(future)
+            try:
+                # The deadline starts once a thread picks the message up
+                await started
+            except asyncio.CancelledError:
+                # A send that has not started never runs
+                future.cancel()
+                raise
+            try:
+                connection, exc = await asyncio.wait_for(asyncio.shield(result), self.timeout)
+            except asyncio.TimeoutError:
+                # The thread cannot be interrupted, so its socket is shut down
+                # and the slot stays held until the thread has returned
+                self.abort(attempt)
+                connection, exc = await result
+                if exc is not None:
+                    exc = TimeoutError(f"No reply from the mail server within {self.timeout}s")
+            # Returned before the slot is released, so the pool never
+            # holds more connections than the concurrency
+            if connection is not None:
+                self.idle.append((connection, time.monotonic()))
+        if exc is not None:
+            logger.warning("Failed to send email to %s: %s", message.to, exc)
+            return message, exc
+        return None
+
+    async def send_async(self, messages):
+        """
+        Send messages concurrently. Returns a list of (message, exception)
+        pairs for the messages that could not be sent.
+        """
+        semaphore = asyncio.BoundedSemaphore(self.concurrency)
+        results = await asyncio.gather(*(self.send_one(semaphore, message) for message in messages))
+        return [result for result in results if result is not None]
+
+    def send(self, messages):
+        """Send messages from synchronous code such as a Celery task"""
+        with self.lock:
+            return asyncio.run(self.send_async(messages))
+
+
+def get_delivery_backend():
+    """Return 'pooled' for one serial connection or 'async' for concurrent sending"""
+    backend = getattr(settings, 'EMAIL_DELIVERY_BACKEND', 'pooled')
+    return backend if backend in ('pooled', 'async') else 'pooled'
+
+
+def create_delivery():
+    return AsyncMailDelivery() if get_delivery_backend() == 'async' else MailDelivery()
+
+
+_delivery = None
+
+
+def get_delivery():
+    """Return the delivery pool for the current worker process"""
+    global _delivery
+    if _delivery is None:
+        _delivery = create_delivery()
+    return _delivery
+
+
+def build_message(subject, body, recipient):
+    """Build a plain text email from the default sender"""
+    return EmailMessage(
+        subject,
+        body,
+        getattr(settings, 'DEFAULT_FROM_EMAIL', 'noreply@yourapp.com'),
+        [recipient],
+    )
+
+
+def deliver(messages):
+    """Send messages through the worker's pooled connection"""
+    if not messages:
+        return []
+    return get_delivery().send(list(messages))
+
+
+@worker_process_shutdown.connect
+def close_delivery(**kwargs):
+    if _delivery is not None:
+        _delivery.close()
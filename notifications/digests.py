@@ -0,0 +1,68 @@
+"""
+Per-teacher reminder digests.
+
+Reminders for the same teacher that fall close together (back-to-back
+lessons) are sent as one notification and one email listing every lesson,
+instead of one of each per reminder. A digest never holds two reminders of the same lesson
+occurrence, so a lesson's later reminder still goes out on its own.
+
+The subject, email body and notification message are rendered from the
+templates in notifications/templates/notifications, compiled once per
+process.
+"""
+from functools import lru_cache
+from datetime import timedelta
+
+from django.conf import settings
+from django.template.loader import get_template
+from django.utils.text import Truncator
+
+from .models import Notification
+
+SUBJECT_TEMPLATE = 'notifications/reminder_digest_subject.txt'
+BODY_TEMPLATE = 'notifications/reminder_digest.txt'
+MESSAGE_TEMPLATE = 'notifications/reminder_digest_message.txt'
+# Digests with a lesson this close to starting are urgent
+URGENT_MINUTES = 10
+
+
+def get_digest_window():
+    """Return how far ahead a firing reminder collects the teacher's next ones"""
+    return timedelta(minutes=getattr(settings, 'LESSON_REMINDER_DIGEST_WINDOW', 15))
+
+
+@lru_cache(maxsize=None)
+def compiled(name):
+    return get_template(name)
+
+
+def render_digest(user, items):
+    """Return the (subject, body, message) of a digest, its items in start order"""
+    context = {'name': user.first_name or user.username, 'items': items}
+    return (
+        compiled(SUBJECT_TEMPLATE).render(context).strip(),
+        compiled(BODY_TEMPLATE).render(context).strip(),
+        Truncator(compiled(MESSAGE_TEMPLATE).render(context).strip()).chars(255),
+    )
+
+
+def build_digest(user, items):
+    """
+    Build the notification and (subject, body, recipient) email of a
+    digest. items are dicts with the lesson, occurrence_date,
+    offset_minutes, starts_at and minutes (until the lesson starts) of
+    each reminder; the first one's key deduplicates the notification.
+    """
+    first = items[0]
+    items = sorted(items, key=lambda item: (item['starts_at'], item['lesson'].id))
+    subject, body, message = render_digest(user, items)
+    notification = Notification(
+        user=user,
+        lesson=first['lesson'],
+        message=message,
+        type='urgent' if min(item['minutes'] for item in items) <= URGENT_MINUTES else 'info',
+        kind='lesson_reminder',
+        occurrence_date=first['occurrence_date'],
+        offset_minutes=first['offset_minutes'],
+    )
+    return notification, (subject, body, user.email)
@@ -0,0 +1,39 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from notifications.delivery import AsyncMailDelivery, MailDelivery, build_message
+from notifications.testing import FakeSMTPServer
+
+
+class Command(BaseCommand):
+    """Compare serial and concurrent email delivery against a local SMTP stand-in"""
+    help = "Benchmark email throughput against a fake SMTP server with per-message latency"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=200)
+        parser.add_argument('--latency', type=float, default=0.05,
+                            help='Seconds the server takes to accept each message')
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+
+    def handle(self, *args, **options):
+        count = options['messages']
+        messages = [build_message('Benchmark', 'Body', f'teacher{i}@example.com') for i in range(count)]
+        with FakeSMTPServer(latency=options['latency']) as server:
+            baseline = self.run(MailDelivery(**server.backend_kwargs()), messages, 'pooled')
+            for concurrency in options['concurrency']:
+                delivery = AsyncMailDelivery(concurrency=concurrency, **server.backend_kwargs())
+                rate = self.run(delivery, messages, f'async x{concurrency}')
+                self.stdout.write(f"{'':<12} {rate / baseline:.1f}x the pooled backend")
+
+    def run(self, delivery, messages, label):
+        started = time.perf_counter()
+        failed = delivery.send(messages)
+        elapsed = time.perf_counter() - started
+        delivery.close()
+        rate = (len(messages) - len(failed)) / elapsed
+        self.stdout.write(
+            f"{label:<12} {len(messages)} messages in {elapsed:.2f}s ({rate:.0f} msg/s, "
+            f"{len(failed)} failed, {delivery.connections_opened} connections)"
+        )
+        return rate
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from notifications.outbox import drain_outbox, outbox_stats, retry_dead
+
+
+class Command(BaseCommand):
+    """Report the email outbox queue depth and send rate, or act on its rows"""
+    help = "Show email outbox depth and send rate; optionally requeue dead emails or drain now"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retry-dead', action='store_true', help='Put dead-lettered emails back in the queue')
+        parser.add_argument('--drain', action='store_true', help='Send due emails in this process')
+
+    def handle(self, *args, **options):
+        if options['retry_dead']:
+            self.stdout.write(f"Requeued {retry_dead()} dead emails")
+        if options['drain']:
+            totals = drain_outbox()
+            self.stdout.write(
+                f"Sent {totals['sent']} emails ({totals['retried']} to retry, {totals['dead']} dead-lettered)"
+            )
+        stats = outbox_stats()
+        self.stdout.write(
+            f"pending={stats['pending']} due={stats['due']} sending={stats['sending']} dead={stats['dead']} "
+            f"oldest_due={stats['oldest_due_age']:.0f}s "
+            f"rate={stats['rate_1m']:.0f}/min (1m) {stats['rate_15m']:.1f}/min (15m)"
+        )
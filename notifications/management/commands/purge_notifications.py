@@ -0,0 +1,33 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from notifications.retention import get_archive_dir, purge_notifications
+
+
+class Command(BaseCommand):
+    """Delete old read notifications in batches, optionally archiving them"""
+    help = "Purge read notifications older than --days in primary-key batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=30)
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--pause', type=float, default=None,
+                            help='Seconds to sleep between batches')
+        parser.add_argument('--archive-dir', default=None,
+                            help='Write purged rows to gzipped NDJSON here (default NOTIFICATION_ARCHIVE_DIR)')
+
+    def handle(self, *args, **options):
+        stats = purge_notifications(
+            timezone.now() - timedelta(days=options['days']),
+            batch_size=options['batch_size'],
+            archive_dir=options['archive_dir'] or get_archive_dir(),
+            pause=options['pause'],
+        )
+        self.stdout.write(
+            f"Deleted {stats.deleted} notifications in {stats.batches} batches, "
+            f"{stats.elapsed:.2f}s ({stats.rows_per_second:.0f} rows/s)"
+        )
+        if stats.archive:
+            self.stdout.write(f"Archived to {stats.archive}")
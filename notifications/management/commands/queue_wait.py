@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from timetable_project.queue_metrics import queue_wait_stats, reset_queue_wait_stats
+
+
+class Command(BaseCommand):
+    """Report how long tasks waited in each Celery queue before a worker started them"""
+    help = "Show queue wait time per Celery queue (count, mean, p95, p99, max in seconds)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Clear the counters after reporting')
+
+    def handle(self, *args, **options):
+        stats = queue_wait_stats()
+        if not stats:
+            self.stdout.write("No tasks recorded yet")
+        for queue, values in stats.items():
+            self.stdout.write(
+                f"{queue:<12} count={values['count']} mean={values['mean']:.3f}s "
+                f"p95<={self.bound(values['p95'])} p99<={self.bound(values['p99'])} max<={self.bound(values['max'])}"
+            )
+        if options['reset']:
+            reset_queue_wait_stats()
+
+    def bound(self, value):
+        return 'inf' if value is None else f'{value}s'
@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from timetable_project.celery import app
+
+
+def worker_arguments(queue, options):
+    """Return the celery worker arguments for a worker dedicated to one queue"""
+    arguments = ['worker', '--queues', queue, '--hostname', f'{queue}@%h']
+    if 'concurrency' in options:
+        arguments += ['--concurrency', str(options['concurrency'])]
+    if 'prefetch_multiplier' in options:
+        arguments += ['--prefetch-multiplier', str(options['prefetch_multiplier'])]
+    return arguments
+
+
+class Command(BaseCommand):
+    """Start a Celery worker for one queue with its configured concurrency and prefetch"""
+    help = "Run a Celery worker consuming a single queue, using CELERY_QUEUE_WORKER_OPTIONS"
+
+    def add_arguments(self, parser):
+        parser.add_argument('queue')
+        parser.add_argument('--loglevel', default='info')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Print the worker command line instead of starting it')
+
+    def handle(self, *args, **options):
+        queue_options = getattr(settings, 'CELERY_QUEUE_WORKER_OPTIONS', {})
+        if options['queue'] not in queue_options:
+            raise CommandError(f"Unknown queue '{options['queue']}'; choose from {', '.join(queue_options)}")
+        arguments = worker_arguments(options['queue'], queue_options[options['queue']])
+        arguments.append(f"--loglevel={options['loglevel']}")
+        if options['dry_run']:
+            self.stdout.write('celery -A timetable_project ' + ' '.join(arguments))
+            return
+        app.worker_main(arguments)
@@ -0,0 +1,35 @@
+# Generated by Django 5.0.1 on 2026-10-17 12:46
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0002_reminderwatermark'),
+        ('timetable_app', '0002_lesson_minute_of_week'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='kind',
+            field=models.CharField(choices=[('general', 'General'), ('lesson_reminder', 'Lesson reminder'), ('upcoming_lesson', 'Upcoming lesson'), ('lesson_created', 'Lesson created'), ('lesson_deleted', 'Lesson deleted'), ('lesson_exception', 'Lesson exception')], default='general', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='occurrence_date',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='offset_minutes',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='notification',
+            constraint=models.UniqueConstraint(condition=models.Q(('occurrence_date__isnull', False), ('offset_minutes__isnull', False)), fields=('kind', 'lesson', 'occurrence_date', 'offset_minutes'), name='unique_notification_occurrence'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.0.1 on 2026-10-17 13:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0004_unreadcounter'),
+        ('timetable_app', '0003_lesson_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduledReminder',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('occurrence_date', models.DateField()),
+                ('offset_minutes', models.IntegerField()),
+                ('fire_at', models.DateTimeField()),
+                ('task_id', models.CharField(max_length=36, unique=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('lesson', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='scheduled_reminders', to='timetable_app.lesson')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['lesson', 'fire_at'], name='notificatio_lesson__698525_idx'), models.Index(fields=['fire_at'], name='notificatio_fire_at_d6210d_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='scheduledreminder',
+            constraint=models.UniqueConstraint(fields=('lesson', 'occurrence_date', 'offset_minutes'), name='unique_scheduled_reminder'),
+        ),
+    ]
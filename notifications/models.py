@@ -1,5 +1,7 @@
 from django.db import models
 from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
 
 
 class Notification(models.Model):
@@ -9,6 +11,14 @@ class Notification(models.Model):
         ('warning', 'Warning'),
         ('urgent', 'Urgent'),
     )
+    NOTIFICATION_KINDS = (
+        ('general', 'General'),
+        ('lesson_reminder', 'Lesson reminder'),
+        ('upcoming_lesson', 'Upcoming lesson'),
+        ('lesson_created', 'Lesson created'),
+        ('lesson_deleted', 'Lesson deleted'),
+        ('lesson_exception', 'Lesson exception'),
+    )
     
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL, 
@@ -28,6 +38,12 @@ class Notification(models.Model):
     type = models.CharField(max_length=10, choices=NOTIFICATION_TYPES, default='info')
     email_sent = models.BooleanField(default=False)
     
+    # Structured dedup key: at most one notification of a kind per lesson
+    # occurrence and offset (minutes before the occurrence)
+    kind = models.CharField(max_length=20, choices=NOTIFICATION_KINDS, default='general')
+    occurrence_date = models.DateField(null=True, blank=True)
+    offset_minutes = models.IntegerField(null=True, blank=True)
+    
     class Meta:
         ordering = ['-time']
         indexes = [
@@ -35,6 +51,113 @@ class Notification(models.Model):
             models.Index(fields=['user', 'read']),
             models.Index(fields=['email_sent']),
         ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['kind', 'lesson', 'occurrence_date', 'offset_minutes'],
+                condition=Q(occurrence_date__isnull=False, offset_minutes__isnull=False),
+                name='unique_notification_occurrence',
+            ),
+        ]
+    
+    def __str__(self):
+        return self.message
+    
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored read flag so a save can tell if it changed
+        instance._loaded_read = instance.__dict__.get('read')
+        return instance
+    
+    @property
+    def dedup_key(self):
+        """Return the idempotency key, or None for notifications that are not deduplicated"""
+        if self.lesson_id is None or self.occurrence_date is None or self.offset_minutes is None:
+            return None
+        return (self.kind, self.lesson_id, self.occurrence_date, self.offset_minutes)
+
+class ReminderWatermark(models.Model):
+    """Last instant covered by a run of a periodic reminder job"""
+    name = models.CharField(max_length=50, unique=True)
+    last_run = models.DateTimeField()
+    
+    def __str__(self):
+        return f"{self.name} @ {self.last_run}"
+
+
+class UnreadCounter(models.Model):
+    """Cached number of unread notifications for a user"""
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='unread_counter'
+    )
+    count = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"{self.user} ({self.count} unread)"
+
+
+class ScheduledReminder(models.Model):
+    """Handle of the delayed task that sends one reminder of a lesson occurrence"""
+    lesson = models.ForeignKey(
+        'timetable_app.Lesson',
+        on_delete=models.CASCADE,
+        related_name='scheduled_reminders'
+    )
+    occurrence_date = models.DateField()
+    offset_minutes = models.IntegerField()
+    fire_at = models.DateTimeField()
+    task_id = models.CharField(max_length=36, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['lesson', 'fire_at']),
+            models.Index(fields=['fire_at']),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['lesson', 'occurrence_date', 'offset_minutes'],
+                name='unique_scheduled_reminder',
+            ),
+        ]
+    
+    def __str__(self):
+        return f"{self.lesson_id} on {self.occurrence_date} -{self.offset_minutes}m @ {self.fire_at}"
+
+
+class EmailOutbox(models.Model):
+    """Email waiting to be sent, written in the transaction that caused it"""
+    STATUSES = (
+        ('pending', 'Pending'),
+        ('sending', 'Sending'),
+        ('sent', 'Sent'),
+        ('dead', 'Dead'),
+    )
+    
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    recipient = models.EmailField()
+    status = models.CharField(max_length=10, choices=STATUSES, default='pending')
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    # Set while a drain worker holds the row; an expired lease can be reclaimed
+    claim_token = models.CharField(max_length=36, null=True, blank=True)
+    leased_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),
+            models.Index(fields=['status', 'leased_until']),
+            models.Index(fields=['status', 'sent_at']),
+        ]
     
     def __str__(self):
-        return self.message
\ No newline at end of file
+        return f"{self.subject} to {self.recipient} ({self.status})"
@@ -0,0 +1,228 @@
+"""
+Transactional email outbox.
+
+Code that sends email alongside a database write adds EmailOutbox rows in
+the same transaction instead of talking to SMTP, so an email exists if and
+only if the write committed, and a slow or failing mail server never rolls
+back or aborts the work that caused it. Once the transaction commits a
+drain task is queued, and Celery beat runs one every
+EMAIL_OUTBOX_DRAIN_INTERVAL seconds to pick up retries and lost wake-ups.
+
+A drain claims due rows in batches by stamping them with a claim token and
+a lease, using SELECT ... FOR UPDATE SKIP LOCKED where the database has it.
+The claim UPDATE re-checks that each row is still claimable, so on
+databases without row locks two drains never send the same row either. A
+worker that dies mid-batch leaves its rows to be reclaimed once the lease
+expires. Failed emails are retried with exponential backoff; after
+EMAIL_OUTBOX_MAX_ATTEMPTS, or on a permanent (5xx) SMTP error, they are
+dead-lettered and kept for inspection.
+"""
+import logging
+import smtplib
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Min, Q
+from django.utils import timezone
+
+from .delivery import build_message, deliver
+from .models import EmailOutbox
+
+logger = logging.getLogger(__name__)
+
+
+def get_batch_size():
+    """Return how many emails one drain claims at a time"""
+    return getattr(settings, 'EMAIL_OUTBOX_BATCH_SIZE', 100)
+
+
+def get_lease():
+    """Return how long a claimed batch is held before other drains may take it"""
+    return timedelta(seconds=getattr(settings, 'EMAIL_OUTBOX_LEASE', 300))
+
+
+def get_max_attempts():
+    return getattr(settings, 'EMAIL_OUTBOX_MAX_ATTEMPTS', 8)
+
+
+def retry_delay(attempts):
+    """Return the wait before the next try of an email that has failed attempts times"""
+    base = getattr(settings, 'EMAIL_OUTBOX_RETRY_BASE', 30)
+    cap = getattr(settings, 'EMAIL_OUTBOX_RETRY_MAX', 3600)
+    return timedelta(seconds=min(cap, base * 2 ** (attempts - 1)))
+
+
+def is_permanent(exc):
+    """Return whether an SMTP error will fail the same way on every retry"""
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return bool(exc.recipients) and all(code >= 500 for code, _ in exc.recipients.values())
+    return isinstance(exc, smtplib.SMTPResponseException) and exc.smtp_code >= 500
+
+
+def kick():
+    """Queue a drain task"""
+    # Imported here because the task module imports this one
+    from .tasks import drain_email_outbox
+    drain_email_outbox.delay()
+
+
+def enqueue_emails(emails):
+    """
+    Add (subject, body, recipient) emails to the outbox in the current
+    transaction and wake a drain once it commits. Returns the rows.
+    """
+    now = timezone.now()
+    rows = [
+        EmailOutbox(subject=subject, body=body, recipient=recipient, next_attempt_at=now)
+        for subject, body, recipient in emails
+    ]
+    if not rows:
+        return []
+    with transaction.atomic():
+        EmailOutbox.objects.bulk_create(rows)
+        # A broker outage only delays the email until the next beat drain
+        transaction.on_commit(kick, robust=True)
+    return rows
+
+
+def enqueue_email(subject, body, recipient):
+    """Add one email to the outbox in the current transaction"""
+    return enqueue_emails([(subject, body, recipient)])[0]
+
+
+def claimable(now):
+    """Rows that are due, or whose previous claim has expired"""
+    return (
+        Q(status='pending', next_attempt_at__lte=now)
+        | Q(status='sending', leased_until__lt=now)
+    )
+
+
+def claim_batch(batch_size=None, now=None):
+    """
+    Claim a batch of due emails for this drain and return them, or None if
+    none are due. The list is empty when other drains claimed every row
+    picked first, which only happens without row locks.
+    """
+    now = now or timezone.now()
+    token = str(uuid.uuid4())
+    with transaction.atomic():
+        ids = list(
+            EmailOutbox.objects.select_for_update(skip_locked=True)
+            .filter(claimable(now)).order_by('next_attempt_at', 'id')
+            .values_list('id', flat=True)[:batch_size or get_batch_size()]
+        )
+        if not ids:
+            return None
+        EmailOutbox.objects.filter(claimable(now), id__in=ids).update(
+            status='sending', claim_token=token, leased_until=now + get_lease()
+        )
+    return list(EmailOutbox.objects.filter(claim_token=token))
+
+
+def send_batch(rows, now=None):
+    """
+    Send claimed emails and record the outcome of each. Returns the
+    numbers of emails sent, retried and dead-lettered.
+    """
+    token = rows[0].claim_token if rows else None
+    messages = {}
+    for row in rows:
+        messages[row.id] = build_message(row.subject, row.body, row.recipient)
+    errors = {id(message): exc for message, exc in deliver(list(messages.values()))}
+    now = now or timezone.now()
+
+    sent, failed = [], []
+    for row in rows:
+        exc = errors.get(id(messages[row.id]))
+        if exc is None:
+            sent.append(row.id)
+            continue
+        row.attempts += 1
+        row.last_error = f"{type(exc).__name__}: {exc}"[:1000]
+        row.claim_token = row.leased_until = None
+        if row.attempts >= get_max_attempts() or is_permanent(exc):
+            row.status = 'dead'
+            logger.error("Dead-lettered email %s to %s: %s", row.id, row.recipient, row.last_error)
+        else:
+            row.status = 'pending'
+            row.next_attempt_at = now + retry_delay(row.attempts)
+        failed.append(row)
+
+    # Only rows still under this batch's claim are updated, in case the
+    # lease ran out and another drain took them over
+    with transaction.atomic():
+        EmailOutbox.objects.filter(id__in=sent, claim_token=token).update(
+            status='sent', sent_at=now, claim_token=None, leased_until=None
+        )
+        for row in failed:
+            EmailOutbox.objects.filter(id=row.id, claim_token=token).update(
+                status=row.status,
+                attempts=row.attempts,
+                next_attempt_at=row.next_attempt_at,
+                last_error=row.last_error,
+                claim_token=None,
+                leased_until=None,
+            )
+    dead = sum(1 for row in failed if row.status == 'dead')
+    return len(sent), len(failed) - dead, dead
+
+
+def drain_outbox(batch_size=None, max_batches=None):
+    """
+    Send due emails batch by batch until none are left (or max_batches
+    have been sent). Returns the counts of sent, retried and dead emails.
+    """
+    totals = {'sent': 0, 'retried': 0, 'dead': 0}
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        rows = claim_batch(batch_size)
+        if rows is None:
+            break
+        if not rows:
+            continue
+        sent, retried, dead = send_batch(rows)
+        totals['sent'] += sent
+        totals['retried'] += retried
+        totals['dead'] += dead
+        batches += 1
+    return totals
+
+
+def retry_dead(ids=None):
+    """Put dead-lettered emails back in the queue; returns how many"""
+    rows = EmailOutbox.objects.filter(status='dead')
+    if ids:
+        rows = rows.filter(id__in=ids)
+    return rows.update(status='pending', attempts=0, next_attempt_at=timezone.now(), last_error='')
+
+
+def purge_sent(before):
+    """Delete sent emails older than the given time; returns how many"""
+    deleted, _ = EmailOutbox.objects.filter(status='sent', sent_at__lt=before).delete()
+    return deleted
+
+
+def outbox_stats(now=None):
+    """
+    Return the queue depth (pending, due now, being sent, dead), the age
+    of the oldest due email in seconds, and the send rate in emails per
+    minute over the last minute and the last 15 minutes
+    """
+    now = now or timezone.now()
+    stats = EmailOutbox.objects.aggregate(
+        pending=Count('id', filter=Q(status='pending')),
+        due=Count('id', filter=Q(status='pending', next_attempt_at__lte=now)),
+        sending=Count('id', filter=Q(status='sending')),
+        dead=Count('id', filter=Q(status='dead')),
+        oldest_due=Min('next_attempt_at', filter=Q(status='pending', next_attempt_at__lte=now)),
+        sent_1m=Count('id', filter=Q(status='sent', sent_at__gt=now - timedelta(minutes=1))),
+        sent_15m=Count('id', filter=Q(status='sent', sent_at__gt=now - timedelta(minutes=15))),
+    )
+    oldest_due = stats.pop('oldest_due')
+    stats['oldest_due_age'] = (now - oldest_due).total_seconds() if oldest_due else 0.0
+    stats['rate_1m'] = float(stats.pop('sent_1m'))
+    stats['rate_15m'] = stats.pop('sent_15m') / 15
+    return stats
@@ -0,0 +1,6 @@
+from timetable_app.pagination import KeysetPagination
+
+
+class NotificationPagination(KeysetPagination):
+    """Notifications newest first, paged by (time, id)"""
+    ordering = ('-time', '-id')
@@ -0,0 +1,137 @@
+"""
+Chunked retention for read notifications.
+
+Old read notifications are deleted in primary-key batches. Each batch is
+one short transaction: select the next ids after the last one seen, write
+the rows to the archive if one is configured, and remove them with a raw
+DELETE ... WHERE id IN (...), which skips the ORM's collection of related
+rows and per-row signals. Nothing references a notification and only read
+rows are removed, so there is nothing to cascade and the unread counters
+are unaffected. The job sleeps between batches so other writers get the
+table in between.
+
+With NOTIFICATION_ARCHIVE_DIR set, every purged row is first appended to a
+gzip-compressed NDJSON file in that directory, one file per run.
+"""
+import gzip
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Notification
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_FIELDS = (
+    'id', 'user_id', 'lesson_id', 'message', 'time', 'read', 'type',
+    'email_sent', 'kind', 'occurrence_date', 'offset_minutes',
+)
+
+
+def get_batch_size():
+    """Return how many notifications are deleted per transaction"""
+    return getattr(settings, 'NOTIFICATION_RETENTION_BATCH_SIZE', 1000)
+
+
+def get_pause():
+    """Return the seconds to sleep between batches"""
+    return getattr(settings, 'NOTIFICATION_RETENTION_PAUSE', 0.05)
+
+
+def get_archive_dir():
+    """Return the directory purged notifications are archived to, or None"""
+    return getattr(settings, 'NOTIFICATION_ARCHIVE_DIR', None)
+
+
+@dataclass
+class RetentionStats:
+    """Throughput of a retention run"""
+    deleted: int = 0
+    batches: int = 0
+    archive: str = None
+    started: float = field(default_factory=time.monotonic)
+    elapsed: float = 0.0
+    # Time spent in the database and archive, excluding pauses
+    working: float = 0.0
+
+    @property
+    def rows_per_second(self):
+        return self.deleted / self.working if self.working else 0.0
+
+    def as_dict(self):
+        return {
+            'deleted': self.deleted,
+            'batches': self.batches,
+            'archive': self.archive,
+            'elapsed': round(self.elapsed, 3),
+            'rows_per_second': round(self.rows_per_second, 1),
+        }
+
+
+def archive_path(archive_dir):
+    stamp = timezone.now().strftime('%Y%m%dT%H%M%S%f')
+    return os.path.join(archive_dir, f'notifications-{stamp}.ndjson.gz')
+
+
+def purge_notifications(before, batch_size=None, archive_dir=None, pause=None):
+    """
+    Delete read notifications older than before in primary-key batches,
+    archiving them first if archive_dir is given, and return the run's stats
+    """
+    batch_size = batch_size or get_batch_size()
+    pause = get_pause() if pause is None else pause
+    stats = RetentionStats()
+    archive = None
+    if archive_dir:
+        os.makedirs(archive_dir, exist_ok=True)
+        stats.archive = archive_path(archive_dir)
+
+    rows = Notification.objects.filter(read=True, time__lt=before).order_by('id')
+    last_id = 0
+    try:
+        while True:
+            batch_started = time.monotonic()
+            with transaction.atomic():
+                if archive_dir:
+                    batch = list(rows.filter(id__gt=last_id).values(*ARCHIVE_FIELDS)[:batch_size])
+                    ids = [row['id'] for row in batch]
+                else:
+                    batch = None
+                    ids = list(rows.filter(id__gt=last_id).values_list('id', flat=True)[:batch_size])
+                if not ids:
+                    break
+                if batch is not None:
+                    if archive is None:
+                        archive = gzip.open(stats.archive, 'wt', encoding='utf-8')
+                    archive.writelines(json.dumps(row, cls=DjangoJSONEncoder) + '\n' for row in batch)
+                    # Rows must be on disk before they leave the table
+                    archive.flush()
+                deleted = Notification.objects.filter(id__in=ids)._raw_delete(Notification.objects.db)
+            last_id = ids[-1]
+            stats.deleted += deleted
+            stats.batches += 1
+            stats.working += time.monotonic() - batch_started
+            if len(ids) < batch_size:
+                break
+            if pause:
+                time.sleep(pause)
+    finally:
+        if archive is not None:
+            archive.close()
+        stats.elapsed = time.monotonic() - stats.started
+
+    if archive is None:
+        stats.archive = None
+    logger.info(
+        "Purged %d notifications in %d batches, %.3fs (%.1f rows/s)%s",
+        stats.deleted, stats.batches, stats.elapsed, stats.rows_per_second,
+        f", archived to {stats.archive}" if stats.archive else "",
+    )
+    return stats
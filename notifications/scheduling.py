@@ -0,0 +1,302 @@
+"""
+Exact-time lesson reminders.
+
+Each reminder is a Celery task with an ETA at the reminder instant, so no
+job has to poll the lesson table every minute. A planner task runs every
+LESSON_REMINDER_PLAN_INTERVAL seconds and schedules the reminders that fire
+within the next LESSON_REMINDER_HORIZON minutes, picking up the candidate
+lessons with a range query on the indexed Lesson.minute_of_week.
+
+Every scheduled task has a ScheduledReminder row per lesson occurrence and
+offset holding its task id. When a lesson or one of its exceptions changes,
+the lesson's rows are compared with the reminders it should now have, and
+the ones that moved or went away are revoked and rescheduled. A task only
+sends its reminder while its row still carries its task id, so a revoke
+that never reaches a worker is harmless.
+
+The short horizon bounds how long ETA tasks wait in workers; the broker's
+visibility_timeout must be longer than it, or Redis redelivers them.
+"""
+import logging
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from celery import current_app
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from timetable_app.models import Lesson, LessonException, get_minute_of_week
+from timetable_app.occurrences import first_occurrence_date
+from .models import ReminderWatermark, ScheduledReminder
+from .digests import build_digest, get_digest_window
+from .outbox import enqueue_emails
+from .services import create_notifications
+
+logger = logging.getLogger(__name__)
+
+PLAN_WATERMARK = 'lesson_reminder_plan'
+
+
+def get_reminder_offsets():
+    """Return the reminder offsets in minutes before the lesson starts"""
+    return tuple(getattr(settings, 'LESSON_REMINDER_OFFSETS', (30, 10)))
+
+
+def window_filter(start, end):
+    """
+    Build a filter matching lessons that start in the half-open window
+    (start, end] of local time. The window must be shorter than a week.
+    """
+    low = get_minute_of_week(start.weekday(), start.time())
+    high = get_minute_of_week(end.weekday(), end.time())
+    if low < high:
+        return Q(minute_of_week__gt=low, minute_of_week__lte=high)
+    # The window wraps around midnight between Sunday and Monday
+    return Q(minute_of_week__gt=low) | Q(minute_of_week__lte=high)
+
+
+def get_horizon():
+    """Return how far ahead reminders are scheduled"""
+    return timedelta(minutes=getattr(settings, 'LESSON_REMINDER_HORIZON', 120))
+
+
+def occurrence_start(on_date, start_time):
+    return timezone.make_aware(datetime.combine(on_date, start_time))
+
+
+def reminder_times(lesson, exceptions, start, end, offsets):
+    """
+    Yield (occurrence date, offset, fire_at) for the reminders of a lesson
+    that fire in (start, end]. exceptions maps dates to the lesson's
+    exceptions; cancelled occurrences have no reminders and rescheduled
+    ones are reminded of at their new time.
+    """
+    current = timezone.localtime(start + timedelta(minutes=min(offsets))).date()
+    last = timezone.localtime(end + timedelta(minutes=max(offsets))).date()
+    while current <= last:
+        if current.weekday() == lesson.day and (
+            lesson.is_recurring or current == first_occurrence_date(lesson)
+        ):
+            exception = exceptions.get(current)
+            if exception is None or exception.exception_type != 'cancelled':
+                begins = occurrence_start(current, (exception and exception.start_time) or lesson.start_time)
+                for offset in offsets:
+                    fire_at = begins - timedelta(minutes=offset)
+                    if start < fire_at <= end:
+                        yield current, offset, fire_at
+        current += timedelta(days=1)
+
+
+def revoke(task_ids):
+    """Ask the workers to drop delayed reminder tasks, logging broker failures"""
+    if not task_ids:
+        return
+    try:
+        current_app.control.revoke(list(task_ids))
+    except Exception:
+        # The task checks its handle before sending, so this is only cleanup
+        logger.warning("Could not revoke %d reminder tasks", len(task_ids), exc_info=True)
+
+
+def enqueue(reminders):
+    """Send the delayed tasks of newly scheduled reminders"""
+    # Imported here because the task module imports this one
+    from .tasks import send_scheduled_reminder
+    for reminder in reminders:
+        send_scheduled_reminder.apply_async(
+            task_id=reminder.task_id,
+            eta=reminder.fire_at,
+            # A reminder is useless once the lesson has started
+            expires=reminder.fire_at + timedelta(minutes=reminder.offset_minutes),
+        )
+
+
+def get_planned_until():
+    """Return the end of the range the planner has scheduled, or None"""
+    return ReminderWatermark.objects.filter(name=PLAN_WATERMARK).values_list('last_run', flat=True).first()
+
+
+def sync_reminders(lesson_ids, until=None, now=None):
+    """
+    Bring the scheduled reminders of these lessons in line with the
+    timetable up to until (by default, as far as the planner has
+    scheduled): revoke the ones that moved or went away and schedule the
+    missing ones once the transaction commits. Returns the number of
+    reminders scheduled.
+    """
+    lesson_ids = list(lesson_ids)
+    now = now or timezone.now()
+    until = until or get_planned_until() or now
+    offsets = get_reminder_offsets()
+
+    existing = defaultdict(dict)
+    for reminder in ScheduledReminder.objects.filter(lesson_id__in=lesson_ids, fire_at__gt=now):
+        existing[reminder.lesson_id][(reminder.occurrence_date, reminder.offset_minutes)] = reminder
+    # Never leave behind a reminder scheduled further ahead than until
+    end = max([until] + [r.fire_at for rows in existing.values() for r in rows.values()])
+
+    lessons = Lesson.objects.filter(id__in=lesson_ids) if end > now else Lesson.objects.none()
+    exceptions = defaultdict(dict)
+    first = timezone.localtime(now).date()
+    last = timezone.localtime(end + timedelta(minutes=max(offsets))).date()
+    for exception in LessonException.objects.filter(lesson_id__in=lesson_ids, date__range=(first, last)):
+        exceptions[exception.lesson_id][exception.date] = exception
+
+    stale, fresh = [], []
+    for lesson in lessons:
+        rows = existing.pop(lesson.id, {})
+        for on_date, offset, fire_at in reminder_times(lesson, exceptions[lesson.id], now, end, offsets):
+            reminder = rows.pop((on_date, offset), None)
+            if reminder is not None and reminder.fire_at == fire_at:
+                continue
+            if reminder is not None:
+                stale.append(reminder)
+            fresh.append(ScheduledReminder(
+                lesson=lesson,
+                occurrence_date=on_date,
+                offset_minutes=offset,
+                fire_at=fire_at,
+                task_id=str(uuid.uuid4()),
+            ))
+        stale.extend(rows.values())
+    # Lessons that no longer exist
+    stale.extend(reminder for rows in existing.values() for reminder in rows.values())
+
+    with transaction.atomic():
+        if stale:
+            ScheduledReminder.objects.filter(id__in=[reminder.id for reminder in stale]).delete()
+            task_ids = [reminder.task_id for reminder in stale]
+            transaction.on_commit(lambda: revoke(task_ids))
+        if fresh:
+            # A reminder planned concurrently keeps its row; the task
+            # sent for the ignored duplicate finds no handle and does nothing
+            ScheduledReminder.objects.bulk_create(fresh, ignore_conflicts=True)
+            transaction.on_commit(lambda: enqueue(fresh))
+    return len(fresh)
+
+
+def reschedule_on_commit(lesson_ids):
+    """Sync the reminders of these lessons once the current transaction commits"""
+    lesson_ids = list(lesson_ids)
+    transaction.on_commit(lambda: sync_reminders(lesson_ids), robust=True)
+
+
+def revoke_on_commit(reminders):
+    """Revoke the tasks of reminders once the delete that cascades to them commits"""
+    task_ids = list(reminders.values_list('task_id', flat=True))
+    if task_ids:
+        transaction.on_commit(lambda: revoke(task_ids), robust=True)
+
+
+def revoke_lesson_reminders(lesson):
+    """Revoke a deleted lesson's reminder tasks"""
+    revoke_on_commit(lesson.scheduled_reminders.all())
+
+
+def revoke_teacher_reminders(teacher):
+    """Revoke the reminder tasks of every lesson of a deleted teacher, in one query"""
+    revoke_on_commit(ScheduledReminder.objects.filter(lesson__teacher=teacher))
+
+
+def plan_reminders(now=None):
+    """
+    Schedule every reminder firing between the end of the previous plan
+    and LESSON_REMINDER_HORIZON from now. Returns the number scheduled.
+    """
+    now = now or timezone.now()
+    horizon_end = now + get_horizon()
+    offsets = get_reminder_offsets()
+
+    with transaction.atomic():
+        watermark, _ = ReminderWatermark.objects.select_for_update().get_or_create(
+            name=PLAN_WATERMARK, defaults={'last_run': now}
+        )
+        since = max(watermark.last_run, now)
+        if since >= horizon_end:
+            return 0
+
+        query = Q()
+        for offset in offsets:
+            query |= window_filter(
+                timezone.localtime(since + timedelta(minutes=offset)),
+                timezone.localtime(horizon_end + timedelta(minutes=offset)),
+            )
+        # Occurrences moved into the range by an exception
+        first = timezone.localtime(since + timedelta(minutes=min(offsets))).date()
+        last = timezone.localtime(horizon_end + timedelta(minutes=max(offsets))).date()
+        moved = LessonException.objects.filter(
+            date__range=(first, last), start_time__isnull=False
+        ).exclude(exception_type='cancelled').values('lesson_id')
+        lesson_ids = Lesson.objects.filter(query | Q(id__in=moved)).values_list('id', flat=True)
+
+        scheduled = sync_reminders(lesson_ids, until=horizon_end, now=now)
+
+        watermark.last_run = horizon_end
+        watermark.save(update_fields=['last_run'])
+
+    # Handles of tasks that were lost rather than run
+    ScheduledReminder.objects.filter(fire_at__lt=now - timedelta(days=1)).delete()
+    logger.info("Scheduled %d lesson reminders up to %s", scheduled, horizon_end)
+    return scheduled
+
+
+def reminder_item(reminder, sent_at):
+    """Describe a reminder for a digest sent at sent_at"""
+    starts_at = reminder.fire_at + timedelta(minutes=reminder.offset_minutes)
+    return {
+        'lesson': reminder.lesson,
+        'occurrence_date': reminder.occurrence_date,
+        'offset_minutes': reminder.offset_minutes,
+        'starts_at': starts_at,
+        'minutes': round((starts_at - sent_at).total_seconds() / 60),
+    }
+
+
+def send_reminder(task_id):
+    """
+    Send the reminder whose handle carries task_id, together with the
+    teacher's other reminders due within LESSON_REMINDER_DIGEST_WINDOW, as
+    one digest. Returns whether one was sent.
+    """
+    reminder = ScheduledReminder.objects.select_related('lesson__teacher').filter(task_id=task_id).first()
+    if reminder is None:
+        # Revoked, rescheduled or sent in an earlier digest since this task was sent
+        return False
+    teacher = reminder.lesson.teacher
+    following = (
+        ScheduledReminder.objects.select_related('lesson')
+        .filter(
+            lesson__teacher=teacher,
+            fire_at__gte=reminder.fire_at,
+            fire_at__lte=reminder.fire_at + get_digest_window(),
+        )
+        .exclude(id=reminder.id).order_by('fire_at', 'id')
+    )
+    with transaction.atomic():
+        items = []
+        occurrences = set()
+        for candidate in [reminder, *following]:
+            occurrence = (candidate.lesson_id, candidate.occurrence_date)
+            if occurrence in occurrences:
+                # A later reminder of a lesson already in the digest keeps its own task
+                continue
+            # Deleting the handle claims the reminder; one taken by a
+            # concurrent digest is left to it
+            if ScheduledReminder.objects.filter(id=candidate.id).delete()[0]:
+                occurrences.add(occurrence)
+                items.append(reminder_item(candidate, reminder.fire_at))
+            elif candidate is reminder:
+                return False
+        notification, email = build_digest(teacher, items)
+        # The dedup key makes a redelivered task a no-op
+        if create_notifications([notification]):
+            enqueue_emails([email])
+            return True
+        # This reminder was sent before, e.g. ahead of its lesson being
+        # moved: hand the other claimed reminders back to their own tasks
+        transaction.set_rollback(True)
+    ScheduledReminder.objects.filter(id=reminder.id).delete()
+    return False
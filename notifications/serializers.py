@@ -9,6 +9,6 @@ class NotificationSerializer(serializers.ModelSerializer):
     class Meta:
         model = Notification
         fields = ('id', 'user', 'lesson', 'lesson_title', 'message', 
-                  'time', 'read', 'type')
+                  'time', 'read', 'type', 'kind')
         read_only_fields = ('id', 'user', 'lesson', 'lesson_title', 
-                           'message', 'time', 'type')
\ No newline at end of file
+                           'message', 'time', 'type', 'kind')
\ No newline at end of file
@@ -0,0 +1,102 @@
+from django.conf import settings
+from django.db import IntegrityError, connections, router, transaction
+from django.db.models.constants import OnConflict
+from django.db.models.sql import InsertQuery
+from notifications.counters import adjust_unread, unread_deltas
+from notifications.models import Notification
+from notifications.stream import publish_notifications_on_commit
+
+# Fields of Notification.dedup_key, in order
+DEDUP_FIELDS = ('kind', 'lesson', 'occurrence_date', 'offset_minutes')
+
+
+def get_bulk_batch_size():
+    """Return the number of rows written per bulk statement"""
+    return getattr(settings, 'NOTIFICATION_BULK_BATCH_SIZE', 500)
+
+
+def create_notifications(notifications, batch_size=None):
+    """
+    Insert unsaved notifications with chunked bulk_create and return the
+    ones that were actually inserted. Notifications carrying a dedup key
+    are written with insert-or-ignore, so one whose key already exists is
+    skipped by the database and left out of the result.
+    No post_save signals are sent for these rows; unread counters are
+    adjusted here instead, in the same transaction, and the new rows are
+    published to connected streams once it commits.
+    """
+    if not notifications:
+        return []
+    batch_size = batch_size or get_bulk_batch_size()
+
+    keyed = [notification for notification in notifications if notification.dedup_key is not None]
+    plain = [notification for notification in notifications if notification.dedup_key is None]
+
+    with transaction.atomic():
+        created = Notification.objects.bulk_create(plain, batch_size=batch_size)
+        if keyed:
+            created += _insert_keyed(keyed, batch_size)
+        adjust_unread(unread_deltas(created))
+        publish_notifications_on_commit(created)
+    return created
+
+
+def _insert_keyed(notifications, batch_size):
+    """
+    Insert keyed notifications, skipping the ones whose key already exists,
+    and return the ones this call wrote with their primary keys assigned.
+    Uses INSERT ... ON CONFLICT DO NOTHING RETURNING where the database
+    has it (PostgreSQL, SQLite 3.35+), so only the rows actually written
+    come back; elsewhere rows are inserted one by one in savepoints.
+    """
+    using = router.db_for_write(Notification)
+    connection = connections[using]
+    if not connection.features.can_return_rows_from_bulk_insert:
+        return _insert_one_by_one(notifications, using)
+
+    opts = Notification._meta
+    fields = [field for field in opts.concrete_fields if field is not opts.pk]
+    returning = [opts.pk] + [opts.get_field(name) for name in DEDUP_FIELDS]
+    by_key = {}
+    for notification in notifications:
+        # Duplicates within the call: the first one is inserted
+        by_key.setdefault(notification.dedup_key, notification)
+
+    inserted = []
+    for start in range(0, len(notifications), batch_size):
+        query = InsertQuery(Notification, on_conflict=OnConflict.IGNORE)
+        query.insert_values(fields, notifications[start:start + batch_size])
+        compiler = query.get_compiler(using=using)
+        compiler.returning_fields = returning
+        with connection.cursor() as cursor:
+            for sql, params in compiler.as_sql():
+                cursor.execute(sql, params)
+            rows = cursor.fetchall()
+        converters = compiler.get_converters([field.get_col(opts.db_table) for field in returning])
+        if converters:
+            rows = compiler.apply_converters(rows, converters)
+        for pk, *key in rows:
+            notification = by_key[tuple(key)]
+            notification.pk = pk
+            notification._state.adding = False
+            notification._state.db = using
+            inserted.append(notification)
+    return inserted
+
+
+def _insert_one_by_one(notifications, using):
+    """Insert keyed notifications one at a time, skipping duplicate keys"""
+    inserted = []
+    for notification in notifications:
+        try:
+            with transaction.atomic(using=using):
+                Notification.objects.using(using).bulk_create([notification])
+        except IntegrityError:
+            continue
+        if notification.pk is None:
+            notification.pk = Notification.objects.using(using).values_list('pk', flat=True).get(
+                **dict(zip(DEDUP_FIELDS, notification.dedup_key))
+            )
+        notification._state.adding = False
+        inserted.append(notification)
+    return inserted
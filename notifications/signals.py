@@ -0,0 +1,91 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.models import Count, QuerySet
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from timetable_app.models import Lesson, LessonException
+from .buffer import suppress_notifications
+from .counters import adjust_unread
+from .models import Notification
+from .scheduling import reschedule_on_commit, revoke_lesson_reminders, revoke_teacher_reminders
+from .stream import publish_notifications_on_commit
+
+
+@receiver(post_save, sender=Notification)
+def update_unread_counter(sender, instance, created, **kwargs):
+    """Keep the user's unread counter in step with a saved notification"""
+    previous = None if created else getattr(instance, '_loaded_read', None)
+    if created:
+        publish_notifications_on_commit([instance])
+    if created and not instance.read:
+        adjust_unread({instance.user_id: 1})
+    elif previous is not None and previous != instance.read:
+        adjust_unread({instance.user_id: -1 if instance.read else 1})
+    instance._loaded_read = instance.read
+
+
+def deleted_with_user(origin):
+    """
+    Return whether a delete started from a user. Their lessons are then
+    handled at once by the user's receivers instead of one by one, and
+    Django sends every lesson's pre_delete before the user's.
+    """
+    model = origin.model if isinstance(origin, QuerySet) else type(origin)
+    return issubclass(model, get_user_model())
+
+
+def discount_unread(notifications):
+    """Take unread notifications off their users' counters, with one grouped query"""
+    unread = (
+        notifications.filter(read=False).order_by()
+        .values('user_id').annotate(total=Count('id')).values_list('user_id', 'total')
+    )
+    adjust_unread({user_id: -total for user_id, total in unread})
+
+
+@receiver(pre_delete, sender=Lesson)
+def discount_lesson_notifications(sender, instance, origin=None, **kwargs):
+    """Take a lesson's unread notifications off the counters before they cascade away"""
+    if not deleted_with_user(origin):
+        discount_unread(Notification.objects.filter(lesson=instance))
+
+
+@receiver(pre_delete, sender=settings.AUTH_USER_MODEL)
+def suppress_deleted_user_notifications(sender, instance, using, **kwargs):
+    """Drop the notifications a user's cascading delete would raise for them"""
+    suppress_notifications(instance.pk, using)
+
+
+@receiver(pre_delete, sender=settings.AUTH_USER_MODEL)
+def discount_deleted_user_lessons(sender, instance, **kwargs):
+    """
+    Take other users' unread notifications about a deleted user's lessons
+    off their counters; the user's own counter goes with them
+    """
+    discount_unread(Notification.objects.filter(lesson__teacher=instance).exclude(user=instance))
+
+
+@receiver(post_save, sender=Lesson)
+def reschedule_lesson_reminders(sender, instance, **kwargs):
+    """Move a lesson's scheduled reminders to its new time once the save commits"""
+    reschedule_on_commit([instance.id])
+
+
+@receiver(pre_delete, sender=Lesson)
+def revoke_deleted_lesson_reminders(sender, instance, origin=None, **kwargs):
+    """Revoke a deleted lesson's reminder tasks"""
+    if not deleted_with_user(origin):
+        revoke_lesson_reminders(instance)
+
+
+@receiver(pre_delete, sender=settings.AUTH_USER_MODEL)
+def revoke_deleted_user_reminders(sender, instance, **kwargs):
+    """Revoke the reminder tasks of a deleted teacher's lessons"""
+    revoke_teacher_reminders(instance)
+
+
+@receiver(post_save, sender=LessonException)
+@receiver(post_delete, sender=LessonException)
+def reschedule_exception_reminders(sender, instance, **kwargs):
+    """Drop or move the reminders of a cancelled or rescheduled occurrence"""
+    reschedule_on_commit([instance.lesson_id])
@@ -0,0 +1,236 @@
+"""
+Server-push of notification events over Redis pub/sub.
+
+Writers publish to a per-user channel once their transaction commits: new
+notifications as they are created and the user's unread count whenever it
+changes. Each ASGI process keeps one Redis pub/sub connection, shared by
+a NotificationHub that subscribes to a user's channel while at least one
+of their streams is open and fans messages out to per-stream asyncio
+queues, so an idle client costs a queue rather than a thread.
+
+Publishing is disabled (a no-op) unless NOTIFICATION_STREAM_REDIS_URL is set.
+
+EventSource cannot send headers, so browsers open a stream with a ticket
+in the URL rather than their access token: a signed user id that is only
+good for opening streams and expires after NOTIFICATION_STREAM_TICKET_MAX_AGE
+seconds, so one leaked through an access log is of little use.
+"""
+import asyncio
+import json
+import logging
+
+import redis
+import redis.asyncio
+from django.conf import settings
+from django.core import signing
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+
+from .models import UnreadCounter
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'notifications:user:{user_id}'
+CHANNEL_PREFIX = CHANNEL.format(user_id='')
+TICKET_SALT = 'notifications.stream'
+
+_publisher = None
+_hub = None
+
+
+def get_stream_url():
+    """Return the Redis URL for notification events, or None if streaming is disabled"""
+    return getattr(settings, 'NOTIFICATION_STREAM_REDIS_URL', None)
+
+
+def make_stream_ticket(user_id):
+    """Return a ticket that lets the user open streams for a short while"""
+    return signing.TimestampSigner(salt=TICKET_SALT).sign(str(user_id))
+
+
+def read_stream_ticket(ticket):
+    """Return the user id from a stream ticket, or None if it is forged or expired"""
+    max_age = getattr(settings, 'NOTIFICATION_STREAM_TICKET_MAX_AGE', 30)
+    try:
+        return int(signing.TimestampSigner(salt=TICKET_SALT).unsign(ticket, max_age=max_age))
+    except (signing.BadSignature, ValueError):
+        return None
+
+
+def channel_name(user_id):
+    return CHANNEL.format(user_id=user_id)
+
+
+def format_event(event, data):
+    """Encode one Server-Sent Events message"""
+    return f"event: {event}\ndata: {json.dumps(data, cls=DjangoJSONEncoder)}\n\n"
+
+
+def notification_payload(notification):
+    """
+    Return the API representation of a notification without touching the
+    database; the lesson title is only included if the lesson is loaded.
+    """
+    lesson = notification.lesson if type(notification).lesson.is_cached(notification) else None
+    return {
+        'id': notification.pk,
+        'user': notification.user_id,
+        'lesson': notification.lesson_id,
+        'lesson_title': lesson.title if lesson is not None else None,
+        'message': notification.message,
+        'time': notification.time,
+        'read': notification.read,
+        'type': notification.type,
+        'kind': notification.kind,
+    }
+
+
+def get_publisher():
+    """Return the shared synchronous Redis client used to publish events"""
+    global _publisher
+    if _publisher is None:
+        _publisher = redis.Redis.from_url(get_stream_url())
+    return _publisher
+
+
+def publish(messages):
+    """Publish (user_id, event, data) messages in one round trip, logging failures"""
+    if not messages:
+        return
+    try:
+        pipeline = get_publisher().pipeline(transaction=False)
+        for user_id, event, data in messages:
+            pipeline.publish(
+                channel_name(user_id),
+                json.dumps({'event': event, 'data': data}, cls=DjangoJSONEncoder),
+            )
+        pipeline.execute()
+    except redis.RedisError:
+        # Streams are best effort; clients resync their counts on reconnect
+        logger.warning("Could not publish %d notification events", len(messages), exc_info=True)
+
+
+def publish_notifications_on_commit(notifications):
+    """Publish newly created notifications once the current transaction commits"""
+    if not get_stream_url() or not notifications:
+        return
+    messages = [
+        (notification.user_id, 'notification', notification_payload(notification))
+        for notification in notifications
+    ]
+    transaction.on_commit(lambda: publish(messages))
+
+
+def publish_unread_counts_on_commit(user_ids):
+    """Publish the unread counts of these users once the current transaction commits"""
+    if not get_stream_url() or not user_ids:
+        return
+    user_ids = list(user_ids)
+
+    def send():
+        counts = UnreadCounter.objects.filter(user_id__in=user_ids).values_list('user_id', 'count')
+        publish([
+            (user_id, 'unread_count', {'unread_count': count})
+            for user_id, count in counts
+        ])
+    transaction.on_commit(send)
+
+
+class NotificationHub:
+    """
+    Per-process fan-out from one Redis pub/sub connection to the open
+    streams on this event loop.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.loop = asyncio.get_running_loop()
+        self.listeners = {}
+        self.pubsub = None
+        self.reader = None
+
+    async def subscribe(self, user_id):
+        """Register a stream for a user and return the queue its events arrive on"""
+        queue = asyncio.Queue(maxsize=getattr(settings, 'NOTIFICATION_STREAM_QUEUE_SIZE', 100))
+        listeners = self.listeners.setdefault(user_id, set())
+        listeners.add(queue)
+        if len(listeners) == 1:
+            try:
+                await self.get_pubsub().subscribe(channel_name(user_id))
+            except redis.RedisError:
+                await self.unsubscribe(user_id, queue)
+                raise
+        if self.reader is None or self.reader.done():
+            self.reader = asyncio.create_task(self.read())
+        return queue
+
+    async def unsubscribe(self, user_id, queue):
+        """Remove a stream, dropping the channel subscription with the last one"""
+        listeners = self.listeners.get(user_id)
+        if listeners is None:
+            return
+        listeners.discard(queue)
+        if listeners:
+            return
+        del self.listeners[user_id]
+        try:
+            await self.get_pubsub().unsubscribe(channel_name(user_id))
+        except redis.RedisError:
+            logger.warning("Could not unsubscribe from %s", channel_name(user_id), exc_info=True)
+
+    def get_pubsub(self):
+        if self.pubsub is None:
+            self.pubsub = redis.asyncio.Redis.from_url(self.url).pubsub()
+        return self.pubsub
+
+    async def reconnect(self):
+        """Replace a broken pub/sub connection and resubscribe the open streams"""
+        old, self.pubsub = self.pubsub, None
+        if old is not None:
+            try:
+                await old.close()
+            except redis.RedisError:
+                pass
+        channels = [channel_name(user_id) for user_id in self.listeners]
+        if channels:
+            await self.get_pubsub().subscribe(*channels)
+
+    async def read(self):
+        """Dispatch published messages to the queues of the open streams"""
+        while self.listeners:
+            try:
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except (redis.RedisError, OSError, RuntimeError):
+                logger.warning("Notification pub/sub connection lost, reconnecting", exc_info=True)
+                await asyncio.sleep(1)
+                try:
+                    await self.reconnect()
+                except redis.RedisError:
+                    pass
+                continue
+            if message is not None:
+                self.dispatch(message)
+
+    def dispatch(self, message):
+        channel = message['channel']
+        if isinstance(channel, bytes):
+            channel = channel.decode()
+        try:
+            user_id = int(channel[len(CHANNEL_PREFIX):])
+            event = json.loads(message['data'])
+        except (ValueError, TypeError):
+            return
+        for queue in self.listeners.get(user_id, ()):
+            try:
+                queue.put_nowait((event['event'], event['data']))
+            except asyncio.QueueFull:
+                # A stalled client loses events rather than holding memory
+                pass
+
+
+def get_hub():
+    """Return the hub for the running event loop"""
+    global _hub
+    if _hub is None or _hub.loop is not asyncio.get_running_loop():
+        _hub = NotificationHub(get_stream_url())
+    return _hub
@@ -0,0 +1,106 @@
+"""
+Daily notification summary emails.
+
+The users to summarise are read in one query and split into chunks of
+NOTIFICATION_SUMMARY_CHUNK_SIZE, each handled by its own Celery task so
+the work spreads over every available worker. A chunk loads its users and
+then all of their notifications for the period in one query ordered by
+user, which is grouped in Python, so a chunk costs two queries whatever
+its size.
+"""
+from itertools import groupby
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+
+from .delivery import build_message, deliver
+from .models import Notification
+
+SUBJECT = "Teacher Timetable - Your Daily Summary"
+# Sections of the email, most urgent first
+SECTIONS = (
+    ('urgent', "URGENT NOTIFICATIONS"),
+    ('warning', "WARNING NOTIFICATIONS"),
+    ('info', "INFORMATION NOTIFICATIONS"),
+)
+
+
+def get_chunk_size():
+    """Return how many users one summary task handles"""
+    return getattr(settings, 'NOTIFICATION_SUMMARY_CHUNK_SIZE', 500)
+
+
+def summary_user_ids(since):
+    """Return the ids of the users with notifications since the given time"""
+    return list(
+        Notification.objects.filter(time__gte=since)
+        .order_by('user_id').values_list('user_id', flat=True).distinct()
+    )
+
+
+def chunked(values, size):
+    return [values[start:start + size] for start in range(0, len(values), size)]
+
+
+def render_summary(user, notifications):
+    """Return the body of a user's summary from (type, message) pairs, newest first"""
+    by_type = {}
+    for notification_type, message in notifications:
+        by_type.setdefault(notification_type, []).append(message)
+
+    body = f"Hello {user.first_name or user.username},\n\n"
+    body += "Here is your daily summary of notifications from Teacher Timetable:\n\n"
+    for notification_type, heading in SECTIONS:
+        messages = by_type.get(notification_type)
+        if messages:
+            body += f"{heading}:\n"
+            body += ''.join(f"- {message}\n" for message in messages)
+            body += "\n"
+    body += "Log in to your account to view more details and manage your timetable.\n\n"
+    body += "Best regards,\nTeacher Timetable Team"
+    return body
+
+
+def send_summaries(user_ids, since):
+    """
+    Email the summaries of a chunk of users and return the counts of
+    users, sent, skipped and failed emails
+    """
+    users = get_user_model().objects.filter(id__in=user_ids).only(
+        'id', 'email', 'first_name', 'username', 'notification_preferences'
+    ).in_bulk()
+    rows = (
+        Notification.objects.filter(user_id__in=user_ids, time__gte=since)
+        .order_by('user_id', '-time', '-id').values_list('user_id', 'type', 'message')
+    )
+
+    messages = []
+    skipped = 0
+    for user_id, group in groupby(rows.iterator(chunk_size=2000), key=lambda row: row[0]):
+        user = users.get(user_id)
+        if user is None:
+            continue
+        # Skip if the user has disabled summary emails
+        if user.notification_preferences.get('disable_summary_emails', False):
+            skipped += 1
+            continue
+        body = render_summary(user, ((row[1], row[2]) for row in group))
+        messages.append(build_message(SUBJECT, body, user.email))
+
+    # Send the emails over one pooled connection
+    failed = deliver(messages)
+    return {
+        'users': len(user_ids),
+        'sent': len(messages) - len(failed),
+        'skipped': skipped,
+        'failed': len(failed),
+    }
+
+
+def combine_results(results):
+    """Add up the counts returned by the chunk tasks"""
+    totals = {'users': 0, 'sent': 0, 'skipped': 0, 'failed': 0}
+    for result in results:
+        for name in totals:
+            totals[name] += result.get(name, 0)
+    return totals
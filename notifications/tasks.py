@@ -1,128 +1,107 @@
-from celery import shared_task
+import logging
+
+from celery import chord, shared_task
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from datetime import timedelta
 from django.conf import settings
-from django.core.mail import send_mail
-from timetable_app.models import Lesson
-from notifications.models import Notification
-from django.contrib.auth import get_user_model
+from notifications.buffer import existing, from_row
+from notifications.counters import reconcile_unread_counts
+from notifications.outbox import drain_outbox
+from notifications.scheduling import plan_reminders, send_reminder
+from notifications.services import create_notifications
+from notifications.summaries import (
+    chunked,
+    combine_results,
+    get_chunk_size,
+    send_summaries,
+    summary_user_ids,
+)
+
+logger = logging.getLogger(__name__)
 
 
 @shared_task
-def send_notification_summary():
+def send_notification_summary(chunk_size=None):
     """
-    Send a daily summary of notifications to users
+    Send a daily summary of notifications to users, fanned out to one
+    task per chunk of users and totalled when every chunk is done
     """
-    yesterday = timezone.now() - timedelta(days=1)
-    
-    # Get all users with notifications from the last day
-    User = get_user_model()
-    
-    users_with_notifications = User.objects.filter(
-        notifications__time__gte=yesterday
-    ).distinct()
-    
-    for user in users_with_notifications:
-        # Skip if the user has disabled summary emails
-        if user.notification_preferences.get('disable_summary_emails', False):
-            continue
-            
-        # Get all notifications for this user from the last day
-        notifications = Notification.objects.filter(
-            user=user,
-            time__gte=yesterday
-        ).order_by('-time')
-        
-        if not notifications.exists():
-            continue
-            
-        # Prepare email content
-        subject = f"Teacher Timetable - Your Daily Summary"
-        message = f"Hello {user.first_name or user.username},\n\n"
-        message += f"Here is your daily summary of notifications from Teacher Timetable:\n\n"
-        
-        # Group by type
-        info_notifications = notifications.filter(type='info')
-        warning_notifications = notifications.filter(type='warning')
-        urgent_notifications = notifications.filter(type='urgent')
-        
-        if urgent_notifications.exists():
-            message += "URGENT NOTIFICATIONS:\n"
-            for notif in urgent_notifications:
-                message += f"- {notif.message}\n"
-            message += "\n"
-            
-        if warning_notifications.exists():
-            message += "WARNING NOTIFICATIONS:\n"
-            for notif in warning_notifications:
-                message += f"- {notif.message}\n"
-            message += "\n"
-            
-        if info_notifications.exists():
-            message += "INFORMATION NOTIFICATIONS:\n"
-            for notif in info_notifications:
-                message += f"- {notif.message}\n"
-            message += "\n"
-        
-        message += "Log in to your account to view more details and manage your timetable.\n\n"
-        message += "Best regards,\nTeacher Timetable Team"
-        
-        # Send the email
-        send_mail(
-            subject,
-            message,
-            settings.DEFAULT_FROM_EMAIL,
-            [user.email],
-            fail_silently=False,
-        )
+    since = timezone.now() - timedelta(days=1)
+    user_ids = summary_user_ids(since)
+    if not user_ids:
+        return "Sent summary emails to 0 users"
     
-    return f"Sent summary emails to {users_with_notifications.count()} users"
+    chunks = chunked(user_ids, chunk_size or get_chunk_size())
+    chord(
+        send_notification_summary_chunk.s(chunk, since.isoformat()) for chunk in chunks
+    )(combine_notification_summaries.s())
+    return f"Queued summary emails for {len(user_ids)} users in {len(chunks)} chunks"
+
+
+@shared_task
+def send_notification_summary_chunk(user_ids, since):
+    """
+    Send the daily summaries of one chunk of users
+    """
+    return send_summaries(user_ids, parse_datetime(since))
+
+
+@shared_task
+def combine_notification_summaries(results):
+    """
+    Total the results of the summary chunks
+    """
+    totals = combine_results(results)
+    logger.info("Daily summaries: %s", totals)
+    return (
+        f"Sent summary emails to {totals['sent']} users "
+        f"({totals['skipped']} opted out, {totals['failed']} failed)"
+    )
+
+@shared_task
+def plan_lesson_reminders_task():
+    """
+    Schedule the lesson reminders due within the planning horizon as ETA tasks
+    """
+    count = plan_reminders()
+    return f"Scheduled {count} lesson reminders"
+
+
+@shared_task(bind=True)
+def send_scheduled_reminder(self):
+    """
+    Send one lesson reminder at its exact time, unless it was revoked
+    """
+    sent = send_reminder(self.request.id)
+    return f"Reminder {self.request.id} {'sent' if sent else 'skipped'}"
+
+
+@shared_task
+def reconcile_unread_counts_task():
+    """
+    Repair unread notification counters that drifted from the table
+    """
+    fixed = reconcile_unread_counts()
+    return f"Reconciled {fixed} unread counters"
+
 
 @shared_task
-def send_lesson_reminders_task():
-    send_lesson_reminders()
-
-def send_lesson_reminders():
-    from django.utils import timezone
-    import pytz
-    local_tz = pytz.timezone('Africa/Harare')
-    now = timezone.now().astimezone(local_tz)
-    print(f"[DEBUG] send_lesson_reminders running at {now}")
-    from datetime import time
-    for minutes in [30, 10]:
-        target_time = now + timezone.timedelta(minutes=minutes)
-        target_day = target_time.weekday()
-        target_time_only = time(target_time.hour, target_time.minute)
-        print(f"[DEBUG] Checking reminders for day={target_day}, time={target_time_only}")
-        lessons = Lesson.objects.filter(
-            day=target_day,
-            start_time=target_time_only,
-            is_recurring=True
-        )
-        print(f"[DEBUG] Found lessons: {list(lessons)}")
-        for lesson in lessons:
-            user = getattr(lesson, 'user', None) or getattr(lesson, 'teacher', None)
-            print(f"[DEBUG] Processing lesson {lesson.id}, user: {user}")
-            if not user:
-                print(f"[DEBUG] Lesson {lesson.id} has no user/teacher field!")
-                continue
-            # Avoid duplicate notifications for the same lesson/time
-            if Notification.objects.filter(user=user, lesson_id=lesson.id, message__icontains=f"{minutes} minutes").exists():
-                print(f"[DEBUG] Duplicate notification for lesson {lesson.id}, user {user}")
-                continue
-            # Create notification
-            Notification.objects.create(
-                user=user,
-                lesson=lesson,
-                message=f"Your lesson '{lesson.title}', starts in {minutes} minutes.",
-                type='urgent' if minutes == 10 else 'info',
-            )
-            print(f"[DEBUG] Notification created for lesson {lesson.title} to {user.email}")
-            # Send email
-            send_mail(
-                subject="Lesson Reminder",
-                message=f"Reminder: Your lesson '{lesson.title}' starts in {minutes} minutes.",
-                from_email=getattr(settings, 'DEFAULT_FROM_EMAIL', 'noreply@yourapp.com'),
-                recipient_list=[user.email],
-            )
-            print(f"[DEBUG] Email sent for lesson {lesson.title} to {user.email}")
\ No newline at end of file
+def create_notifications_task(rows):
+    """
+    Write notifications buffered by a committed transaction
+    """
+    created = create_notifications(existing([from_row(row) for row in rows]))
+    return f"Created {len(created)} notifications"
+
+
+@shared_task
+def drain_email_outbox():
+    """
+    Send the emails waiting in the outbox, retrying failures with backoff
+    """
+    totals = drain_outbox()
+    return (
+        f"Sent {totals['sent']} emails "
+        f"({totals['retried']} to retry, {totals['dead']} dead-lettered)"
+    )
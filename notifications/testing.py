@@ -0,0 +1,141 @@
+"""
+Local SMTP stand-in for tests and benchmarks.
+
+Speaks just enough plain SMTP (no TLS, no auth) for Django's SMTP email
+backend, records what it receives and can add latency per message, overall or
+for given recipients.
+"""
+import select
+import socket
+import socketserver
+import threading
+import time
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def client_left(self, delay):
+        """Wait delay seconds; return True if the client disconnected meanwhile"""
+        deadline = time.monotonic() + delay
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            readable, _, _ = select.select([self.connection], [], [], remaining)
+            if readable and not self.connection.recv(1, socket.MSG_PEEK):
+                return True
+            if readable:
+                # Pipelined input; keep waiting without busy-looping
+                time.sleep(min(remaining, 0.01))
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+            server.sockets.add(self.connection)
+        try:
+            self.reply("220 localhost ESMTP stand-in")
+            recipients = []
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    break
+                command = line.decode(errors='replace').strip()
+                verb = command.split(' ', 1)[0].upper()
+                if verb == 'EHLO':
+                    self.wfile.write(b"250-localhost\r\n250 8BITMIME\r\n")
+                elif verb in ('HELO', 'NOOP', 'RSET'):
+                    recipients = []
+                    self.reply("250 OK")
+                elif verb == 'MAIL':
+                    recipients = []
+                    self.reply("250 OK")
+                elif verb == 'RCPT':
+                    address = command.split(':', 1)[1].strip().strip('<>')
+                    if address in server.refused:
+                        self.reply("550 No such user")
+                    else:
+                        recipients.append(address)
+                        self.reply("250 OK")
+                elif verb == 'DATA':
+                    self.reply("354 End data with <CR><LF>.<CR><LF>")
+                    data = []
+                    while True:
+                        chunk = self.rfile.readline()
+                        if not chunk or chunk == b".\r\n":
+                            break
+                        data.append(chunk)
+                    delay = max([server.delays.get(address, 0) for address in recipients] + [server.latency])
+                    if delay and self.client_left(delay):
+                        # Like a real server, drop a message whose sender hung
+                        # up before it was acknowledged
+                        break
+                    with server.lock:
+                        server.messages.append((recipients, b"".join(data)))
+                    self.reply("250 OK queued")
+                elif verb == 'QUIT':
+                    self.reply("221 Bye")
+                    break
+                else:
+                    self.reply("502 Command not implemented")
+        except OSError:
+            pass
+        finally:
+            with server.lock:
+                server.sockets.discard(self.connection)
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    """Threaded SMTP server on localhost, usable as a context manager"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency=0.0, refused=(), delays=None):
+        super().__init__(('127.0.0.1', 0), _SMTPHandler)
+        self.latency = latency
+        self.refused = set(refused)
+        # Extra latency for messages to particular recipients
+        self.delays = dict(delays or {})
+        self.messages = []
+        self.connections = 0
+        self.sockets = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def backend_kwargs(self):
+        """Keyword arguments for an SMTP EmailBackend pointed at this server"""
+        return {
+            'backend': 'django.core.mail.backends.smtp.EmailBackend',
+            'host': '127.0.0.1',
+            'port': self.port,
+            'username': '',
+            'password': '',
+            'use_tls': False,
+            'use_ssl': False,
+        }
+
+    def drop_connections(self):
+        """Close every open client connection, as an idle timeout would"""
+        with self.lock:
+            sockets = list(self.sockets)
+        for sock in sockets:
+            try:
+                sock.shutdown(2)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
@@ -1,11 +1,38 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import json
+import os
+import smtplib
+import tempfile
+from types import SimpleNamespace
+from unittest import mock
+
+from django.db import connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from rest_framework.test import APIClient
 from rest_framework import status
 from django.contrib.auth import get_user_model
-from .models import Notification
-from timetable_app.models import Lesson
-from datetime import time
+from django.core import mail
+from django.utils import timezone
+from .delivery import AsyncMailDelivery, MailDelivery, build_message, create_delivery, deliver
+from .counters import reconcile_unread_counts
+from .models import EmailOutbox, Notification, ScheduledReminder, UnreadCounter
+from .outbox import claim_batch, drain_outbox, enqueue_emails, outbox_stats, send_batch
+from .retention import purge_notifications
+from .summaries import combine_results, send_summaries
+from .scheduling import plan_reminders, send_reminder, sync_reminders
+from .tasks import send_notification_summary, send_scheduled_reminder
+from timetable_project.celery import app as celery_app
+from timetable_project.queue_metrics import queue_wait, queue_wait_stats, record_wait, reset_queue_wait_stats
+from .services import create_notifications
+from .stream import NotificationHub, make_stream_ticket, read_stream_ticket
+from rest_framework_simplejwt.tokens import AccessToken
+from .testing import FakeSMTPServer
+from timetable_app.models import Lesson, LessonException
+from timetable_app.tasks import send_email_notifications
+from datetime import datetime, date, time, timedelta
 
 User = get_user_model()
 
@@ -106,4 +133,967 @@ class NotificationTests(TestCase):
         response = self.client.get(url, format='json')
         
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(response.data['unread_count'], 1)
\ No newline at end of file
+        self.assertEqual(response.data['unread_count'], 1)
+        
+    def test_unread_count_conditional_get(self):
+        """Test unread_count answers 304 until a notification is read"""
+        url = reverse('notification-unread-count')
+        etag = self.client.get(url)['ETag']
+        
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        
+        self.client.patch(reverse('notification-mark-read', args=[self.notification1.id]))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+    
+    def test_list_conditional_get_does_not_count_history(self):
+        """Test revalidating the list reads index bounds and the counter instead of counting rows"""
+        url = reverse('notification-list')
+        etag = self.client.get(url)['ETag']
+        
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(len(queries), 2)
+        self.assertFalse(any('COUNT(' in query['sql'] for query in queries))
+        
+        self.client.patch(reverse('notification-mark-read', args=[self.notification1.id]))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+        
+        Notification.objects.create(user=self.user, message='Room changed', type='info', read=True)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_200_OK)
+
+    
+    def test_cursor_pagination_with_identical_times(self):
+        """Test paging by cursor neither skips nor repeats rows that share a timestamp"""
+        for index in range(5):
+            Notification.objects.create(user=self.user, message=f'Bulk {index}', type='info')
+        Notification.objects.filter(user=self.user).update(time=timezone.now())
+        expected = list(
+            Notification.objects.filter(user=self.user).order_by('-id').values_list('id', flat=True)
+        )
+        
+        url = reverse('notification-list')
+        response = self.client.get(url, {'page_size': 2, 'count': 'true'})
+        self.assertEqual(response.data['count'], len(expected))
+        seen = [notification['id'] for notification in response.data['results']]
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            self.assertNotIn('count', response.data)
+            seen.extend(notification['id'] for notification in response.data['results'])
+        self.assertEqual(seen, expected)
+
+
+class UnreadCounterTests(TestCase):
+    """Test suite for the counter-cached unread count"""
+    
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='teacher1',
+            email='teacher@example.com',
+            password='StrongPass123!'
+        )
+        self.client.force_authenticate(user=self.user)
+        self.url = reverse('notification-unread-count')
+    
+    def counter(self):
+        return UnreadCounter.objects.get(user=self.user).count
+    
+    def test_concurrent_mark_read_discounts_once(self):
+        """Test two requests marking the same notification read from stale rows discount it once"""
+        notification = Notification.objects.create(user=self.user, message='One', type='info')
+        stale = [Notification.objects.get(pk=notification.pk) for _ in range(2)]
+        url = reverse('notification-mark-read', args=[notification.pk])
+        with mock.patch('notifications.views.NotificationViewSet.get_object', side_effect=stale):
+            self.client.patch(url)
+            self.client.patch(url)
+        self.assertEqual(self.counter(), 0)
+    
+    def test_counter_follows_writes(self):
+        """Test creating, reading and marking all read keep the counter exact"""
+        first = Notification.objects.create(user=self.user, message='One', type='info')
+        Notification.objects.create(user=self.user, message='Two', type='info')
+        self.assertEqual(self.counter(), 2)
+        
+        first.read = True
+        first.save()
+        first.save()
+        self.assertEqual(self.counter(), 1)
+        
+        self.client.post(reverse('notification-mark-all-read'))
+        self.assertEqual(self.counter(), 0)
+    
+    def test_unread_count_is_a_single_lookup(self):
+        """Test the endpoint reads the counter instead of counting rows"""
+        Notification.objects.create(user=self.user, message='One', type='info')
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url)
+        self.assertEqual(response.data['unread_count'], 1)
+    
+    def test_lesson_delete_discounts_cascaded_notifications(self):
+        """Test unread notifications removed with their lesson leave the counter"""
+        lesson = Lesson.objects.create(
+            title='Math Class',
+            subject='Mathematics',
+            teacher=self.user,
+            day=0,
+            start_time=time(9, 0),
+            end_time=time(10, 0),
+            location='Room 101'
+        )
+        Notification.objects.create(user=self.user, lesson=lesson, message='Reminder', type='info')
+        lesson.delete()
+        self.assertEqual(self.counter(), Notification.objects.filter(user=self.user, read=False).count())
+    
+    def test_reconcile_fixes_drift(self):
+        """Test reconciliation repairs counters changed behind their back"""
+        Notification.objects.create(user=self.user, message='One', type='info')
+        Notification.objects.filter(user=self.user).update(read=True)
+        self.assertEqual(self.counter(), 1)
+        
+        self.assertEqual(reconcile_unread_counts(), 1)
+        self.assertEqual(self.counter(), 0)
+        self.assertEqual(reconcile_unread_counts(), 0)
+
+
+class CreateNotificationsTests(TestCase):
+    """Test suite for bulk notification writes with dedup keys"""
+    
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='teacher1',
+            email='teacher@example.com',
+            password='StrongPass123!'
+        )
+        self.lesson = Lesson.objects.create(
+            title='Math', subject='Mathematics', teacher=self.user, day=0,
+            start_time=time(9, 0), end_time=time(10, 0)
+        )
+        self.day = date(2030, 1, 7)
+    
+    def reminder(self, offset, message='Reminder'):
+        return Notification(
+            user=self.user, lesson=self.lesson, message=message, type='info',
+            kind='lesson_reminder', occurrence_date=self.day, offset_minutes=offset
+        )
+    
+    def test_duplicate_keys_are_skipped(self):
+        """Test only the rows actually written are returned, counted and given ids"""
+        now = timezone.now()
+        # Same key and same timestamp as an existing row: still skipped
+        with mock.patch('django.utils.timezone.now', return_value=now):
+            create_notifications([self.reminder(30, 'First')])
+            unread = UnreadCounter.objects.get(user=self.user).count
+            created = create_notifications([
+                self.reminder(30, 'Again'),
+                self.reminder(15),
+                self.reminder(15, 'Twice in one call'),
+                Notification(user=self.user, message='Plain', type='info'),
+            ])
+        
+        self.assertEqual([n.message for n in created], ['Plain', 'Reminder'])
+        for notification in created:
+            self.assertEqual(Notification.objects.get(pk=notification.pk).message, notification.message)
+        self.assertEqual(UnreadCounter.objects.get(user=self.user).count, unread + 2)
+        self.assertEqual(
+            Notification.objects.get(kind='lesson_reminder', offset_minutes=30).message, 'First'
+        )
+
+
+class NotificationStreamTests(TestCase):
+    """Test suite for the server-sent notification stream"""
+    
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='teacher1',
+            email='teacher@example.com',
+            password='StrongPass123!'
+        )
+        self.url = reverse('notification-stream')
+    
+    def test_stream_disabled_without_redis(self):
+        """Test the stream answers 503 so clients fall back to polling"""
+        response = self.client.get(self.url, {'ticket': make_stream_ticket(self.user.pk)})
+        self.assertEqual(response.status_code, 503)
+        api = APIClient()
+        api.force_authenticate(user=self.user)
+        self.assertEqual(api.post(reverse('notification-stream-ticket')).status_code, 503)
+    
+    @override_settings(NOTIFICATION_STREAM_REDIS_URL='redis://localhost:6379/15')
+    def test_stream_requires_valid_ticket(self):
+        """Test a missing, forged or access-token ticket is rejected before streaming"""
+        self.assertEqual(self.client.get(self.url).status_code, 401)
+        self.assertEqual(self.client.get(self.url, {'ticket': 'forged'}).status_code, 401)
+        # Access tokens no longer go in the URL
+        token = str(AccessToken.for_user(self.user))
+        self.assertEqual(self.client.get(self.url, {'ticket': token}).status_code, 401)
+        self.assertEqual(self.client.get(self.url, {'token': token}).status_code, 401)
+    
+    @override_settings(NOTIFICATION_STREAM_REDIS_URL='redis://localhost:6379/15')
+    def test_stream_ticket_is_short_lived(self):
+        """Test an issued ticket opens streams only until it expires"""
+        api = APIClient()
+        api.force_authenticate(user=self.user)
+        ticket = api.post(reverse('notification-stream-ticket')).data['ticket']
+        self.assertEqual(read_stream_ticket(ticket), self.user.pk)
+        with override_settings(NOTIFICATION_STREAM_TICKET_MAX_AGE=-1):
+            self.assertIsNone(read_stream_ticket(ticket))
+    
+    @override_settings(NOTIFICATION_STREAM_REDIS_URL='redis://localhost:6379/15')
+    def test_stream_rejects_inactive_user(self):
+        """Test a deactivated or deleted user cannot open a stream with a valid credential"""
+        ticket = make_stream_ticket(self.user.pk)
+        token = str(AccessToken.for_user(self.user))
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        self.assertEqual(self.client.get(self.url, {'ticket': ticket}).status_code, 401)
+        self.assertEqual(
+            self.client.get(self.url, HTTP_AUTHORIZATION=f'Bearer {token}').status_code, 401
+        )
+        self.user.delete()
+        self.assertEqual(self.client.get(self.url, {'ticket': ticket}).status_code, 401)
+    
+    @override_settings(NOTIFICATION_STREAM_REDIS_URL='redis://localhost:6379/15')
+    def test_events_published_after_commit(self):
+        """Test new notifications and the unread count are published once committed"""
+        with mock.patch('notifications.stream.publish') as publish:
+            with self.captureOnCommitCallbacks(execute=False) as callbacks:
+                created = create_notifications([
+                    Notification(user=self.user, message='Hello', type='info')
+                ])
+            publish.assert_not_called()
+            for callback in callbacks:
+                callback()
+        
+        events = [message for call in publish.call_args_list for message in call.args[0]]
+        self.assertIn((self.user.pk, 'unread_count', {'unread_count': 1}), events)
+        notification_events = [data for _, event, data in events if event == 'notification']
+        self.assertEqual([data['id'] for data in notification_events], [created[0].pk])
+    
+    def test_hub_fans_out_to_user_streams(self):
+        """Test a published message reaches every open stream of its user only"""
+        async def run():
+            hub = NotificationHub('redis://localhost:6379/15')
+            mine, other = asyncio.Queue(), asyncio.Queue()
+            hub.listeners = {self.user.pk: {mine}, self.user.pk + 1: {other}}
+            hub.dispatch({
+                'channel': f'notifications:user:{self.user.pk}'.encode(),
+                'data': json.dumps({'event': 'unread_count', 'data': {'unread_count': 3}}),
+            })
+            return mine.get_nowait(), other.empty()
+        
+        event, other_empty = asyncio.run(run())
+        self.assertEqual(event, ('unread_count', {'unread_count': 3}))
+        self.assertTrue(other_empty)
+
+
+class MailDeliveryTests(TestCase):
+    """Test suite for pooled email delivery against a local SMTP stand-in"""
+    
+    def messages(self, count, recipient='teacher{}@example.com'):
+        return [build_message('Subject', 'Body', recipient.format(i)) for i in range(count)]
+    
+    def test_messages_share_one_connection(self):
+        """Test a batch of messages is sent over a single SMTP session"""
+        with FakeSMTPServer() as server:
+            delivery = MailDelivery(batch_size=2, **server.backend_kwargs())
+            failed = delivery.send(self.messages(5))
+            delivery.send(self.messages(2))
+            delivery.close()
+        
+        self.assertEqual(failed, [])
+        self.assertEqual(len(server.messages), 7)
+        self.assertEqual(server.connections, 1)
+    
+    def test_reconnects_after_server_disconnect(self):
+        """Test a connection dropped by the server is reopened transparently"""
+        with FakeSMTPServer() as server:
+            delivery = MailDelivery(**server.backend_kwargs())
+            delivery.send(self.messages(1))
+            server.drop_connections()
+            failed = delivery.send(self.messages(1))
+            delivery.close()
+        
+        self.assertEqual(failed, [])
+        self.assertEqual(len(server.messages), 2)
+        self.assertEqual(server.connections, 2)
+    
+    def test_refused_recipient_only_fails_its_message(self):
+        """Test a refused recipient does not abort the rest of the batch"""
+        with FakeSMTPServer(refused=['teacher1@example.com']) as server:
+            delivery = MailDelivery(**server.backend_kwargs())
+            failed = delivery.send(self.messages(3))
+            delivery.close()
+        
+        self.assertEqual([message.to for message, _ in failed], [['teacher1@example.com']])
+        self.assertEqual(len(server.messages), 2)
+        self.assertEqual(server.connections, 1)
+
+
+
+class AsyncMailDeliveryTests(TestCase):
+    """Test suite for concurrent email delivery against a local SMTP stand-in"""
+    
+    def messages(self, count, recipient='teacher{}@example.com'):
+        return [build_message('Subject', 'Body', recipient.format(i)) for i in range(count)]
+    
+    def test_sends_concurrently_within_bound(self):
+        """Test messages are sent over at most concurrency connections at once"""
+        with FakeSMTPServer(latency=0.2) as server:
+            delivery = AsyncMailDelivery(concurrency=4, **server.backend_kwargs())
+            started = timezone.now()
+            failed = delivery.send(self.messages(8))
+            elapsed = (timezone.now() - started).total_seconds()
+            delivery.send(self.messages(4))
+            delivery.close()
+        
+        self.assertEqual(failed, [])
+        self.assertEqual(len(server.messages), 12)
+        # Two rounds of four rather than eight messages in a row
+        self.assertLess(elapsed, 8 * 0.2 * 0.75)
+        # Connections are reused by the next call
+        self.assertEqual(server.connections, 4)
+        self.assertEqual(delivery.connections_opened, 4)
+    
+    def test_refused_recipient_only_fails_its_message(self):
+        """Test a refused recipient does not fail the other messages"""
+        with FakeSMTPServer(refused=['teacher1@example.com']) as server:
+            delivery = AsyncMailDelivery(concurrency=2, **server.backend_kwargs())
+            failed = delivery.send(self.messages(3))
+            delivery.close()
+        
+        self.assertEqual([message.to for message, _ in failed], [['teacher1@example.com']])
+        self.assertEqual(len(server.messages), 2)
+    
+    def test_slow_message_times_out(self):
+        """Test a message the server does not accept in time is reported as failed"""
+        with FakeSMTPServer(latency=1.0) as server:
+            delivery = AsyncMailDelivery(concurrency=2, timeout=0.2, **server.backend_kwargs())
+            started = timezone.now()
+            failed = delivery.send(self.messages(2))
+            elapsed = (timezone.now() - started).total_seconds()
+            delivery.close()
+        
+        self.assertEqual(len(failed), 2)
+        self.assertTrue(all(isinstance(exc, TimeoutError) for _, exc in failed))
+        self.assertLess(elapsed, 1.0)
+        self.assertEqual(delivery.idle, [])
+    
+    def test_slow_message_does_not_fail_fast_ones(self):
+        """Test waiting for a busy slot does not count against a message's timeout"""
+        slow = {'teacher0@example.com': 1.5, 'teacher1@example.com': 1.5}
+        with FakeSMTPServer(delays=slow) as server:
+            delivery = AsyncMailDelivery(concurrency=2, timeout=0.5, **server.backend_kwargs())
+            started = timezone.now()
+            failed = delivery.send(self.messages(6))
+            elapsed = (timezone.now() - started).total_seconds()
+            delivery.close()
+        
+        self.assertEqual(sorted(message.to[0] for message, _ in failed), sorted(slow))
+        self.assertTrue(all(isinstance(exc, TimeoutError) for _, exc in failed))
+        # Only the fast messages arrived, so a retry cannot send any twice
+        self.assertEqual(len(server.messages), 4)
+        self.assertLess(elapsed, 1.5)
+    
+    @override_settings(EMAIL_DELIVERY_BACKEND='async', EMAIL_CONCURRENCY=3)
+    def test_setting_selects_async_backend(self):
+        """Test EMAIL_DELIVERY_BACKEND switches deliver() to the concurrent backend"""
+        delivery = create_delivery()
+        self.assertIsInstance(delivery, AsyncMailDelivery)
+        self.assertEqual(delivery.concurrency, 3)
+        
+        self.assertEqual(delivery.send(self.messages(3)), [])
+        self.assertEqual(len(mail.outbox), 3)
+
+
+class RetentionTests(TestCase):
+    """Test suite for the chunked notification retention job"""
+    
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='teacher1',
+            email='teacher@example.com',
+            password='StrongPass123!'
+        )
+        Notification.objects.bulk_create([
+            Notification(user=self.user, message=f"Old {i}", read=True) for i in range(5)
+        ] + [
+            Notification(user=self.user, message="Old unread"),
+            Notification(user=self.user, message="Recent", read=True),
+        ])
+        Notification.objects.exclude(message='Recent').update(time=timezone.now() - timedelta(days=40))
+        self.before = timezone.now() - timedelta(days=30)
+    
+    def test_purges_old_read_notifications_in_batches(self):
+        """Test only old read rows go, two at a time"""
+        stats = purge_notifications(self.before, batch_size=2, pause=0)
+        
+        self.assertEqual(stats.deleted, 5)
+        self.assertEqual(stats.batches, 3)
+        self.assertIsNone(stats.archive)
+        self.assertEqual(
+            sorted(Notification.objects.values_list('message', flat=True)),
+            ['Old unread', 'Recent']
+        )
+    
+    def test_archives_rows_before_purging(self):
+        """Test purged rows are written to a gzipped NDJSON archive"""
+        with tempfile.TemporaryDirectory() as archive_dir:
+            stats = purge_notifications(self.before, batch_size=2, archive_dir=archive_dir, pause=0)
+            self.assertEqual(os.path.dirname(stats.archive), archive_dir)
+            with gzip.open(stats.archive, 'rt') as archive:
+                rows = [json.loads(line) for line in archive]
+        
+        self.assertEqual([row['message'] for row in rows], [f"Old {i}" for i in range(5)])
+        self.assertTrue(all(row['read'] and row['user_id'] == self.user.pk for row in rows))
+    
+    def test_nothing_to_purge(self):
+        """Test an empty run creates no archive and reports zero throughput"""
+        with tempfile.TemporaryDirectory() as archive_dir:
+            stats = purge_notifications(timezone.now() - timedelta(days=60), archive_dir=archive_dir)
+            self.assertEqual(os.listdir(archive_dir), [])
+        self.assertEqual(stats.as_dict()['deleted'], 0)
+        self.assertEqual(stats.rows_per_second, 0.0)
+
+
+
+class SignalNotificationBufferTests(TestCase):
+    """Test suite for notifications raised by lesson signals and written on commit"""
+    
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='teacher1',
+            email='teacher@example.com',
+            password='StrongPass123!'
+        )
+    
+    def create_lesson(self, title, hour=9):
+        return Lesson.objects.create(
+            title=title,
+            subject='Mathematics',
+            teacher=self.user,
+            day=0,
+            start_time=time(hour, 0),
+            end_time=time(hour, 45),
+            location='Room 101'
+        )
+    
+    def messages(self):
+        return sorted(Notification.objects.filter(user=self.user).values_list('message', flat=True))
+    
+    def test_written_once_on_commit(self):
+        """Test a transaction's notifications wait for the commit and share one insert"""
+        with self.captureOnCommitCallbacks() as callbacks:
+            for hour in (8, 9, 10):
+                self.create_lesson(f'Class {hour}', hour)
+            self.assertEqual(self.messages(), [])
+        
+        with CaptureQueriesContext(connection) as queries:
+            for callback in callbacks:
+                callback()
+        inserts = [query for query in queries if query['sql'].startswith('INSERT INTO "notifications_notification"')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(len(self.messages()), 3)
+    
+    def test_rolled_back_savepoint_discards_notifications(self):
+        """Test notifications raised inside a savepoint that rolls back are never written"""
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_lesson('Kept', 8)
+            try:
+                with transaction.atomic():
+                    self.create_lesson('Rolled back', 9)
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+        self.assertEqual(self.messages(), ["New lesson 'Kept' has been created."])
+    
+    def test_lesson_deleted_before_commit(self):
+        """Test a lesson created and deleted in one transaction only reports the delete"""
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_lesson('Short lived').delete()
+        self.assertEqual(self.messages(), ["Lesson 'Short lived' has been deleted."])
+    
+    def test_teacher_delete_is_silent(self):
+        """Test deleting a teacher does not raise a notification per cascaded lesson"""
+        with self.captureOnCommitCallbacks(execute=True):
+            for hour in (8, 9, 10):
+                self.create_lesson(f'Class {hour}', hour)
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.delete()
+        self.assertFalse(Notification.objects.exists())
+        self.assertFalse(Lesson.objects.exists())
+    
+    def test_teacher_delete_discounts_in_one_query(self):
+        """Test a teacher's cascading delete discounts unread notifications without a query per lesson"""
+        other = User.objects.create_user(username='head', email='head@example.com', password='StrongPass123!')
+        with self.captureOnCommitCallbacks(execute=True):
+            lessons = [self.create_lesson(f'Class {hour}', hour) for hour in range(8, 14)]
+        Notification.objects.create(user=other, lesson=lessons[0], message='Watch this one', type='info')
+        
+        with CaptureQueriesContext(connection) as queries:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.user.delete()
+        counts = [query for query in queries if 'COUNT(' in query['sql'] and 'notifications_notification' in query['sql']]
+        self.assertEqual(len(counts), 1)
+        self.assertEqual(UnreadCounter.objects.get(user=other).count, 0)
+
+
+
+class NotificationSummaryTests(TestCase):
+    """Test suite for the chunked daily summary emails"""
+    
+    def setUp(self):
+        self.users = [
+            User.objects.create_user(
+                username=f'teacher{index}',
+                email=f'teacher{index}@example.com',
+                password='StrongPass123!'
+            )
+            for index in range(3)
+        ]
+        self.users[2].notification_preferences = {'disable_summary_emails': True}
+        self.users[2].save()
+        Notification.objects.bulk_create([
+            Notification(user=self.users[0], message='Lesson moved', type='info'),
+            Notification(user=self.users[0], message='Room changed', type='warning'),
+            Notification(user=self.users[0], message='Lesson cancelled', type='urgent'),
+            Notification(user=self.users[1], message='New lesson', type='info'),
+            Notification(user=self.users[2], message='New lesson', type='info'),
+        ])
+        self.since = timezone.now() - timedelta(days=1)
+    
+    def test_chunk_is_two_queries(self):
+        """Test a chunk loads its users and notifications once and skips opted-out users"""
+        with self.assertNumQueries(2):
+            result = send_summaries([user.id for user in self.users], self.since)
+        
+        self.assertEqual(result, {'users': 3, 'sent': 2, 'skipped': 1, 'failed': 0})
+        self.assertEqual([message.to for message in mail.outbox], [['teacher0@example.com'], ['teacher1@example.com']])
+        body = mail.outbox[0].body
+        self.assertLess(body.index('URGENT NOTIFICATIONS:\n- Lesson cancelled'), body.index('WARNING'))
+        self.assertLess(body.index('WARNING NOTIFICATIONS:\n- Room changed'), body.index('INFORMATION'))
+        self.assertNotIn('URGENT', mail.outbox[1].body)
+    
+    def test_fan_out_totals_chunks(self):
+        """Test the summary is split into chunk tasks whose results are totalled"""
+        celery_app.conf.task_always_eager = True
+        self.addCleanup(setattr, celery_app.conf, 'task_always_eager', False)
+        with mock.patch('notifications.tasks.combine_results', wraps=combine_results) as combine:
+            result = send_notification_summary(chunk_size=2)
+        
+        self.assertEqual(result, "Queued summary emails for 3 users in 2 chunks")
+        self.assertEqual(combine.call_count, 1)
+        self.assertEqual(len(combine.call_args.args[0]), 2)
+        self.assertEqual(len(mail.outbox), 2)
+
+
+
+class TaskQueueTests(TestCase):
+    """Test suite for task routing and queue wait metrics"""
+    
+    def setUp(self):
+        reset_queue_wait_stats()
+    
+    def route(self, name):
+        return celery_app.amqp.router.route({}, name)['queue'].name
+    
+    def test_routes(self):
+        """Test reminders, bulk email and maintenance tasks get their own queues"""
+        self.assertEqual(self.route('notifications.tasks.send_scheduled_reminder'), 'reminders')
+        self.assertEqual(self.route('notifications.tasks.send_notification_summary_chunk'), 'email')
+        self.assertEqual(self.route('timetable_app.tasks.clean_old_notifications'), 'maintenance')
+        self.assertEqual(self.route('timetable_app.tasks.check_upcoming_lessons'), 'default')
+    
+    def test_queue_wait_counts_from_eta(self):
+        """Test the wait is measured from publishing, or from the ETA of a delayed task"""
+        request = SimpleNamespace(published_at=100.0, eta=None)
+        self.assertEqual(queue_wait(request, now=102.5), 2.5)
+        
+        eta = datetime.fromtimestamp(200.0).astimezone().isoformat()
+        request = SimpleNamespace(published_at=100.0, eta=eta)
+        self.assertEqual(queue_wait(request, now=200.25), 0.25)
+        self.assertIsNone(queue_wait(SimpleNamespace(), now=1.0))
+    
+    def test_stats_per_queue(self):
+        """Test waits are aggregated per queue with bucketed percentiles"""
+        for seconds in [0.05] * 98 + [2, 45]:
+            record_wait('reminders', seconds)
+        record_wait('email', 400)
+        record_wait('unrouted', 0.2)
+        
+        stats = queue_wait_stats()
+        self.assertEqual(stats['reminders']['count'], 100)
+        self.assertEqual(stats['reminders']['p95'], 0.1)
+        self.assertEqual(stats['reminders']['p99'], 5)
+        self.assertEqual(stats['reminders']['max'], 60)
+        self.assertIsNone(stats['email']['p95'])
+        self.assertEqual(set(stats), {'reminders', 'email', 'other'})
+    
+    def test_record_is_two_increments(self):
+        """Test recording a wait costs two cache increments and no reads"""
+        with mock.patch('timetable_project.queue_metrics.cache') as fake_cache:
+            record_wait('email', 0.3)
+        self.assertEqual(fake_cache.incr.call_count, 2)
+        self.assertFalse(fake_cache.get.called or fake_cache.set.called)
+
+
+
+class ScheduledReminderTests(TestCase):
+    """Test suite for exact-time reminders sent as ETA tasks"""
+    
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='teacher1',
+            email='teacher@example.com',
+            password='StrongPass123!'
+        )
+        self.lesson = Lesson.objects.create(
+            title='Math Class',
+            subject='Mathematics',
+            teacher=self.user,
+            day=0,
+            start_time=time(9, 0),
+            end_time=time(10, 0),
+            location='Room 101'
+        )
+        Notification.objects.all().delete()
+        self.monday = date(2024, 1, 1)
+        # The clock stands at 07:00 on Monday
+        now = mock.patch('django.utils.timezone.now', return_value=self.at(0, 7, 0))
+        now.start()
+        self.addCleanup(now.stop)
+        apply_async = mock.patch.object(send_scheduled_reminder, 'apply_async')
+        self.apply_async = apply_async.start()
+        self.addCleanup(apply_async.stop)
+        revoke = mock.patch.object(celery_app.control, 'revoke')
+        self.revoke = revoke.start()
+        self.addCleanup(revoke.stop)
+    
+    def at(self, day, hour, minute):
+        return timezone.make_aware(datetime.combine(self.monday + timedelta(days=day), time(hour, minute)))
+    
+    def plan(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            return plan_reminders()
+    
+    def fire_times(self):
+        return sorted(ScheduledReminder.objects.values_list('fire_at', flat=True))
+    
+    def test_plan_schedules_eta_tasks(self):
+        """Test reminders in the horizon are sent as tasks due at the reminder time"""
+        self.assertEqual(self.plan(), 2)
+        self.assertEqual(self.fire_times(), [self.at(0, 8, 30), self.at(0, 8, 50)])
+        etas = sorted(call.kwargs['eta'] for call in self.apply_async.call_args_list)
+        self.assertEqual(etas, self.fire_times())
+        task_ids = {call.kwargs['task_id'] for call in self.apply_async.call_args_list}
+        self.assertEqual(task_ids, set(ScheduledReminder.objects.values_list('task_id', flat=True)))
+        
+        # The planned range is not planned again
+        self.assertEqual(self.plan(), 0)
+    
+    def test_plan_wraps_around_the_week(self):
+        """Test reminders for Monday morning lessons are planned on Sunday night"""
+        self.lesson.start_time = time(0, 10)
+        self.lesson.save()
+        with mock.patch('django.utils.timezone.now', return_value=self.at(6, 23, 0)):
+            self.assertEqual(self.plan(), 2)
+        
+        self.assertEqual(self.fire_times(), [self.at(6, 23, 40), self.at(7, 0, 0)])
+    
+    def test_reminder_sent_once(self):
+        """Test a task sends its reminder once and a revoked handle sends nothing"""
+        self.plan()
+        reminder = ScheduledReminder.objects.get(offset_minutes=30)
+        
+        self.assertTrue(send_reminder(reminder.task_id))
+        self.assertFalse(send_reminder(reminder.task_id))
+        self.assertFalse(send_reminder('revoked'))
+        self.assertIn('30 minutes', Notification.objects.get(lesson=self.lesson).message)
+        drain_outbox()
+        self.assertEqual(len(mail.outbox), 1)
+    
+    def test_edit_reschedules(self):
+        """Test moving a lesson revokes its reminders and schedules them at the new time"""
+        self.plan()
+        old_task_ids = set(ScheduledReminder.objects.values_list('task_id', flat=True))
+        
+        self.lesson.start_time = time(8, 45)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.lesson.save()
+        
+        self.assertEqual(self.fire_times(), [self.at(0, 8, 15), self.at(0, 8, 35)])
+        self.assertEqual(set(self.revoke.call_args.args[0]), old_task_ids)
+    
+    def test_cancellation_and_delete_revoke(self):
+        """Test cancelling an occurrence or deleting the lesson revokes its reminders"""
+        self.plan()
+        with self.captureOnCommitCallbacks(execute=True):
+            exception = LessonException.objects.create(
+                lesson=self.lesson, date=self.monday, exception_type='cancelled'
+            )
+        self.assertEqual(self.fire_times(), [])
+        self.assertEqual(len(self.revoke.call_args.args[0]), 2)
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            exception.delete()
+        self.assertEqual(len(self.fire_times()), 2)
+        task_ids = set(ScheduledReminder.objects.values_list('task_id', flat=True))
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            self.lesson.delete()
+        self.assertEqual(set(self.revoke.call_args.args[0]), task_ids)
+        self.assertFalse(ScheduledReminder.objects.exists())
+    
+    def test_teacher_delete_revokes_in_one_query(self):
+        """Test deleting a teacher revokes every lesson's reminders with one lookup"""
+        for hour in (11, 12, 13):
+            Lesson.objects.create(
+                title=f'Class {hour}', subject='Mathematics', teacher=self.user, day=0,
+                start_time=time(hour, 0), end_time=time(hour, 45)
+            )
+        with mock.patch('notifications.scheduling.get_horizon', return_value=timedelta(hours=8)):
+            self.plan()
+        task_ids = set(ScheduledReminder.objects.values_list('task_id', flat=True))
+        self.assertEqual(len(task_ids), 8)
+        
+        with CaptureQueriesContext(connection) as queries:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.user.delete()
+        lookups = [query for query in queries if query['sql'].startswith('SELECT "notifications_scheduledreminder"."task_id"')]
+        self.assertEqual(len(lookups), 1)
+        self.assertEqual(self.revoke.call_count, 1)
+        self.assertEqual(set(self.revoke.call_args.args[0]), task_ids)
+
+
+
+class EmailOutboxTests(TestCase):
+    """Test suite for the transactional email outbox"""
+    
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='teacher1',
+            email='teacher@example.com',
+            password='StrongPass123!'
+        )
+    
+    def queue(self, count):
+        with self.captureOnCommitCallbacks() as callbacks:
+            rows = enqueue_emails(
+                ('Subject', 'Body', f'teacher{index}@example.com') for index in range(count)
+            )
+        self.assertEqual(len(callbacks), 1)
+        return rows
+    
+    def test_rolled_back_write_sends_nothing(self):
+        """Test emails queued in a transaction that rolls back are never sent"""
+        try:
+            with transaction.atomic():
+                enqueue_emails([('Subject', 'Body', 'teacher@example.com')])
+                raise ValueError
+        except ValueError:
+            pass
+        
+        self.assertFalse(EmailOutbox.objects.exists())
+    
+    def test_drain_sends_in_batches(self):
+        """Test a drain claims and sends every due email batch by batch"""
+        self.queue(5)
+        with mock.patch('notifications.outbox.deliver', wraps=deliver) as send:
+            totals = drain_outbox(batch_size=2)
+        
+        self.assertEqual(totals, {'sent': 5, 'retried': 0, 'dead': 0})
+        self.assertEqual([len(call.args[0]) for call in send.call_args_list], [2, 2, 1])
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(EmailOutbox.objects.filter(status='sent', claim_token=None).count(), 5)
+        self.assertEqual(drain_outbox(), {'sent': 0, 'retried': 0, 'dead': 0})
+    
+    @override_settings(EMAIL_OUTBOX_MAX_ATTEMPTS=3, EMAIL_OUTBOX_RETRY_BASE=30)
+    def test_failures_back_off_then_dead_letter(self):
+        """Test a failing email is retried with doubling delays and then dead-lettered"""
+        row, = self.queue(1)
+        error = smtplib.SMTPServerDisconnected('Connection lost')
+        delays = []
+        with mock.patch('notifications.outbox.deliver', side_effect=lambda messages: [(messages[0], error)]):
+            for _ in range(3):
+                EmailOutbox.objects.filter(id=row.id).update(next_attempt_at=timezone.now())
+                before = timezone.now()
+                drain_outbox()
+                row.refresh_from_db()
+                delays.append(round((row.next_attempt_at - before).total_seconds() / 30))
+        
+        self.assertEqual(row.status, 'dead')
+        self.assertEqual(row.attempts, 3)
+        self.assertIn('SMTPServerDisconnected', row.last_error)
+        self.assertEqual(delays[:2], [1, 2])
+        self.assertEqual(len(mail.outbox), 0)
+    
+    def test_permanent_error_is_dead_lettered(self):
+        """Test a refused recipient is not retried"""
+        self.queue(1)
+        error = smtplib.SMTPRecipientsRefused({'teacher0@example.com': (550, b'No such user')})
+        with mock.patch('notifications.outbox.deliver', side_effect=lambda messages: [(messages[0], error)]):
+            totals = drain_outbox()
+        
+        self.assertEqual(totals, {'sent': 0, 'retried': 0, 'dead': 1})
+    
+    def test_expired_lease_is_reclaimed(self):
+        """Test rows held by a live claim are skipped and reclaimed once it expires"""
+        self.queue(2)
+        claimed = claim_batch(batch_size=1)
+        self.assertEqual(len(claimed), 1)
+        
+        self.assertEqual(drain_outbox(), {'sent': 1, 'retried': 0, 'dead': 0})
+        EmailOutbox.objects.filter(status='sending').update(leased_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(drain_outbox(), {'sent': 1, 'retried': 0, 'dead': 0})
+        # The first claim's late results no longer apply to the row
+        send_batch(claimed)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(EmailOutbox.objects.filter(status='sent').count(), 2)
+    
+    def test_drain_continues_after_losing_a_claim(self):
+        """Test a drain whose claim is taken by another drain moves on to the remaining rows"""
+        first, *_ = self.queue(3)
+        lease = timedelta(seconds=300)
+        
+        def competing_claim():
+            # Another drain claims the row between our SELECT and UPDATE
+            if not EmailOutbox.objects.filter(claim_token='other').exists():
+                EmailOutbox.objects.filter(id=first.id).update(
+                    status='sending', claim_token='other', leased_until=timezone.now() + lease
+                )
+            return lease
+        
+        with mock.patch('notifications.outbox.get_lease', side_effect=competing_claim):
+            totals = drain_outbox(batch_size=1)
+        
+        self.assertEqual(totals, {'sent': 2, 'retried': 0, 'dead': 0})
+        self.assertEqual(EmailOutbox.objects.get(id=first.id).claim_token, 'other')
+    
+    def test_email_notifications_are_queued_with_flag(self):
+        """Test notification emails are queued and flagged in one transaction"""
+        Notification.objects.bulk_create([
+            Notification(user=self.user, message='Lesson moved'),
+            Notification(user=self.user, message='Room changed'),
+        ])
+        
+        send_email_notifications()
+        
+        self.assertFalse(Notification.objects.filter(email_sent=False).exists())
+        self.assertEqual(len(mail.outbox), 0)
+        row = EmailOutbox.objects.get()
+        self.assertIn('- Room changed', row.body)
+        drain_outbox()
+        self.assertEqual(mail.outbox[0].to, ['teacher@example.com'])
+    
+    def test_stats(self):
+        """Test the queue depth and send rate"""
+        self.queue(3)
+        drain_outbox(batch_size=1, max_batches=1)
+        EmailOutbox.objects.filter(status='pending').update(next_attempt_at=timezone.now() - timedelta(seconds=60))
+        
+        stats = outbox_stats()
+        self.assertEqual(stats['pending'], 2)
+        self.assertEqual(stats['due'], 2)
+        self.assertEqual(stats['dead'], 0)
+        self.assertGreaterEqual(stats['oldest_due_age'], 60)
+        self.assertEqual(stats['rate_1m'], 1)
+
+
+
+class ReminderDigestTests(TestCase):
+    """Test suite for coalescing a teacher's reminders into digests"""
+    
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='teacher1',
+            email='teacher@example.com',
+            password='StrongPass123!',
+            first_name='Ada'
+        )
+        self.other = User.objects.create_user(
+            username='teacher2',
+            email='other@example.com',
+            password='StrongPass123!'
+        )
+        self.math = self.lesson('Math Class', self.user, time(9, 0))
+        self.physics = self.lesson('Physics', self.user, time(9, 15))
+        self.history = self.lesson('History', self.other, time(9, 0))
+        Notification.objects.all().delete()
+        self.monday = date(2024, 1, 1)
+    
+    def lesson(self, title, teacher, start_time):
+        return Lesson.objects.create(
+            title=title,
+            subject=title,
+            teacher=teacher,
+            day=0,
+            start_time=start_time,
+            end_time=time(start_time.hour + 1, start_time.minute),
+            location='Room 101'
+        )
+    
+    def at(self, day, hour, minute):
+        return timezone.make_aware(datetime.combine(self.monday + timedelta(days=day), time(hour, minute)))
+    
+    def schedule(self):
+        sync_reminders(
+            [self.math.id, self.physics.id, self.history.id],
+            until=self.at(0, 10, 0), now=self.at(0, 7, 0)
+        )
+    
+    def task_id(self, lesson, offset):
+        return ScheduledReminder.objects.get(lesson=lesson, offset_minutes=offset).task_id
+    
+    def test_back_to_back_lessons_share_digests(self):
+        """Test reminders due within the window go out as one digest per teacher"""
+        self.schedule()
+        physics_30 = self.task_id(self.physics, 30)
+        
+        self.assertTrue(send_reminder(self.task_id(self.math, 30)))
+        self.assertFalse(send_reminder(physics_30))
+        self.assertTrue(send_reminder(self.task_id(self.math, 10)))
+        
+        messages = list(Notification.objects.filter(user=self.user).order_by('id').values_list('message', 'type'))
+        self.assertEqual(messages, [
+            ("2 lessons start soon: 'Math Class' in 30 minutes, 'Physics' in 45 minutes.", 'info'),
+            ("2 lessons start soon: 'Math Class' in 10 minutes, 'Physics' in 25 minutes.", 'urgent'),
+        ])
+        self.assertFalse(ScheduledReminder.objects.filter(lesson__teacher=self.user).exists())
+        # The other teacher's reminders are untouched
+        self.assertEqual(ScheduledReminder.objects.filter(lesson=self.history).count(), 2)
+        
+        drain_outbox()
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(mail.outbox[0].subject, 'Lesson Reminder: 2 lessons starting soon')
+        self.assertIn('Hello Ada', mail.outbox[0].body)
+        self.assertIn('- 09:15 Physics (Room 101), in 45 minutes', mail.outbox[0].body)
+    
+    def test_already_sent_reminder_leaves_the_rest_of_its_digest(self):
+        """Test a reminder whose notification already exists does not swallow the reminders it claimed"""
+        self.schedule()
+        Notification.objects.create(
+            user=self.user, lesson=self.math, message='Sent before the lesson moved', type='info',
+            kind='lesson_reminder', occurrence_date=self.monday, offset_minutes=30
+        )
+        physics_30 = self.task_id(self.physics, 30)
+        
+        self.assertFalse(send_reminder(self.task_id(self.math, 30)))
+        self.assertFalse(ScheduledReminder.objects.filter(lesson=self.math, offset_minutes=30).exists())
+        self.assertTrue(send_reminder(physics_30))
+        self.assertTrue(Notification.objects.filter(lesson=self.physics, offset_minutes=30).exists())
+    
+    @override_settings(LESSON_REMINDER_DIGEST_WINDOW=0)
+    def test_zero_window_sends_each_reminder(self):
+        """Test a zero window keeps one reminder per email"""
+        self.schedule()
+        
+        self.assertTrue(send_reminder(self.task_id(self.math, 30)))
+        self.assertTrue(send_reminder(self.task_id(self.physics, 30)))
+        
+        drain_outbox()
+        self.assertEqual([message.subject for message in mail.outbox], ['Lesson Reminder', 'Lesson Reminder'])
+        self.assertEqual(mail.outbox[1].body, "Reminder: Your lesson 'Physics' starts in 30 minutes.")
@@ -1,11 +1,13 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import NotificationViewSet
+from .views import NotificationViewSet, notification_stream
 
 router = DefaultRouter()
 router.register(r'', NotificationViewSet, basename='notification')  # No double path
 
 urlpatterns = [
+    # Before the router, whose detail route would otherwise match 'stream/'
+    path('stream/', notification_stream, name='notification-stream'),
     path('', include(router.urls)),
 ]
 
@@ -1,13 +1,30 @@
+import asyncio
+
+import redis
+from asgiref.sync import sync_to_async
 from rest_framework import viewsets, permissions
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.tokens import AccessToken
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Max, Min
+from django.http import JsonResponse, StreamingHttpResponse
+from timetable_app.etags import conditional_response, make_etag
+from .counters import adjust_unread, get_unread_count
 from .models import Notification
+from .pagination import NotificationPagination
 from .serializers import NotificationSerializer
+from .stream import format_event, get_hub, get_stream_url, make_stream_ticket, read_stream_ticket
 
 class NotificationViewSet(viewsets.ReadOnlyModelViewSet):
     """ViewSet for notifications"""
     serializer_class = NotificationSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = NotificationPagination
 
     def get_queryset(self):
         user = self.request.user
@@ -23,19 +40,126 @@ class NotificationViewSet(viewsets.ReadOnlyModelViewSet):
 
         return queryset
 
+    def get_etag(self):
+        """
+        Build a validator from the newest and oldest notification times, read
+        off the (user, -time) index, and the unread counter, so revalidating
+        never counts the user's history. New notifications, reads and purges
+        of the oldest ones all change it.
+        """
+        bounds = Notification.objects.filter(user=self.request.user).order_by().aggregate(
+            newest=Max('time'),
+            oldest=Min('time'),
+        )
+        return make_etag(
+            'notifications',
+            self.request.user.pk,
+            bounds['newest'],
+            bounds['oldest'],
+            get_unread_count(self.request.user.pk),
+            self.request.get_full_path(),
+        )
+
+    def list(self, request, *args, **kwargs):
+        return conditional_response(
+            request,
+            self.get_etag(),
+            lambda: super(NotificationViewSet, self).list(request, *args, **kwargs),
+        )
+
     @action(detail=True, methods=['patch'])
     def mark_read(self, request, pk=None):
         notification = self.get_object()
-        notification.read = True
-        notification.save()
+        # Only the request that flips the row discounts it, however many
+        # mark it read at once
+        with transaction.atomic():
+            count = Notification.objects.filter(pk=notification.pk, user=request.user, read=False).update(read=True)
+            adjust_unread({request.user.pk: -count})
         return Response({'status': 'notification marked as read'})
 
     @action(detail=False, methods=['post'], url_path='mark-all-read')
     def mark_all_read(self, request):
-        count = Notification.objects.filter(user=request.user, read=False).update(read=True)
+        with transaction.atomic():
+            count = Notification.objects.filter(user=request.user, read=False).update(read=True)
+            adjust_unread({request.user.pk: -count})
         return Response({'status': 'notifications marked as read', 'count': count})
 
     @action(detail=False, methods=['get'], url_path='unread_count')
     def unread_count(self, request):
-        count = Notification.objects.filter(user=request.user, read=False).count()
-        return Response({'unread_count': count})
+        # One primary key lookup on the counter; the count is its own validator
+        count = get_unread_count(request.user.pk)
+        etag = make_etag('unread_count', request.user.pk, count)
+        return conditional_response(request, etag, lambda: Response({'unread_count': count}))
+
+    @action(detail=False, methods=['post'], url_path='stream-ticket')
+    def stream_ticket(self, request):
+        """Issue a short-lived ticket for opening the notification stream"""
+        if not get_stream_url():
+            return Response({'detail': 'Notification streaming is not enabled.'}, status=503)
+        return Response({'ticket': make_stream_ticket(request.user.pk)})
+
+
+def get_stream_user_id(request):
+    """
+    Return the id of the user opening a stream, from the stream ticket in
+    the ?ticket= parameter (EventSource cannot send headers) or the access
+    token in the Authorization header. The user is checked to still exist
+    and be active once, when the stream opens.
+    """
+    ticket = request.GET.get('ticket')
+    if ticket:
+        user_id = read_stream_ticket(ticket)
+    else:
+        header = request.headers.get('Authorization', '')
+        if not header.startswith('Bearer '):
+            return None
+        try:
+            user_id = AccessToken(header[len('Bearer '):])[jwt_settings.USER_ID_CLAIM]
+        except (TokenError, KeyError):
+            return None
+    if user_id is None or not get_user_model().objects.filter(pk=user_id, is_active=True).exists():
+        return None
+    return user_id
+
+
+async def event_stream(user_id):
+    """Yield Server-Sent Events for one user until the client disconnects"""
+    heartbeat = getattr(settings, 'NOTIFICATION_STREAM_HEARTBEAT', 15)
+    hub = get_hub()
+    try:
+        queue = await hub.subscribe(user_id)
+    except redis.RedisError:
+        yield format_event('error', {'detail': 'Notification stream unavailable.'})
+        return
+    try:
+        yield f"retry: {heartbeat * 1000}\n\n"
+        # Sent after subscribing, so no change can fall between the two
+        count = await sync_to_async(get_unread_count)(user_id)
+        yield format_event('unread_count', {'unread_count': count})
+        while True:
+            try:
+                event, data = await asyncio.wait_for(queue.get(), heartbeat)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            yield format_event(event, data)
+    finally:
+        await hub.unsubscribe(user_id, queue)
+
+
+async def notification_stream(request):
+    """
+    Stream new notifications and unread count changes to the authenticated
+    user. Needs an ASGI server: each open stream is a coroutine, not a thread.
+    """
+    if not get_stream_url():
+        return JsonResponse({'detail': 'Notification streaming is not enabled.'}, status=503)
+    user_id = await sync_to_async(get_stream_user_id)(request)
+    if user_id is None:
+        return JsonResponse({'detail': 'Authentication credentials were not provided or are invalid.'}, status=401)
+
+    response = StreamingHttpResponse(event_stream(user_id), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Stop nginx from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
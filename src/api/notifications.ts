@@ -1,5 +1,6 @@
 import api from './axios';
 import { Notification } from '@/types';
+import { getStoredAuth } from '@/utils/storage';
 
 export async function getNotifications() {
   const response = await api.get<{ results: Notification[] }>('/notifications/');
@@ -19,4 +20,63 @@ export async function markAllAsRead() {
 export async function getUnreadCount() {
   const response = await api.get<{ unread_count: number }>('/notifications/unread_count/');
   return response.data.unread_count;
-}
\ No newline at end of file
+}
+export interface NotificationStreamHandlers {
+  onNotification?: (notification: Notification) => void;
+  onUnreadCount?: (count: number) => void;
+  onStatusChange?: (connected: boolean) => void;
+}
+
+// Open a server-sent event stream of new notifications and unread count
+// changes. Returns a function that closes the stream.
+export function subscribeToNotifications(handlers: NotificationStreamHandlers) {
+  const auth = getStoredAuth();
+  if (!auth?.token || typeof EventSource === 'undefined') {
+    return () => {};
+  }
+
+  let source: EventSource | null = null;
+  let retry: ReturnType<typeof setTimeout> | undefined;
+  let closed = false;
+
+  // Tickets are short-lived, so every (re)connect asks for a fresh one
+  // instead of letting the browser retry with the old URL
+  const connect = async () => {
+    let ticket: string;
+    try {
+      const response = await api.post<{ ticket: string }>('/notifications/stream-ticket/');
+      ticket = response.data.ticket;
+    } catch (error: any) {
+      // Streaming is disabled; stay on polling
+      if (error?.response?.status !== 503 && !closed) {
+        retry = setTimeout(connect, 15000);
+      }
+      return;
+    }
+    if (closed) return;
+
+    const url = `${import.meta.env.VITE_API_URL}/notifications/stream/?ticket=${encodeURIComponent(ticket)}`;
+    source = new EventSource(url);
+    source.onopen = () => handlers.onStatusChange?.(true);
+    source.onerror = () => {
+      handlers.onStatusChange?.(false);
+      source?.close();
+      if (!closed) {
+        retry = setTimeout(connect, 15000);
+      }
+    };
+    source.addEventListener('notification', (event) => {
+      handlers.onNotification?.(JSON.parse((event as MessageEvent).data));
+    });
+    source.addEventListener('unread_count', (event) => {
+      handlers.onUnreadCount?.(JSON.parse((event as MessageEvent).data).unread_count);
+    });
+  };
+  connect();
+
+  return () => {
+    closed = true;
+    clearTimeout(retry);
+    source?.close();
+  };
+}
@@ -1,18 +1,30 @@
 import { Link } from 'react-router-dom';
 import { useAuth } from '@/contexts/AuthContext';
 import { Menu, Transition } from '@headlessui/react';
-import { Fragment } from 'react';
+import { Fragment, useEffect, useState } from 'react';
 import { BellIcon, UserCircleIcon } from '@heroicons/react/24/outline';
-import { useQuery } from '@tanstack/react-query';
-import { getUnreadCount } from '@/api/notifications';
+import { useQuery, useQueryClient } from '@tanstack/react-query';
+import { getUnreadCount, subscribeToNotifications } from '@/api/notifications';
 
 export default function Navbar() {
   const { user, logout } = useAuth();
+  const queryClient = useQueryClient();
+  const [streaming, setStreaming] = useState(false);
+  
+  // Push updates from the server; polling only runs while the stream is down
+  useEffect(() => {
+    if (!user) return;
+    return subscribeToNotifications({
+      onStatusChange: setStreaming,
+      onUnreadCount: (count) => queryClient.setQueryData(['notifications', 'unread'], count),
+      onNotification: () => queryClient.invalidateQueries({ queryKey: ['notifications'], exact: true }),
+    });
+  }, [user, queryClient]);
   
   const { data: unreadCount = 0 } = useQuery({
     queryKey: ['notifications', 'unread'],
     queryFn: getUnreadCount,
-    refetchInterval: 30000, // Refetch every 30 seconds
+    refetchInterval: streaming ? false : 30000, // Refetch every 30 seconds without a stream
   });
 
   return (
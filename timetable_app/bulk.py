@@ -0,0 +1,234 @@
+"""
+Streaming bulk import and export of lessons as CSV or NDJSON.
+
+Imports read the input row by row, validate each batch with one reused
+serializer and the conflict index, and insert it with a single bulk_create
+in its own transaction, so memory stays flat and no per-lesson signals
+fire. Caches are invalidated once per batch and the teacher gets one
+summary notification at the end. Exports stream rows from a server-side
+iterator straight into the response.
+"""
+import codecs
+import csv
+import json
+from collections import defaultdict
+from dataclasses import dataclass, field
+from itertools import islice
+
+from django.conf import settings
+from django.db import transaction
+from rest_framework import serializers
+
+from notifications.models import Notification
+from notifications.scheduling import reschedule_on_commit
+from notifications.services import create_notifications
+from . import rooms
+from .cache import invalidate_teacher
+from .conflicts import get_conflict_policy, get_index, invalidate_timetable, resource_keys, to_minutes
+from .models import Lesson, get_minute_of_week
+
+LESSON_FIELDS = ('title', 'subject', 'day', 'start_time', 'end_time', 'location',
+                 'notes', 'color', 'is_recurring')
+EXPORT_FIELDS = ('id',) + LESSON_FIELDS
+FORMATS = ('csv', 'ndjson')
+
+
+def get_import_batch_size():
+    """Return how many rows are validated and inserted together"""
+    return getattr(settings, 'LESSON_IMPORT_BATCH_SIZE', 500)
+
+
+def get_max_reported_errors():
+    """Return how many row errors an import reports in detail"""
+    return getattr(settings, 'LESSON_IMPORT_MAX_ERRORS', 100)
+
+
+class LessonImportSerializer(serializers.ModelSerializer):
+    """Validates one imported row"""
+
+    class Meta:
+        model = Lesson
+        fields = LESSON_FIELDS
+
+    def validate(self, data):
+        if data['start_time'] >= data['end_time']:
+            raise serializers.ValidationError({'end_time': 'End time must be after start time.'})
+        return data
+
+
+@dataclass
+class UnreadableInput:
+    """Stands in for the row where the input stopped being readable"""
+    message: str
+
+
+def read_rows(stream, input_format):
+    """
+    Yield (row number, dict or None) pairs from a binary CSV or NDJSON
+    stream. Input that is not UTF-8, or CSV that cannot be parsed, ends
+    the rows with an UnreadableInput at the row it failed on.
+    """
+    lines = codecs.iterdecode(stream, 'utf-8-sig')
+    number = 0
+    try:
+        if input_format == 'csv':
+            for number, row in enumerate(csv.DictReader(lines), start=2):
+                # Empty cells mean "use the default", not an empty value
+                yield number, {key: value for key, value in row.items() if key and value not in ('', None)}
+            return
+        for number, line in enumerate(lines, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield number, row if isinstance(row, dict) else None
+    except UnicodeDecodeError:
+        yield number + 1, UnreadableInput('Not UTF-8 text; the rest of the input was not imported.')
+    except csv.Error as exc:
+        yield number + 1, UnreadableInput(f'Unreadable CSV ({exc}); the rest of the input was not imported.')
+
+
+@dataclass
+class ImportResult:
+    """Counts and the first row errors of an import"""
+    created: int = 0
+    failed: int = 0
+    errors: list = field(default_factory=list)
+    conflicts: list = field(default_factory=list)
+
+    def add_error(self, row, errors):
+        self.failed += 1
+        if len(self.errors) < get_max_reported_errors():
+            self.errors.append({'row': row, 'errors': errors})
+
+    def as_dict(self):
+        return {
+            'created': self.created,
+            'failed': self.failed,
+            'errors': self.errors,
+            'conflicts': self.conflicts,
+        }
+
+
+class LessonImporter:
+    """Validates and inserts imported rows for one teacher"""
+
+    def __init__(self, teacher, batch_size=None, dry_run=False):
+        self.teacher = teacher
+        self.batch_size = batch_size or get_import_batch_size()
+        self.dry_run = dry_run
+        self.serializer = LessonImportSerializer()
+        self.reject_conflicts = get_conflict_policy() == 'reject'
+        self.index = get_index()
+        # Slots taken by rows accepted earlier in this import
+        self.booked = defaultdict(list)
+        self.result = ImportResult()
+
+    def run(self, rows):
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, self.batch_size))
+            if not batch:
+                break
+            self.import_batch(batch)
+        if self.result.created and not self.dry_run:
+            create_notifications([Notification(
+                user=self.teacher,
+                message=f"Imported {self.result.created} lessons.",
+                type='info',
+            )])
+        return self.result
+
+    def import_batch(self, batch):
+        lessons = []
+        for number, row in batch:
+            lesson = self.validate_row(number, row)
+            if lesson is not None:
+                lessons.append(lesson)
+        if not lessons:
+            return
+        if not self.dry_run:
+            with transaction.atomic():
+                Lesson.objects.bulk_create(lessons)
+                # bulk_create sends no signals, so invalidate once per batch
+                invalidate_teacher(self.teacher.pk)
+                invalidate_timetable()
+                rooms.invalidate()
+                reschedule_on_commit([lesson.id for lesson in lessons])
+        self.result.created += len(lessons)
+
+    def validate_row(self, number, row):
+        if row is None:
+            self.result.add_error(number, {'non_field_errors': ['Not a JSON object.']})
+            return None
+        if isinstance(row, UnreadableInput):
+            self.result.add_error(number, {'non_field_errors': [row.message]})
+            return None
+        try:
+            data = self.serializer.run_validation(row)
+        except serializers.ValidationError as exc:
+            self.result.add_error(number, exc.detail)
+            return None
+
+        conflicts = [
+            self.index.describe(conflict)['message'] for conflict in self.index.lesson_conflicts(
+                self.teacher.pk, data['location'], data['day'], data['start_time'], data['end_time']
+            )
+        ] + self.find_import_conflicts(data)
+        if conflicts and self.reject_conflicts:
+            self.result.add_error(number, {'conflicts': conflicts})
+            return None
+        if conflicts:
+            self.result.conflicts.append({'row': number, 'conflicts': conflicts})
+
+        self.book(number, data)
+        return Lesson(
+            teacher=self.teacher,
+            minute_of_week=get_minute_of_week(data['day'], data['start_time']),
+            **data
+        )
+
+    def find_import_conflicts(self, data):
+        start, end = to_minutes(data['start_time']), to_minutes(data['end_time'])
+        conflicts = []
+        for kind, key in resource_keys(self.teacher.pk, data['location']):
+            for other_start, other_end, number in self.booked[(kind, key, data['day'])]:
+                if other_start < end and other_end > start:
+                    conflicts.append(f"Overlaps row {number} of this import.")
+        return list(dict.fromkeys(conflicts))
+
+    def book(self, number, data):
+        interval = (to_minutes(data['start_time']), to_minutes(data['end_time']), number)
+        for kind, key in resource_keys(self.teacher.pk, data['location']):
+            self.booked[(kind, key, data['day'])].append(interval)
+
+
+def import_lessons(stream, input_format, teacher, batch_size=None, dry_run=False):
+    """Import lessons for a teacher from a binary CSV or NDJSON stream"""
+    importer = LessonImporter(teacher, batch_size=batch_size, dry_run=dry_run)
+    return importer.run(read_rows(stream, input_format))
+
+
+class Echo:
+    """File-like object whose write returns the value, for csv.writer"""
+
+    def write(self, value):
+        return value
+
+
+def export_lessons(queryset, output_format):
+    """Yield a lesson queryset as CSV or NDJSON chunks without loading it whole"""
+    rows = queryset.order_by('minute_of_week', 'id').values_list(*EXPORT_FIELDS).iterator(chunk_size=500)
+    if output_format == 'csv':
+        writer = csv.writer(Echo())
+        yield writer.writerow(EXPORT_FIELDS)
+        for row in rows:
+            yield writer.writerow(row)
+        return
+    for row in rows:
+        data = dict(zip(EXPORT_FIELDS, row))
+        data['start_time'] = data['start_time'].isoformat()
+        data['end_time'] = data['end_time'].isoformat()
+        yield json.dumps(data) + '\n'
@@ -0,0 +1,108 @@
+"""
+Versioned per-teacher cache for lesson API responses.
+
+Every teacher has a version number that is bumped whenever one of their
+lessons, attachments or exceptions changes. Cache keys embed the current
+version, so a bump makes every cached response for that teacher
+unreachable at once and the stale entries simply expire.
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from rest_framework.response import Response
+
+VERSION_KEY = 'lessons:version:{teacher_id}'
+RESPONSE_KEY = 'lessons:response:{teacher_id}:{version}:{digest}'
+STATS_KEY = 'lessons:cache:{name}'
+
+
+def get_cache_timeout():
+    """Return how long cached lesson responses are kept, in seconds"""
+    return getattr(settings, 'LESSON_CACHE_TIMEOUT', 300)
+
+
+def get_shared_version(key):
+    """Return a version number shared by every process through the cache"""
+    version = cache.get(key)
+    if version is None:
+        # Start from the clock so an evicted version never reuses an old number
+        cache.add(key, int(time.time() * 1000), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def bump_shared_version(key):
+    """Increment a shared version number and return the new value"""
+    try:
+        return cache.incr(key)
+    except ValueError:
+        return get_shared_version(key)
+
+
+def get_version(teacher_id):
+    """Return the current cache version for a teacher's lessons"""
+    return get_shared_version(VERSION_KEY.format(teacher_id=teacher_id))
+
+
+def bump_version(teacher_id):
+    """Invalidate every cached response for a teacher"""
+    return bump_shared_version(VERSION_KEY.format(teacher_id=teacher_id))
+
+
+def invalidate_teacher(teacher_id):
+    """
+    Bump a teacher's version now and again once the current transaction
+    commits, so a response cached by a concurrent reader before the commit
+    is not served afterwards.
+    """
+    bump_version(teacher_id)
+    transaction.on_commit(lambda: bump_version(teacher_id))
+
+
+def response_key(request, version):
+    """Build the cache key for a request by the authenticated teacher"""
+    digest = hashlib.md5(request.get_full_path().encode()).hexdigest()
+    return RESPONSE_KEY.format(teacher_id=request.user.pk, version=version, digest=digest)
+
+
+def record(name):
+    """Increment a hit or miss counter"""
+    key = STATS_KEY.format(name=name)
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, timeout=None):
+            cache.incr(key)
+
+
+def cache_stats():
+    """Return the hit and miss counters for the lesson response cache"""
+    hits = cache.get(STATS_KEY.format(name='hits'), 0)
+    misses = cache.get(STATS_KEY.format(name='misses'), 0)
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': hits / total if total else 0.0,
+    }
+
+
+def cached_response(request, build):
+    """
+    Return the cached data for this request, or build the response, cache
+    its data on success and return it.
+    """
+    key = response_key(request, get_version(request.user.pk))
+    data = cache.get(key)
+    if data is not None:
+        record('hits')
+        return Response(data)
+
+    record('misses')
+    response = build()
+    if response.status_code == 200:
+        cache.set(key, response.data, get_cache_timeout())
+    return response
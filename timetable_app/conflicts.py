@@ -0,0 +1,365 @@
+"""
+Double-booking detection for lessons.
+
+The whole timetable is held in per-process interval indexes, one per
+teacher and one per location for each weekday, plus the same for the
+upcoming dates where a LessonException moves an occurrence. A check is a
+handful of binary searches, so validating a lesson against a school-wide
+timetable takes microseconds once the index is built.
+
+Each process keeps its index next to the shared timetable version, like
+the room bitmaps. A committed lesson or exception write bumps the version;
+the writing process applies the change to its index in place when it was
+up to date, re-sorting only the few intervals of the teacher and room
+involved, and every other process sees the new version and rebuilds on its
+next check. An index is only kept when it was built outside a transaction,
+so it never holds rows that may roll back.
+"""
+import threading
+from bisect import bisect_left, bisect_right
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from datetime import date
+from typing import Optional
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .cache import bump_shared_version, get_shared_version
+from .models import DAY_CHOICES, Lesson, LessonException
+
+VERSION_KEY = 'lessons:timetable_version'
+CONFLICT_POLICIES = ('reject', 'flag')
+
+_lock = threading.Lock()
+_cached = None
+
+
+def get_conflict_policy():
+    """Return whether conflicting writes are rejected or accepted and flagged"""
+    policy = getattr(settings, 'LESSON_CONFLICT_POLICY', 'reject')
+    return policy if policy in CONFLICT_POLICIES else 'reject'
+
+
+def to_minutes(value):
+    return value.hour * 60 + value.minute
+
+
+def normalize_location(location):
+    """Rooms match case-insensitively and ignoring surrounding whitespace"""
+    return (location or '').strip().casefold()
+
+
+def resource_keys(teacher_id, location):
+    """Return the (kind, key) pairs a booking occupies"""
+    keys = [('teacher', teacher_id)]
+    room = normalize_location(location)
+    if room:
+        keys.append(('location', room))
+    return keys
+
+
+@dataclass(frozen=True)
+class Conflict:
+    """An existing booking that overlaps the one being checked"""
+    kind: str
+    lesson_id: int
+    date: Optional[date] = None
+
+
+class IntervalIndex:
+    """
+    Static index of half-open [start, end) intervals sorted by start.
+    Overlaps with [start, end) are found by bisecting between
+    start - longest interval and end, then filtering on the end.
+    """
+
+    def __init__(self, intervals):
+        self.entries = sorted(intervals, key=lambda entry: entry[0])
+        self.starts = [entry[0] for entry in self.entries]
+        self.max_length = max((end - start for start, end, _ in self.entries), default=0)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def overlapping(self, start, end):
+        """Return the items whose intervals overlap [start, end)"""
+        low = bisect_right(self.starts, start - self.max_length)
+        high = bisect_left(self.starts, end)
+        return [item for _, entry_end, item in self.entries[low:high] if entry_end > start]
+
+
+EMPTY_INDEX = IntervalIndex([])
+
+
+class TimetableIndex:
+    """Interval indexes over every weekly lesson and upcoming moved occurrence"""
+
+    def __init__(self, lessons=(), exceptions=()):
+        self.lessons = {}
+        self.exceptions = {}
+        self.lesson_exceptions = defaultdict(set)
+        # Every exception takes the weekly slot away on its date; all but
+        # cancellations put the occurrence somewhere else that day
+        self.displaced = Counter()
+        # The intervals behind each index, keyed by (table, kind, key, day
+        # or date) and then by the lesson or exception that placed them
+        self.entries = defaultdict(dict)
+        self.dirty = set()
+        self.weekly = {}
+        self.moved_by_weekday = {}
+        self.moved_by_date = {}
+        for lesson_id, *values in lessons:
+            self.lessons[lesson_id] = tuple(values)
+            self.place_lesson(lesson_id)
+        for exception_id, *values in exceptions:
+            self.add_exception(exception_id, tuple(values))
+        self.refresh()
+
+    def put(self, index_key, owner, interval):
+        self.entries[index_key][owner] = interval
+        self.dirty.add(index_key)
+
+    def take(self, index_key, owner):
+        self.entries[index_key].pop(owner, None)
+        self.dirty.add(index_key)
+
+    def refresh(self):
+        """Re-sort the indexes whose intervals changed"""
+        for index_key in self.dirty:
+            table = getattr(self, index_key[0])
+            entries = self.entries.get(index_key)
+            if entries:
+                table[index_key[1:]] = IntervalIndex(entries.values())
+            else:
+                table.pop(index_key[1:], None)
+                self.entries.pop(index_key, None)
+        self.dirty.clear()
+
+    def weekly_keys(self, lesson_id):
+        teacher_id, day, _, _, location, _ = self.lessons[lesson_id]
+        return [('weekly',) + key + (day,) for key in resource_keys(teacher_id, location)]
+
+    def place_lesson(self, lesson_id):
+        _, _, start_time, end_time, _, _ = self.lessons[lesson_id]
+        for index_key in self.weekly_keys(lesson_id):
+            self.put(index_key, lesson_id, (to_minutes(start_time), to_minutes(end_time), lesson_id))
+
+    def moved_keys(self, exception_id):
+        """Return the index keys and interval of a moved occurrence, or None if it does not take place"""
+        lesson_id, on_date, exception_type, start_time, end_time, location = self.exceptions[exception_id]
+        if exception_type == 'cancelled' or lesson_id not in self.lessons:
+            return None
+        teacher_id, _, lesson_start, lesson_end, lesson_location, _ = self.lessons[lesson_id]
+        interval = (
+            to_minutes(start_time or lesson_start),
+            to_minutes(end_time or lesson_end),
+            (lesson_id, on_date),
+        )
+        keys = []
+        for key in resource_keys(teacher_id, location or lesson_location):
+            keys += [('moved_by_weekday',) + key + (on_date.weekday(),), ('moved_by_date',) + key + (on_date,)]
+        return keys, interval
+
+    def place_exception(self, exception_id):
+        moved = self.moved_keys(exception_id)
+        if moved is not None:
+            keys, interval = moved
+            for index_key in keys:
+                self.put(index_key, exception_id, interval)
+
+    def unplace_exception(self, exception_id):
+        moved = self.moved_keys(exception_id)
+        if moved is not None:
+            for index_key in moved[0]:
+                self.take(index_key, exception_id)
+
+    def add_exception(self, exception_id, values):
+        self.exceptions[exception_id] = values
+        self.lesson_exceptions[values[0]].add(exception_id)
+        self.displaced[values[:2]] += 1
+        self.place_exception(exception_id)
+
+    def drop_exception(self, exception_id):
+        if exception_id not in self.exceptions:
+            return
+        self.unplace_exception(exception_id)
+        values = self.exceptions.pop(exception_id)
+        self.lesson_exceptions[values[0]].discard(exception_id)
+        self.displaced[values[:2]] -= 1
+        if not self.displaced[values[:2]]:
+            del self.displaced[values[:2]]
+
+    def set_lesson(self, lesson_id, teacher_id, day, start_time, end_time, location, title):
+        """Add or move a lesson, and the occurrences its exceptions move with it"""
+        exception_ids = list(self.lesson_exceptions.get(lesson_id, ()))
+        for exception_id in exception_ids:
+            self.unplace_exception(exception_id)
+        if lesson_id in self.lessons:
+            for index_key in self.weekly_keys(lesson_id):
+                self.take(index_key, lesson_id)
+        self.lessons[lesson_id] = (teacher_id, day, start_time, end_time, location, title)
+        self.place_lesson(lesson_id)
+        for exception_id in exception_ids:
+            self.place_exception(exception_id)
+        self.refresh()
+
+    def remove_lesson(self, lesson_id):
+        for exception_id in list(self.lesson_exceptions.pop(lesson_id, ())):
+            self.drop_exception(exception_id)
+        if lesson_id in self.lessons:
+            for index_key in self.weekly_keys(lesson_id):
+                self.take(index_key, lesson_id)
+            del self.lessons[lesson_id]
+        self.refresh()
+
+    def set_exception(self, exception_id, lesson_id, on_date, exception_type, start_time, end_time, location):
+        """Add or change an exception that cancels or moves one occurrence"""
+        self.drop_exception(exception_id)
+        # Like a rebuild, only upcoming dates are indexed
+        if on_date >= timezone.localdate():
+            self.add_exception(exception_id, (lesson_id, on_date, exception_type, start_time, end_time, location))
+        self.refresh()
+
+    def remove_exception(self, exception_id):
+        self.drop_exception(exception_id)
+        self.refresh()
+
+    def lesson_conflicts(self, teacher_id, location, day, start_time, end_time, exclude=None):
+        """
+        Return the conflicts of a weekly booking: other weekly lessons on the
+        same weekday, and upcoming occurrences moved onto that weekday.
+        """
+        start, end = to_minutes(start_time), to_minutes(end_time)
+        conflicts = []
+        for kind, key in resource_keys(teacher_id, location):
+            weekly = set()
+            for lesson_id in self.weekly.get((kind, key, day), EMPTY_INDEX).overlapping(start, end):
+                if lesson_id != exclude:
+                    weekly.add(lesson_id)
+                    conflicts.append(Conflict(kind, lesson_id))
+            moved = self.moved_by_weekday.get((kind, key, day), EMPTY_INDEX)
+            for lesson_id, on_date in moved.overlapping(start, end):
+                if lesson_id != exclude and lesson_id not in weekly:
+                    conflicts.append(Conflict(kind, lesson_id, on_date))
+        return conflicts
+
+    def occurrence_conflicts(self, lesson_id, teacher_id, location, on_date, start_time, end_time):
+        """
+        Return the conflicts of one lesson occurrence moved to start_time on
+        on_date: weekly lessons still taking place that day and other moved
+        occurrences on the same date.
+        """
+        start, end = to_minutes(start_time), to_minutes(end_time)
+        conflicts = []
+        for kind, key in resource_keys(teacher_id, location):
+            weekly = self.weekly.get((kind, key, on_date.weekday()), EMPTY_INDEX)
+            for other in weekly.overlapping(start, end):
+                if other != lesson_id and (other, on_date) not in self.displaced:
+                    conflicts.append(Conflict(kind, other, on_date))
+            moved = self.moved_by_date.get((kind, key, on_date), EMPTY_INDEX)
+            for other, _ in moved.overlapping(start, end):
+                if other != lesson_id:
+                    conflicts.append(Conflict(kind, other, on_date))
+        return conflicts
+
+    def describe(self, conflict):
+        """Return a client-facing description of a conflict"""
+        _, day, start_time, end_time, _, title = self.lessons[conflict.lesson_id]
+        return {
+            'kind': conflict.kind,
+            'lesson': conflict.lesson_id,
+            'title': title,
+            'day': day,
+            'date': conflict.date,
+            'message': "{who} already has '{title}' on {when} {start:%H:%M}-{end:%H:%M}.".format(
+                who='The teacher' if conflict.kind == 'teacher' else 'This room',
+                title=title,
+                when=conflict.date or dict(DAY_CHOICES)[day],
+                start=start_time,
+                end=end_time,
+            ),
+        }
+
+
+def get_timetable_version():
+    """Return the shared version of the timetable, bumped on every write"""
+    return get_shared_version(VERSION_KEY)
+
+
+def bump_timetable_version():
+    bump_shared_version(VERSION_KEY)
+
+
+def invalidate_timetable():
+    """
+    Make every process rebuild its index, now and once the transaction
+    commits. For writes that send no signals, such as bulk_create.
+    """
+    bump_timetable_version()
+    transaction.on_commit(bump_timetable_version)
+
+
+def build_index():
+    """Load the whole timetable in two queries"""
+    lessons = Lesson.objects.order_by().values_list(
+        'id', 'teacher_id', 'day', 'start_time', 'end_time', 'location', 'title'
+    )
+    exceptions = LessonException.objects.filter(date__gte=timezone.localdate()).order_by().values_list(
+        'id', 'lesson_id', 'date', 'exception_type', 'start_time', 'end_time', 'location'
+    )
+    return TimetableIndex(lessons, exceptions)
+
+
+def get_index():
+    """Return this process's index, rebuilding it if another process changed the timetable"""
+    global _cached
+    stamp = (get_timetable_version(), timezone.localdate())
+    with _lock:
+        if _cached is not None and _cached[0] == stamp:
+            return _cached[1]
+    index = build_index()
+    if not connection.in_atomic_block:
+        with _lock:
+            _cached = (stamp, index)
+    return index
+
+
+def apply_committed(change):
+    """
+    Bump the shared version and apply change to the local index if it was
+    current, otherwise drop it to be rebuilt
+    """
+    global _cached
+    version = bump_shared_version(VERSION_KEY)
+    with _lock:
+        if _cached is not None and _cached[0] == (version - 1, timezone.localdate()):
+            change(_cached[1])
+            _cached = ((version, _cached[0][1]), _cached[1])
+        else:
+            _cached = None
+
+
+def lesson_saved(lesson):
+    values = (
+        lesson.id, lesson.teacher_id, lesson.day, lesson.start_time, lesson.end_time,
+        lesson.location, lesson.title,
+    )
+    transaction.on_commit(lambda: apply_committed(lambda index: index.set_lesson(*values)))
+
+
+def lesson_deleted(lesson_id):
+    transaction.on_commit(lambda: apply_committed(lambda index: index.remove_lesson(lesson_id)))
+
+
+def exception_saved(exception):
+    values = (
+        exception.id, exception.lesson_id, exception.date, exception.exception_type,
+        exception.start_time, exception.end_time, exception.location,
+    )
+    transaction.on_commit(lambda: apply_committed(lambda index: index.set_exception(*values)))
+
+
+def exception_deleted(exception_id):
+    transaction.on_commit(lambda: apply_committed(lambda index: index.remove_exception(exception_id)))
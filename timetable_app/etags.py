@@ -0,0 +1,44 @@
+"""
+Conditional GET support for API endpoints.
+
+Views compute a cheap validator (a few aggregates, no serialization) and
+answer 304 Not Modified when it matches the client's If-None-Match header.
+"""
+import hashlib
+
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+
+
+def make_etag(*parts):
+    """Build a strong ETag from the values that determine a response"""
+    return quote_etag(hashlib.md5(repr(parts).encode()).hexdigest())
+
+
+def etag_matches(request, etag):
+    """Return True if the request's If-None-Match header matches etag"""
+    header = request.META.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return False
+    etags = parse_etags(header)
+    return '*' in etags or etag in etags
+
+
+def conditional_response(request, etag, build):
+    """
+    Return 304 Not Modified if the client already has this version,
+    otherwise build the response. Either way the ETag is attached.
+    """
+    if etag_matches(request, etag):
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        response = build()
+        if response.status_code != status.HTTP_200_OK:
+            return response
+    response['ETag'] = etag
+    # Responses are per user; clients must revalidate before reuse
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ['Authorization'])
+    return response
@@ -0,0 +1,215 @@
+"""
+iCalendar (RFC 5545) feed of a teacher's timetable.
+
+Each recurring lesson is written once as a weekly RRULE event. Cancelled
+occurrences become EXDATEs and rescheduled or modified ones become
+RECURRENCE-ID overrides, so the feed size grows with the number of
+lessons and exceptions rather than with the number of occurrences. The
+feed is produced by a generator walking two ordered iterators, lessons by
+id and exceptions by lesson, so it is never held in memory whole.
+
+Calendar apps cannot send a JWT, so feeds are addressed by a signed token
+of the teacher's id. The signing key includes the teacher's feed_version
+and password hash, so bumping the version or changing the password
+revokes every URL handed out before.
+"""
+from datetime import datetime
+from itertools import groupby
+from zoneinfo import ZoneInfo
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import signing
+from django.utils import timezone
+
+from .models import Lesson, LessonException
+from .occurrences import first_occurrence_date
+
+TOKEN_SALT = 'timetable_app.ical'
+WEEKDAYS = ('MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU')
+LINE_LIMIT = 75
+
+
+def feed_signer(teacher):
+    return signing.Signer(salt=f'{TOKEN_SALT}:{teacher.feed_version}:{teacher.password}')
+
+
+def make_feed_token(teacher):
+    """Return the signed token that addresses a teacher's feed"""
+    return feed_signer(teacher).sign(str(teacher.pk))
+
+
+def read_feed_token(token):
+    """
+    Return the active teacher a feed token addresses, or None if the token
+    was tampered with or revoked, or the teacher is gone or deactivated
+    """
+    teacher_id = token.split(signing.Signer().sep, 1)[0]
+    if not teacher_id.isdigit():
+        return None
+    teacher = get_user_model().objects.filter(pk=int(teacher_id), is_active=True).first()
+    if teacher is None:
+        return None
+    try:
+        feed_signer(teacher).unsign(token)
+    except signing.BadSignature:
+        return None
+    return teacher
+
+
+def escape_text(value):
+    """Escape a TEXT property value"""
+    return (
+        (value or '')
+        .replace('\\', '\\\\')
+        .replace(';', '\\;')
+        .replace(',', '\\,')
+        .replace('\r\n', '\\n')
+        .replace('\n', '\\n')
+    )
+
+
+def fold(line):
+    """Fold a content line into CRLF-terminated chunks of at most 75 octets"""
+    encoded = line.encode()
+    if len(encoded) <= LINE_LIMIT:
+        return line + '\r\n'
+    chunks = []
+    start, limit = 0, LINE_LIMIT
+    while start < len(encoded):
+        end = min(start + limit, len(encoded))
+        # Never split inside a UTF-8 sequence
+        while end < len(encoded) and (encoded[end] & 0xC0) == 0x80:
+            end -= 1
+        chunks.append(encoded[start:end].decode())
+        start, limit = end, LINE_LIMIT - 1
+    return '\r\n '.join(chunks) + '\r\n'
+
+
+def format_local(on_date, at):
+    return datetime.combine(on_date, at).strftime('%Y%m%dT%H%M%S')
+
+
+def format_utc(value):
+    return value.astimezone(ZoneInfo('UTC')).strftime('%Y%m%dT%H%M%SZ')
+
+
+def vtimezone(tzid):
+    """
+    Describe the time zone the lesson times are given in. Only zones with a
+    fixed offset are described; for others clients resolve the IANA name.
+    """
+    zone = ZoneInfo(tzid)
+    year = timezone.localdate().year
+    january = datetime(year, 1, 1, tzinfo=zone).utcoffset()
+    july = datetime(year, 7, 1, tzinfo=zone).utcoffset()
+    if january != july:
+        return []
+    minutes = int(january.total_seconds() // 60)
+    offset = '{}{:02d}{:02d}'.format('-' if minutes < 0 else '+', abs(minutes) // 60, abs(minutes) % 60)
+    return [
+        'BEGIN:VTIMEZONE',
+        f'TZID:{tzid}',
+        'BEGIN:STANDARD',
+        'DTSTART:19700101T000000',
+        f'TZOFFSETFROM:{offset}',
+        f'TZOFFSETTO:{offset}',
+        'END:STANDARD',
+        'END:VTIMEZONE',
+    ]
+
+
+def event_lines(lesson, uid, tzid, on_date, start_time, end_time, location, notes, extra=()):
+    lines = [
+        'BEGIN:VEVENT',
+        f'UID:{uid}',
+        f'DTSTAMP:{format_utc(lesson.updated_at)}',
+        *extra,
+        f'DTSTART;TZID={tzid}:{format_local(on_date, start_time)}',
+        f'DTEND;TZID={tzid}:{format_local(on_date, end_time)}',
+        f'SUMMARY:{escape_text(lesson.title)}',
+        f'LOCATION:{escape_text(location)}',
+        f'CATEGORIES:{escape_text(lesson.subject)}',
+    ]
+    if notes:
+        lines.append(f'DESCRIPTION:{escape_text(notes)}')
+    return lines
+
+
+def lesson_lines(lesson, exceptions, uid_domain, tzid):
+    """Return the content lines for a lesson and its exceptions"""
+    uid = f'lesson-{lesson.id}@{uid_domain}'
+    first = first_occurrence_date(lesson)
+
+    if not lesson.is_recurring:
+        # A one-off lesson has at most one exception, on its only date
+        exception = next((e for e in exceptions if e.date == first), None)
+        lines = event_lines(
+            lesson, uid, tzid, first,
+            (exception and exception.start_time) or lesson.start_time,
+            (exception and exception.end_time) or lesson.end_time,
+            (exception and exception.location) or lesson.location,
+            (exception and exception.notes) or lesson.notes,
+        )
+        if exception is not None and exception.exception_type == 'cancelled':
+            lines.append('STATUS:CANCELLED')
+        return lines + ['END:VEVENT']
+
+    extra = [f'RRULE:FREQ=WEEKLY;BYDAY={WEEKDAYS[lesson.day]}']
+    extra += [
+        f'EXDATE;TZID={tzid}:{format_local(exception.date, lesson.start_time)}'
+        for exception in exceptions if exception.exception_type == 'cancelled'
+    ]
+    lines = event_lines(
+        lesson, uid, tzid, first, lesson.start_time, lesson.end_time, lesson.location, lesson.notes, extra
+    )
+    lines.append('END:VEVENT')
+
+    for exception in exceptions:
+        if exception.exception_type == 'cancelled':
+            continue
+        lines += event_lines(
+            lesson, uid, tzid, exception.date,
+            exception.start_time or lesson.start_time,
+            exception.end_time or lesson.end_time,
+            exception.location or lesson.location,
+            exception.notes or lesson.notes,
+            [f'RECURRENCE-ID;TZID={tzid}:{format_local(exception.date, lesson.start_time)}'],
+        )
+        lines.append('END:VEVENT')
+    return lines
+
+
+def generate_feed(teacher, uid_domain):
+    """Yield the feed for a teacher in chunks, one lesson at a time"""
+    tzid = settings.TIME_ZONE
+    header = [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//Teacher Timetable//Timetable Feed//EN',
+        'CALSCALE:GREGORIAN',
+        'METHOD:PUBLISH',
+        f'X-WR-CALNAME:{escape_text(teacher.get_full_name() or teacher.username)} timetable',
+        f'X-WR-TIMEZONE:{tzid}',
+        *vtimezone(tzid),
+    ]
+    yield ''.join(fold(line) for line in header)
+
+    lessons = Lesson.objects.filter(teacher=teacher).order_by('id').iterator(chunk_size=500)
+    exceptions = groupby(
+        LessonException.objects.filter(lesson__teacher=teacher).order_by('lesson_id', 'date')
+        .iterator(chunk_size=500),
+        key=lambda exception: exception.lesson_id,
+    )
+    pending_id, pending = next(exceptions, (None, None))
+    for lesson in lessons:
+        # Both iterators are ordered by lesson id, so merge them in one walk
+        while pending_id is not None and pending_id < lesson.id:
+            pending_id, pending = next(exceptions, (None, None))
+        lesson_exceptions = []
+        if pending_id == lesson.id:
+            lesson_exceptions = list(pending)
+            pending_id, pending = next(exceptions, (None, None))
+        yield ''.join(fold(line) for line in lesson_lines(lesson, lesson_exceptions, uid_domain, tzid))
+
+    yield fold('END:VCALENDAR')
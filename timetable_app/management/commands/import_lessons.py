@@ -0,0 +1,56 @@
+import json
+import sys
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+
+from timetable_app.bulk import FORMATS, import_lessons
+
+
+class Command(BaseCommand):
+    """Bulk import a teacher's lessons from a CSV or NDJSON file"""
+    help = "Import lessons for a teacher from CSV or NDJSON ('-' reads standard input)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to import, or '-' for standard input")
+        parser.add_argument('--teacher', required=True, help='Username or email of the teacher')
+        parser.add_argument('--input', choices=FORMATS,
+                            help='Input format (default: from the file extension, else csv)')
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Validate every row without inserting anything')
+
+    def handle(self, *args, **options):
+        User = get_user_model()
+        teacher = User.objects.filter(
+            Q(username=options['teacher']) | Q(email=options['teacher'])
+        ).first()
+        if teacher is None:
+            raise CommandError(f"No teacher with username or email '{options['teacher']}'")
+
+        path = options['path']
+        input_format = options['input'] or (
+            'ndjson' if path.endswith(('.ndjson', '.jsonl')) else 'csv'
+        )
+        if path == '-':
+            result = self.run(sys.stdin.buffer, input_format, teacher, options)
+        else:
+            with open(path, 'rb') as stream:
+                result = self.run(stream, input_format, teacher, options)
+
+        for error in result.errors:
+            self.stderr.write(f"Row {error['row']}: {json.dumps(error['errors'])}")
+        verb = 'Validated' if options['dry_run'] else 'Imported'
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {result.created} lessons, {result.failed} rows failed"
+        ))
+
+    def run(self, stream, input_format, teacher, options):
+        return import_lessons(
+            stream,
+            input_format,
+            teacher,
+            batch_size=options['batch_size'],
+            dry_run=options['dry_run'],
+        )
@@ -0,0 +1,33 @@
+# Generated by Django 5.0.1 on 2026-10-17 12:42
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def populate_minute_of_week(apps, schema_editor):
+    Lesson = apps.get_model('timetable_app', 'Lesson')
+    lessons = Lesson.objects.only('id', 'day', 'start_time')
+    for lesson in lessons.iterator():
+        lesson.minute_of_week = lesson.day * 1440 + lesson.start_time.hour * 60 + lesson.start_time.minute
+        lesson.save(update_fields=['minute_of_week'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timetable_app', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lesson',
+            name='minute_of_week',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(populate_minute_of_week, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='lesson',
+            index=models.Index(fields=['minute_of_week'], name='timetable_a_minute__74258f_idx'),
+        ),
+    ]
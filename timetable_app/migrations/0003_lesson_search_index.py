@@ -0,0 +1,74 @@
+from django.db import migrations
+
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE timetable_app_lesson_fts USING fts5(
+        title, subject, location,
+        content='timetable_app_lesson', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )
+    """,
+    """
+    CREATE TRIGGER timetable_app_lesson_fts_insert AFTER INSERT ON timetable_app_lesson BEGIN
+        INSERT INTO timetable_app_lesson_fts (rowid, title, subject, location)
+        VALUES (new.id, new.title, new.subject, new.location);
+    END
+    """,
+    """
+    CREATE TRIGGER timetable_app_lesson_fts_delete AFTER DELETE ON timetable_app_lesson BEGIN
+        INSERT INTO timetable_app_lesson_fts (timetable_app_lesson_fts, rowid, title, subject, location)
+        VALUES ('delete', old.id, old.title, old.subject, old.location);
+    END
+    """,
+    """
+    CREATE TRIGGER timetable_app_lesson_fts_update
+    AFTER UPDATE OF title, subject, location ON timetable_app_lesson BEGIN
+        INSERT INTO timetable_app_lesson_fts (timetable_app_lesson_fts, rowid, title, subject, location)
+        VALUES ('delete', old.id, old.title, old.subject, old.location);
+        INSERT INTO timetable_app_lesson_fts (rowid, title, subject, location)
+        VALUES (new.id, new.title, new.subject, new.location);
+    END
+    """,
+    "INSERT INTO timetable_app_lesson_fts (timetable_app_lesson_fts) VALUES ('rebuild')",
+]
+
+SQLITE_REVERSE = [
+    "DROP TRIGGER IF EXISTS timetable_app_lesson_fts_update",
+    "DROP TRIGGER IF EXISTS timetable_app_lesson_fts_delete",
+    "DROP TRIGGER IF EXISTS timetable_app_lesson_fts_insert",
+    "DROP TABLE IF EXISTS timetable_app_lesson_fts",
+]
+
+# An expression index needs no triggers; queries must use the same expression
+POSTGRESQL_FORWARD = [
+    """
+    CREATE INDEX timetable_app_lesson_search_idx ON timetable_app_lesson USING GIN (
+        to_tsvector('simple', title || ' ' || subject || ' ' || location)
+    )
+    """,
+]
+
+POSTGRESQL_REVERSE = [
+    "DROP INDEX IF EXISTS timetable_app_lesson_search_idx",
+]
+
+
+def run_for_vendor(statements):
+    def run(apps, schema_editor):
+        for sql in statements.get(schema_editor.connection.vendor, ()):
+            schema_editor.execute(sql)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timetable_app', '0002_lesson_minute_of_week'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run_for_vendor({'sqlite': SQLITE_FORWARD, 'postgresql': POSTGRESQL_FORWARD}),
+            run_for_vendor({'sqlite': SQLITE_REVERSE, 'postgresql': POSTGRESQL_REVERSE}),
+        ),
+    ]
@@ -25,6 +25,14 @@ COLOR_CHOICES = (
     ('teal', 'Teal'),
 )
 
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+
+def get_minute_of_week(day, start_time):
+    """Return the number of minutes between Monday 00:00 and the given day/time"""
+    return day * MINUTES_PER_DAY + start_time.hour * 60 + start_time.minute
+
 
 class Lesson(models.Model):
     """Model for teacher lessons"""
@@ -42,6 +50,8 @@ class Lesson(models.Model):
     notes = models.TextField(blank=True, null=True)
     color = models.CharField(max_length=20, choices=COLOR_CHOICES, default='indigo')
     is_recurring = models.BooleanField(default=True)
+    # Denormalised sort/search key kept in sync with day and start_time
+    minute_of_week = models.PositiveIntegerField(default=0, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
@@ -50,10 +60,18 @@ class Lesson(models.Model):
         indexes = [
             models.Index(fields=['teacher', 'day']),
             models.Index(fields=['day', 'start_time']),
+            models.Index(fields=['minute_of_week']),
         ]
     
     def __str__(self):
         return f"{self.title} - {self.get_day_display()} at {self.start_time}"
+    
+    def save(self, *args, **kwargs):
+        self.minute_of_week = get_minute_of_week(self.day, self.start_time)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'day', 'start_time'} & set(update_fields):
+            kwargs['update_fields'] = set(update_fields) | {'minute_of_week'}
+        super().save(*args, **kwargs)
 
 
 class LessonAttachment(models.Model):
@@ -0,0 +1,103 @@
+"""
+Expansion of weekly lessons into concrete occurrences for a date range.
+
+The expansion reads two sorted queries, the lessons ordered by their
+position in the week and the exceptions inside the range ordered by date,
+and merges them while walking the dates once. Its cost grows with the
+length of the range, not with the lesson's whole exception history.
+"""
+from dataclasses import dataclass
+from datetime import date, time, timedelta
+from itertools import groupby
+from typing import Optional
+
+from django.utils import timezone
+
+from .models import Lesson, LessonException
+
+
+@dataclass
+class Occurrence:
+    """A lesson as it actually happens on one date"""
+    lesson: Lesson
+    date: date
+    start_time: time
+    end_time: time
+    location: str
+    notes: str
+    status: str = 'scheduled'
+    exception: Optional[LessonException] = None
+
+
+def first_occurrence_date(lesson):
+    """Return the date of the first occurrence of a lesson, based on when it was created"""
+    created = timezone.localdate(lesson.created_at) if lesson.created_at else timezone.localdate()
+    return created + timedelta(days=(lesson.day - created.weekday()) % 7)
+
+
+def apply_exception(occurrence, exception):
+    """Apply a cancel, reschedule or modify exception to an occurrence"""
+    occurrence.exception = exception
+    occurrence.status = exception.exception_type
+    if exception.exception_type == 'cancelled':
+        return occurrence
+    occurrence.start_time = exception.start_time or occurrence.start_time
+    occurrence.end_time = exception.end_time or occurrence.end_time
+    occurrence.location = exception.location or occurrence.location
+    occurrence.notes = exception.notes or occurrence.notes
+    return occurrence
+
+
+def expand_occurrences(lessons, start, end, include_cancelled=False):
+    """
+    Expand a lesson queryset into occurrences between start and end
+    (inclusive), ordered by date and start time. Cancelled occurrences are
+    left out unless include_cancelled is set.
+    """
+    lessons_by_day = {}
+    for lesson in lessons.order_by('minute_of_week', 'id'):
+        lessons_by_day.setdefault(lesson.day, []).append(lesson)
+    if not lessons_by_day:
+        return []
+
+    exceptions = (
+        LessonException.objects
+        .filter(lesson__in=lessons.order_by().values('id'), date__range=(start, end))
+        .order_by('date', 'lesson_id')
+    )
+    exceptions_by_date = groupby(exceptions, key=lambda exception: exception.date)
+    pending_date, pending = next(exceptions_by_date, (None, None))
+
+    occurrences = []
+    current = start
+    while current <= end:
+        day_exceptions = {}
+        if pending_date == current:
+            day_exceptions = {exception.lesson_id: exception for exception in pending}
+            pending_date, pending = next(exceptions_by_date, (None, None))
+
+        day_occurrences = []
+        for lesson in lessons_by_day.get(current.weekday(), ()):
+            if not lesson.is_recurring and current != first_occurrence_date(lesson):
+                continue
+            occurrence = Occurrence(
+                lesson=lesson,
+                date=current,
+                start_time=lesson.start_time,
+                end_time=lesson.end_time,
+                location=lesson.location,
+                notes=lesson.notes or '',
+            )
+            exception = day_exceptions.get(lesson.id)
+            if exception is not None:
+                apply_exception(occurrence, exception)
+                if occurrence.status == 'cancelled' and not include_cancelled:
+                    continue
+            day_occurrences.append(occurrence)
+
+        # Rescheduled occurrences may move ahead of or behind others that day
+        day_occurrences.sort(key=lambda occurrence: occurrence.start_time)
+        occurrences.extend(day_occurrences)
+        current += timedelta(days=1)
+
+    return occurrences
@@ -0,0 +1,125 @@
+"""
+Keyset (cursor) pagination.
+
+Pages are addressed by the ordering values of the last row seen instead
+of an OFFSET, so fetching a page deep into a long history costs the same
+as fetching the first one. The total count is only computed on request
+(?count=true).
+"""
+import base64
+import json
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination over a unique tuple of ordering fields, for example
+    ('-time', '-id'). The last field must be unique to break ties.
+    """
+    ordering = ('id',)
+    page_size = getattr(settings, 'REST_FRAMEWORK', {}).get('PAGE_SIZE', 20)
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def encode_cursor(self, values):
+        # str() keeps full microsecond precision for datetimes, unlike DjangoJSONEncoder
+        payload = json.dumps(values, default=str, separators=(',', ':'))
+        return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+    def decode_cursor(self, request, model):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            padded = encoded + '=' * (-len(encoded) % 4)
+            values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+            if not isinstance(values, list) or len(values) != len(self.ordering):
+                raise ValueError
+            return [
+                model._meta.get_field(name.lstrip('-')).to_python(value)
+                for name, value in zip(self.ordering, values)
+            ]
+        except Exception:
+            raise NotFound(self.invalid_cursor_message)
+
+    def keyset_filter(self, values):
+        """
+        Build the filter for rows after the cursor in ordering order. The
+        leading bound on the first field keeps the lookup index-friendly.
+        """
+        names = [name.lstrip('-') for name in self.ordering]
+        after = ['lt' if name.startswith('-') else 'gt' for name in self.ordering]
+
+        first_bound = 'lte' if after[0] == 'lt' else 'gte'
+        condition = Q()
+        for position in range(len(names)):
+            term = Q(**{f'{names[position]}__{after[position]}': values[position]})
+            for name, value in zip(names[:position], values[:position]):
+                term &= Q(**{name: value})
+            condition |= term
+        return Q(**{f'{names[0]}__{first_bound}': values[0]}) & condition
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.count = None
+        if request.query_params.get(self.count_query_param, '').lower() == 'true':
+            self.count = queryset.count()
+
+        queryset = queryset.order_by(*self.ordering)
+        cursor = self.decode_cursor(request, queryset.model)
+        if cursor is not None:
+            queryset = queryset.filter(self.keyset_filter(cursor))
+
+        rows = list(queryset[:self.page_size + 1])
+        self.page = rows[:self.page_size]
+        self.has_next = len(rows) > self.page_size
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        last = self.page[-1]
+        values = [getattr(last, name.lstrip('-')) for name in self.ordering]
+        # The count only needs computing once, on the first page
+        url = remove_query_param(self.request.build_absolute_uri(), self.count_query_param)
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(values))
+
+    def get_paginated_response(self, data):
+        response = OrderedDict([('next', self.get_next_link())])
+        if self.count is not None:
+            response['count'] = self.count
+        response['results'] = data
+        return Response(response)
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'count': {'type': 'integer', 'description': 'Only present with ?count=true'},
+                'results': schema,
+            },
+        }
+
+
+class LessonPagination(KeysetPagination):
+    """Lessons in weekly order"""
+    ordering = ('minute_of_week', 'id')
@@ -0,0 +1,230 @@
+"""
+Room availability from per-room occupancy bitmaps.
+
+The week is cut into 5-minute slots (2016 of them) and each room's weekly
+occupancy is a Python integer with one bit per slot, the OR of the masks
+of the lessons held there. Asking which rooms are free for a time range is
+one AND per room against the range's mask, with no database access.
+
+Each process keeps its bitmaps in memory next to the shared rooms version.
+A committed lesson or exception write bumps that version; the writing
+process applies the change to its bitmaps in place when it was up to date,
+and every other process sees the new version and rebuilds on its next query.
+A room is known while a lesson or an exception names it, and is dropped
+once the last one moves away or is removed.
+"""
+import threading
+from collections import defaultdict
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .cache import bump_shared_version, get_shared_version
+from .conflicts import normalize_location
+from .models import MINUTES_PER_DAY, Lesson, LessonException
+
+SLOT_MINUTES = 5
+SLOTS_PER_DAY = MINUTES_PER_DAY // SLOT_MINUTES
+VERSION_KEY = 'rooms:version'
+
+_lock = threading.Lock()
+_state = None
+
+
+def slot_mask(day, start_time, end_time):
+    """
+    Return the bits for [start_time, end_time) on a weekday, widened to
+    whole slots so a partly used slot counts as occupied
+    """
+    first = (start_time.hour * 60 + start_time.minute) // SLOT_MINUTES
+    last = -(-(end_time.hour * 60 + end_time.minute) // SLOT_MINUTES)
+    if last <= first:
+        return 0
+    return ((1 << (last - first)) - 1) << (day * SLOTS_PER_DAY + first)
+
+
+class RoomOccupancy:
+    """Weekly occupancy bitmaps per room plus the exceptions that move occurrences"""
+
+    def __init__(self):
+        self.names = {}
+        self.lessons = {}
+        self.room_lessons = defaultdict(set)
+        self.room_exceptions = defaultdict(set)
+        self.weekly = {}
+        self.exceptions = {}
+        self.exceptions_by_date = defaultdict(set)
+
+    @classmethod
+    def build(cls, lessons, exceptions):
+        occupancy = cls()
+        for row in lessons:
+            occupancy.set_lesson(*row)
+        for row in exceptions:
+            occupancy.set_exception(*row)
+        return occupancy
+
+    def add_room(self, location):
+        room = normalize_location(location)
+        if room:
+            self.names.setdefault(room, location.strip())
+        return room
+
+    def refresh_room(self, room):
+        bits = 0
+        for lesson_id in self.room_lessons.get(room, ()):
+            bits |= self.lessons[lesson_id][2]
+        self.weekly[room] = bits
+
+    def prune_room(self, room):
+        """Forget a room no lesson or exception names any more"""
+        if room and not self.room_lessons.get(room) and not self.room_exceptions.get(room):
+            self.names.pop(room, None)
+            self.weekly.pop(room, None)
+            self.room_lessons.pop(room, None)
+            self.room_exceptions.pop(room, None)
+
+    def set_lesson(self, lesson_id, day, start_time, end_time, location):
+        """Add or move a lesson"""
+        previous = self.lessons.get(lesson_id)
+        room = self.add_room(location)
+        self.lessons[lesson_id] = (room, day, slot_mask(day, start_time, end_time), start_time, end_time)
+        if room:
+            self.room_lessons[room].add(lesson_id)
+            self.refresh_room(room)
+        if previous is not None and previous[0] != room:
+            self.room_lessons[previous[0]].discard(lesson_id)
+            self.refresh_room(previous[0])
+            self.prune_room(previous[0])
+
+    def remove_lesson(self, lesson_id):
+        previous = self.lessons.pop(lesson_id, None)
+        if previous is not None and previous[0]:
+            self.room_lessons[previous[0]].discard(lesson_id)
+            self.refresh_room(previous[0])
+            self.prune_room(previous[0])
+
+    def set_exception(self, exception_id, lesson_id, on_date, exception_type, start_time, end_time, location):
+        """Add or change an exception that cancels or moves one occurrence"""
+        self.remove_exception(exception_id)
+        self.exceptions[exception_id] = (lesson_id, on_date, exception_type, start_time, end_time, location)
+        self.exceptions_by_date[on_date].add(exception_id)
+        room = self.add_room(location)
+        if room:
+            self.room_exceptions[room].add(exception_id)
+
+    def remove_exception(self, exception_id):
+        previous = self.exceptions.pop(exception_id, None)
+        if previous is not None:
+            self.exceptions_by_date[previous[1]].discard(exception_id)
+            room = normalize_location(previous[5])
+            if room:
+                self.room_exceptions[room].discard(exception_id)
+                self.prune_room(room)
+
+    def day_occupancy(self, on_date):
+        """
+        Return the bitmaps of the rooms whose occupancy on on_date differs
+        from their weekly pattern
+        """
+        day = on_date.weekday()
+        displaced = defaultdict(set)
+        moved = defaultdict(int)
+        for exception_id in self.exceptions_by_date.get(on_date, ()):
+            lesson_id, _, exception_type, start_time, end_time, location = self.exceptions[exception_id]
+            lesson = self.lessons.get(lesson_id)
+            if lesson is None:
+                continue
+            room, _, _, lesson_start, lesson_end = lesson
+            if room:
+                displaced[room].add(lesson_id)
+            if exception_type == 'cancelled':
+                continue
+            new_room = normalize_location(location) or room
+            if new_room:
+                moved[new_room] |= slot_mask(day, start_time or lesson_start, end_time or lesson_end)
+
+        rooms = {}
+        for room in set(displaced) | set(moved):
+            bits = moved[room]
+            for lesson_id in self.room_lessons.get(room, ()):
+                if lesson_id not in displaced[room]:
+                    bits |= self.lessons[lesson_id][2]
+            rooms[room] = bits
+        return rooms
+
+    def free_rooms(self, day, start_time, end_time, on_date=None):
+        """Return the names of the rooms with no lesson overlapping the range"""
+        mask = slot_mask(day, start_time, end_time)
+        overrides = self.day_occupancy(on_date) if on_date is not None else {}
+        free = [
+            self.names[room] for room in self.names
+            if not (overrides.get(room, self.weekly.get(room, 0)) & mask)
+        ]
+        return sorted(free, key=str.casefold)
+
+
+def build_occupancy():
+    """Load every lesson and upcoming exception in two queries"""
+    lessons = Lesson.objects.order_by().values_list('id', 'day', 'start_time', 'end_time', 'location')
+    exceptions = LessonException.objects.filter(date__gte=timezone.localdate()).order_by().values_list(
+        'id', 'lesson_id', 'date', 'exception_type', 'start_time', 'end_time', 'location'
+    )
+    return RoomOccupancy.build(lessons, exceptions)
+
+
+def get_occupancy():
+    """Return this process's bitmaps, rebuilding them if another process changed the timetable"""
+    global _state
+    version = get_shared_version(VERSION_KEY)
+    with _lock:
+        if _state is not None and _state[0] == version:
+            return _state[1]
+    occupancy = build_occupancy()
+    # Rows read inside a transaction may still roll back, so only keep
+    # bitmaps built from committed data
+    if not connection.in_atomic_block:
+        with _lock:
+            _state = (version, occupancy)
+    return occupancy
+
+
+def apply_committed(change):
+    """
+    Bump the shared version and apply change to the local bitmaps if they
+    were current, otherwise drop them to be rebuilt
+    """
+    global _state
+    version = bump_shared_version(VERSION_KEY)
+    with _lock:
+        if _state is not None and _state[0] == version - 1:
+            change(_state[1])
+            _state = (version, _state[1])
+        else:
+            _state = None
+
+
+def invalidate():
+    """Make every process rebuild its bitmaps once the transaction commits"""
+    transaction.on_commit(lambda: bump_shared_version(VERSION_KEY))
+
+
+def lesson_saved(lesson):
+    values = (lesson.id, lesson.day, lesson.start_time, lesson.end_time, lesson.location)
+    transaction.on_commit(lambda: apply_committed(lambda occupancy: occupancy.set_lesson(*values)))
+
+
+def lesson_deleted(lesson_id):
+    transaction.on_commit(lambda: apply_committed(lambda occupancy: occupancy.remove_lesson(lesson_id)))
+
+
+def exception_saved(exception):
+    values = (
+        exception.id, exception.lesson_id, exception.date, exception.exception_type,
+        exception.start_time, exception.end_time, exception.location,
+    )
+    transaction.on_commit(lambda: apply_committed(lambda occupancy: occupancy.set_exception(*values)))
+
+
+def exception_deleted(exception_id):
+    transaction.on_commit(lambda: apply_committed(lambda occupancy: occupancy.remove_exception(exception_id)))
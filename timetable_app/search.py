@@ -0,0 +1,93 @@
+"""
+Full-text search over lesson titles, subjects and locations.
+
+On SQLite the lessons are indexed by an external-content FTS5 table kept in
+sync by triggers (see migration 0003), so bulk_create and raw updates are
+indexed too. On PostgreSQL a GIN index over a tsvector expression plays the
+same part. Each search term matches as a prefix, so partial words typed
+into a search box already find lessons, and ranked searches weight title
+matches above subject and location matches. Other backends fall back to a
+substring search.
+"""
+import re
+
+from django.db import connections
+from django.db.models import BooleanField, FloatField, Q
+from django.db.models.expressions import RawSQL
+
+FTS_TABLE = 'timetable_app_lesson_fts'
+# bm25 weights of the title, subject and location columns
+FTS_WEIGHTS = (10.0, 5.0, 1.0)
+SEARCH_VECTOR = "to_tsvector('simple', title || ' ' || subject || ' ' || location)"
+MAX_TERMS = 8
+
+
+def search_terms(text):
+    """Split user input into at most MAX_TERMS words"""
+    return re.findall(r'\w+', (text or '').casefold())[:MAX_TERMS]
+
+
+def fts_query(terms):
+    """Return an FTS5 query matching every term as a prefix"""
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+def tsquery(terms):
+    """Return a PostgreSQL tsquery matching every term as a prefix"""
+    return ' & '.join(f"'{term}':*" for term in terms)
+
+
+def get_vendor(queryset):
+    return connections[queryset.db].vendor
+
+
+def filter_lessons(queryset, text):
+    """Restrict a lesson queryset to the lessons matching every word of text"""
+    terms = search_terms(text)
+    if not terms:
+        return queryset.none()
+    vendor = get_vendor(queryset)
+    if vendor == 'sqlite':
+        return queryset.filter(id__in=RawSQL(
+            f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s", (fts_query(terms),)
+        ))
+    if vendor == 'postgresql':
+        return queryset.filter(RawSQL(
+            f"{SEARCH_VECTOR} @@ to_tsquery('simple', %s)", (tsquery(terms),), output_field=BooleanField()
+        ))
+    condition = Q()
+    for term in terms:
+        condition &= Q(title__icontains=term) | Q(subject__icontains=term) | Q(location__icontains=term)
+    return queryset.filter(condition)
+
+
+def rank_lessons(queryset, text, limit):
+    """Return up to limit lessons from queryset matching text, best match first"""
+    terms = search_terms(text)
+    if not terms:
+        return []
+    vendor = get_vendor(queryset)
+    if vendor == 'sqlite':
+        # bm25 is only defined inside a full-text query, so rank there and
+        # restrict to the queryset with a subquery
+        subquery, params = queryset.order_by().values('id').query.sql_with_params()
+        weights = ', '.join(str(weight) for weight in FTS_WEIGHTS)
+        with connections[queryset.db].cursor() as cursor:
+            cursor.execute(
+                f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s AND rowid IN ({subquery}) "
+                f"ORDER BY bm25({FTS_TABLE}, {weights}) LIMIT %s",
+                (fts_query(terms), *params, limit),
+            )
+            ids = [row[0] for row in cursor.fetchall()]
+        lessons = queryset.in_bulk(ids)
+        return [lessons[lesson_id] for lesson_id in ids if lesson_id in lessons]
+    if vendor == 'postgresql':
+        query = tsquery(terms)
+        return list(
+            filter_lessons(queryset, text)
+            .annotate(search_rank=RawSQL(
+                f"ts_rank({SEARCH_VECTOR}, to_tsquery('simple', %s))", (query,), output_field=FloatField()
+            ))
+            .order_by('-search_rank', 'id')[:limit]
+        )
+    return list(filter_lessons(queryset, text).order_by('title', 'id')[:limit])
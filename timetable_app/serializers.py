@@ -1,6 +1,49 @@
 from rest_framework import serializers
+from .conflicts import get_conflict_policy, get_index
 from .models import Lesson, LessonAttachment, LessonException
 
+NESTED_LESSON_FIELDS = ('attachments', 'exceptions')
+
+
+def parse_field_list(value):
+    """Split a comma separated query parameter into a set of field names"""
+    return {name.strip() for name in (value or '').split(',') if name.strip()}
+
+
+def get_expanded_fields(request):
+    """
+    Return the nested lesson fields to render for a request. Without
+    ?fields= every nested field is rendered; with it, only those in ?expand=.
+    """
+    if request is None or 'fields' not in request.query_params:
+        return set(NESTED_LESSON_FIELDS)
+    return parse_field_list(request.query_params.get('expand')) & set(NESTED_LESSON_FIELDS)
+
+
+class ConflictCheckMixin:
+    """
+    Reject a write that double-books a teacher or room, or accept it and
+    list the conflicts in the response, depending on LESSON_CONFLICT_POLICY
+    """
+    
+    def check_conflicts(self, find):
+        index = get_index()
+        conflicts = find(index)
+        if not conflicts:
+            return
+        described = [index.describe(conflict) for conflict in conflicts]
+        if get_conflict_policy() == 'reject':
+            raise serializers.ValidationError({
+                'conflicts': [conflict['message'] for conflict in described]
+            })
+        self.conflicts = described
+    
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        if getattr(self, 'conflicts', None):
+            data['conflicts'] = self.conflicts
+        return data
+
 
 class LessonAttachmentSerializer(serializers.ModelSerializer):
     """Serializer for lesson attachments"""
@@ -10,15 +53,37 @@ class LessonAttachmentSerializer(serializers.ModelSerializer):
         read_only_fields = ('id', 'uploaded_at')
 
 
-class LessonExceptionSerializer(serializers.ModelSerializer):
+class LessonExceptionSerializer(ConflictCheckMixin, serializers.ModelSerializer):
     """Serializer for lesson exceptions"""
     class Meta:
         model = LessonException
         fields = ('id', 'date', 'exception_type', 'start_time', 'end_time', 'location', 'notes')
         read_only_fields = ('id',)
+    
+    def validate(self, data):
+        """Check a rescheduled or modified occurrence does not double-book its new slot"""
+        lesson = self.context.get('lesson') or getattr(self.instance, 'lesson', None)
+        exception_type = data.get('exception_type', getattr(self.instance, 'exception_type', None))
+        if lesson is None or exception_type == 'cancelled':
+            return data
+        
+        def value(name):
+            if name in data:
+                return data[name]
+            return getattr(self.instance, name, None)
+        
+        start_time = value('start_time') or lesson.start_time
+        end_time = value('end_time') or lesson.end_time
+        if start_time >= end_time:
+            raise serializers.ValidationError({'end_time': 'End time must be after start time.'})
+        self.check_conflicts(lambda index: index.occurrence_conflicts(
+            lesson.id, lesson.teacher_id, value('location') or lesson.location,
+            value('date'), start_time, end_time
+        ))
+        return data
 
 
-class LessonSerializer(serializers.ModelSerializer):
+class LessonSerializer(ConflictCheckMixin, serializers.ModelSerializer):
     """Serializer for lessons"""
     attachments = LessonAttachmentSerializer(many=True, read_only=True)
     exceptions = LessonExceptionSerializer(many=True, read_only=True)
@@ -33,18 +98,45 @@ class LessonSerializer(serializers.ModelSerializer):
                   'attachments', 'exceptions')
         read_only_fields = ('id', 'created_at', 'updated_at', 'teacher')
     
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Sparse fieldsets for reads: ?fields=id,title,day&expand=exceptions
+        request = self.context.get('request')
+        if request is None or request.method != 'GET' or 'fields' not in request.query_params:
+            return
+        keep = parse_field_list(request.query_params.get('fields')) | get_expanded_fields(request)
+        for name in set(self.fields) - keep:
+            self.fields.pop(name)
+    
     def create(self, validated_data):
         # Set the teacher to the current user
         validated_data['teacher'] = self.context['request'].user
         return super().create(validated_data)
     
     def validate(self, data):
-        """Validate start time is before end time"""
+        """Validate start time is before end time and the slot is free"""
         if data.get('start_time') and data.get('end_time'):
             if data['start_time'] >= data['end_time']:
                 raise serializers.ValidationError({
                     'end_time': 'End time must be after start time.'
                 })
+        
+        request = self.context.get('request')
+        if request is None:
+            return data
+        
+        def value(name):
+            if name in data:
+                return data[name]
+            return getattr(self.instance, name, None)
+        
+        teacher_id = self.instance.teacher_id if self.instance else request.user.pk
+        if None not in (value('day'), value('start_time'), value('end_time')):
+            self.check_conflicts(lambda index: index.lesson_conflicts(
+                teacher_id, value('location'), value('day'),
+                value('start_time'), value('end_time'),
+                exclude=self.instance.pk if self.instance else None
+            ))
         return data
 
 
@@ -52,4 +144,19 @@ class LessonDetailSerializer(LessonSerializer):
     """Detailed serializer for single lesson view"""
     
     class Meta(LessonSerializer.Meta):
-        pass
\ No newline at end of file
+        pass
+
+
+class LessonOccurrenceSerializer(serializers.Serializer):
+    """Serializer for a concrete lesson occurrence on a date"""
+    lesson = serializers.IntegerField(source='lesson.id')
+    title = serializers.CharField(source='lesson.title')
+    subject = serializers.CharField(source='lesson.subject')
+    color = serializers.CharField(source='lesson.color')
+    date = serializers.DateField()
+    start_time = serializers.TimeField()
+    end_time = serializers.TimeField()
+    location = serializers.CharField()
+    notes = serializers.CharField()
+    status = serializers.CharField()
+    exception = serializers.IntegerField(source='exception.id', default=None)
@@ -1,19 +1,23 @@
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
-from .models import Lesson, LessonException
+from .cache import invalidate_teacher
+from . import conflicts, rooms
+from .models import Lesson, LessonAttachment, LessonException
 from notifications.models import Notification
+from notifications.buffer import notify_on_commit
 
 
 @receiver(post_save, sender=Lesson)
 def create_lesson_notification(sender, instance, created, **kwargs):
     """Create a notification when a new lesson is created"""
     if created:
-        Notification.objects.create(
-            user=instance.teacher,
+        notify_on_commit(Notification(
+            user_id=instance.teacher_id,
             lesson=instance,
             message=f"New lesson '{instance.title}' has been created.",
-            type='info'
-        )
+            type='info',
+            kind='lesson_created'
+        ))
 
 
 @receiver(post_save, sender=LessonException)
@@ -30,19 +34,96 @@ def create_exception_notification(sender, instance, created, **kwargs):
             message = f"Lesson '{instance.lesson.title}' on {instance.date} has been modified."
             notification_type = 'info'
             
-        Notification.objects.create(
-            user=instance.lesson.teacher,
+        notify_on_commit(Notification(
+            user_id=instance.lesson.teacher_id,
             lesson=instance.lesson,
             message=message,
-            type=notification_type
-        )
+            type=notification_type,
+            kind='lesson_exception',
+            occurrence_date=instance.date
+        ))
 
 
 @receiver(post_delete, sender=Lesson)
 def create_lesson_deleted_notification(sender, instance, **kwargs):
     """Create a notification when a lesson is deleted"""
-    Notification.objects.create(
-        user=instance.teacher,
+    notify_on_commit(Notification(
+        user_id=instance.teacher_id,
         message=f"Lesson '{instance.title}' has been deleted.",
-        type='warning'
-    )
\ No newline at end of file
+        type='warning',
+        kind='lesson_deleted'
+    ))
+
+
+
+def lesson_teacher_id(sender, instance):
+    """Return the teacher id for an attachment or exception, if its lesson still exists"""
+    if sender.lesson.is_cached(instance):
+        return instance.lesson.teacher_id
+    return Lesson.objects.filter(pk=instance.lesson_id).values_list('teacher_id', flat=True).first()
+
+
+@receiver(post_save, sender=Lesson)
+@receiver(post_delete, sender=Lesson)
+def invalidate_lesson_cache(sender, instance, **kwargs):
+    """Invalidate the teacher's cached lesson responses when a lesson changes"""
+    invalidate_teacher(instance.teacher_id)
+
+
+@receiver(post_save, sender=LessonAttachment)
+@receiver(post_delete, sender=LessonAttachment)
+@receiver(post_save, sender=LessonException)
+@receiver(post_delete, sender=LessonException)
+def invalidate_lesson_child_cache(sender, instance, **kwargs):
+    """Invalidate the teacher's cached lesson responses when an attachment or exception changes"""
+    teacher_id = lesson_teacher_id(sender, instance)
+    if teacher_id is not None:
+        invalidate_teacher(teacher_id)
+
+
+@receiver(post_save, sender=Lesson)
+def update_timetable_index_for_lesson(sender, instance, **kwargs):
+    """Apply a saved lesson to the conflict index once it commits"""
+    conflicts.lesson_saved(instance)
+
+
+@receiver(post_delete, sender=Lesson)
+def remove_timetable_index_for_lesson(sender, instance, **kwargs):
+    """Drop a deleted lesson from the conflict index once the delete commits"""
+    conflicts.lesson_deleted(instance.id)
+
+
+@receiver(post_save, sender=LessonException)
+def update_timetable_index_for_exception(sender, instance, **kwargs):
+    """Apply a saved exception to the conflict index once it commits"""
+    conflicts.exception_saved(instance)
+
+
+@receiver(post_delete, sender=LessonException)
+def remove_timetable_index_for_exception(sender, instance, **kwargs):
+    """Drop a deleted exception from the conflict index once the delete commits"""
+    conflicts.exception_deleted(instance.id)
+
+
+@receiver(post_save, sender=Lesson)
+def update_room_occupancy_for_lesson(sender, instance, **kwargs):
+    """Apply a saved lesson to the room bitmaps once it commits"""
+    rooms.lesson_saved(instance)
+
+
+@receiver(post_delete, sender=Lesson)
+def remove_room_occupancy_for_lesson(sender, instance, **kwargs):
+    """Free a deleted lesson's slots once the delete commits"""
+    rooms.lesson_deleted(instance.id)
+
+
+@receiver(post_save, sender=LessonException)
+def update_room_occupancy_for_exception(sender, instance, **kwargs):
+    """Apply a saved exception to the room bitmaps once it commits"""
+    rooms.exception_saved(instance)
+
+
+@receiver(post_delete, sender=LessonException)
+def remove_room_occupancy_for_exception(sender, instance, **kwargs):
+    """Drop a deleted exception from the room bitmaps once the delete commits"""
+    rooms.exception_deleted(instance.id)
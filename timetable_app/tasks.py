@@ -1,62 +1,81 @@
 from celery import shared_task
 from django.utils import timezone
-from datetime import timedelta, datetime
-from django.core.mail import send_mail
+from datetime import timedelta
 from django.conf import settings
-from .models import Lesson, LessonException
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from .models import Lesson, LessonException, MINUTES_PER_DAY
 from notifications.models import Notification
+from notifications.outbox import enqueue_emails, purge_sent
+from notifications.retention import get_archive_dir, purge_notifications
+from notifications.scheduling import get_horizon, sync_reminders
+from notifications.services import create_notifications, get_bulk_batch_size
 from django.contrib.auth import get_user_model
 from timetable_app.models import Lesson
 import pytz
 
 
 @shared_task
-def check_upcoming_lessons(days_ahead=1):
+def check_upcoming_lessons(days_ahead=1, batch_size=None):
     """
     Check for upcoming lessons and create notifications
     """
-    today = timezone.now().date()
+    today = timezone.localdate()
     target_date = today + timedelta(days=days_ahead)
     
     # Get the weekday (0-6, Monday is 0)
     target_weekday = target_date.weekday()
     
-    # Find all lessons on that day
-    lessons = Lesson.objects.filter(day=target_weekday, is_recurring=True)
+    # Find all lessons on that day, flagging those cancelled on the target date
+    cancelled = LessonException.objects.filter(
+        lesson=OuterRef('pk'),
+        date=target_date,
+        exception_type='cancelled'
+    )
+    lessons = (
+        Lesson.objects.filter(day=target_weekday, is_recurring=True)
+        .annotate(is_cancelled=Exists(cancelled))
+        .order_by()
+        .values_list('id', 'teacher_id', 'title', 'start_time', 'is_cancelled')
+    )
     
-    for lesson in lessons:
-        # Check if there's an exception for this lesson on the target date
-        exception = LessonException.objects.filter(
-            lesson=lesson, 
-            date=target_date
-        ).first()
-        
-        if exception:
-            if exception.exception_type == 'cancelled':
-                # Skip cancelled lessons
-                continue
+    batch_size = batch_size or get_bulk_batch_size()
+    checked = created = 0
+    batch = []
+    for lesson_id, teacher_id, title, start_time, is_cancelled in lessons.iterator(chunk_size=batch_size):
+        checked += 1
+        if is_cancelled:
+            # Skip cancelled lessons
+            continue
         
-        # Create a notification for the upcoming lesson
-        Notification.objects.create(
-            user=lesson.teacher,
-            lesson=lesson,
-            message=f"Reminder: You have '{lesson.title}' tomorrow at {lesson.start_time}.",
-            type='info'
-        )
+        batch.append(Notification(
+            user_id=teacher_id,
+            lesson_id=lesson_id,
+            message=f"Reminder: You have '{title}' tomorrow at {start_time}.",
+            type='info',
+            kind='upcoming_lesson',
+            occurrence_date=target_date,
+            offset_minutes=days_ahead * MINUTES_PER_DAY
+        ))
+        if len(batch) >= batch_size:
+            created += len(create_notifications(batch, batch_size))
+            batch = []
+    
+    created += len(create_notifications(batch, batch_size))
     
-    return f"Checked {lessons.count()} lessons for {target_date}"
+    return f"Checked {checked} lessons for {target_date}, created {created} notifications"
 
 
 @shared_task
 def send_email_notifications():
     """
-    Send email notifications for unread notifications
+    Queue email notifications for unread notifications in the email outbox
     """
     # Get unread notifications that haven't been emailed
     notifications = Notification.objects.filter(
         read=False,
         email_sent=False
-    )
+    ).select_related('user')
     
     # Group by user
     user_notifications = {}
@@ -65,7 +84,9 @@ def send_email_notifications():
             user_notifications[notification.user.id] = []
         user_notifications[notification.user.id].append(notification)
     
-    # Send emails to each user
+    # Prepare one email per user
+    emails = []
+    queued_ids = []
     for user_id, user_notifications_list in user_notifications.items():
         user = user_notifications_list[0].user
         
@@ -73,7 +94,6 @@ def send_email_notifications():
         if user.notification_preferences.get('disable_emails', False):
             continue
         
-        # Prepare email content
         subject = f"Teacher Timetable - You have {len(user_notifications_list)} new notifications"
         message = "Here are your recent notifications:\n\n"
         
@@ -82,75 +102,44 @@ def send_email_notifications():
         
         message += "\nLog in to view more details."
         
-        # Send the email
-        send_mail(
-            subject,
-            message,
-            settings.DEFAULT_FROM_EMAIL,
-            [user.email],
-            fail_silently=False,
-        )
-        
-        # Mark notifications as emailed
-        for notification in user_notifications_list:
-            notification.email_sent = True
-            notification.save()
+        emails.append((subject, message, user.email))
+        queued_ids.extend(notification.id for notification in user_notifications_list)
+    
+    # Queue the emails in the outbox and mark the notifications in the same
+    # transaction, so a mail server error cannot leave them half recorded
+    with transaction.atomic():
+        enqueue_emails(emails)
+        Notification.objects.filter(id__in=queued_ids).update(email_sent=True)
     
-    return f"Sent emails for {len(notifications)} notifications"
+    return f"Queued emails for {len(queued_ids)} notifications"
 
 
 @shared_task
 def clean_old_notifications(days=30):
     """
-    Clean up old read notifications to keep the database size manageable
+    Clean up old read notifications to keep the database size manageable,
+    in small batches so the table is never locked for long
     """
     threshold_date = timezone.now() - timedelta(days=days)
     
-    # Delete old read notifications
-    deleted_count, _ = Notification.objects.filter(
-        read=True,
-        time__lt=threshold_date
-    ).delete()
+    # Only read rows go, so the unread counters are unchanged and the
+    # batches can use raw deletes that skip per-row signals
+    stats = purge_notifications(threshold_date, archive_dir=get_archive_dir())
+    emails = purge_sent(timezone.now() - timedelta(days=getattr(settings, 'EMAIL_OUTBOX_RETENTION_DAYS', 7)))
     
-    return f"Deleted {deleted_count} old notifications"
+    return (
+        f"Deleted {stats.deleted} old notifications in {stats.batches} batches "
+        f"({stats.rows_per_second:.0f} rows/s) and {emails} sent emails"
+    )
 
 
 @shared_task
 def schedule_lesson_notifications(lesson_id):
     """
-    Schedule notifications and email for a lesson 30 and 10 minutes before start time.
+    Schedule the reminders of a lesson's occurrences in the planning horizon
+    as tasks that fire 30 and 10 minutes before start time.
     """
-    try:
-        lesson = Lesson.objects.get(id=lesson_id)
-        user = lesson.teacher
-        # Assume lesson.start_time is a time object, and lesson.day is 0=Monday, 6=Sunday
-        # Find the next date for this lesson
-        now = timezone.now()
-        today = now.date()
-        weekday = today.weekday()
-        days_ahead = (lesson.day - weekday) % 7
-        lesson_date = today + timedelta(days=days_ahead)
-        lesson_datetime = datetime.combine(lesson_date, lesson.start_time)
-        lesson_datetime = timezone.make_aware(lesson_datetime, timezone.get_current_timezone())
-
-        # Schedule for 30 and 10 minutes before
-        for minutes_before in [30, 10]:
-            notify_time = lesson_datetime - timedelta(minutes=minutes_before)
-            if notify_time > now:
-                Notification.objects.create(
-                    user=user,
-                    lesson=lesson,
-                    message=f"Reminder: '{lesson.title}' starts in {minutes_before} minutes at {lesson.start_time}.",
-                    type='urgent' if minutes_before == 10 else 'info'
-                )
-                # Send email
-                send_mail(
-                    f"Lesson Reminder: {lesson.title}",
-                    f"You have '{lesson.title}' at {lesson.start_time} in {minutes_before} minutes.",
-                    settings.DEFAULT_FROM_EMAIL,
-                    [user.email],
-                    fail_silently=True,
-                )
-        return f"Notifications and emails scheduled for lesson {lesson_id}"
-    except Lesson.DoesNotExist:
-        return f"Lesson {lesson_id} does not exist."
\ No newline at end of file
+    if not Lesson.objects.filter(id=lesson_id).exists():
+        return f"Lesson {lesson_id} does not exist."
+    count = sync_reminders([lesson_id], until=timezone.now() + get_horizon())
+    return f"Scheduled {count} reminders for lesson {lesson_id}"
@@ -1,10 +1,28 @@
-from django.test import TestCase
+import io
+import json
+import tempfile
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from rest_framework.test import APIClient
 from rest_framework import status
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.utils import timezone
 from .models import Lesson, LessonException, LessonAttachment
-from datetime import time
+from .cache import bump_shared_version, cache_stats, get_shared_version
+from . import conflicts
+from .conflicts import IntervalIndex, build_index
+from .occurrences import expand_occurrences
+from . import rooms
+from .rooms import build_occupancy
+from .tasks import check_upcoming_lessons
+from notifications.models import Notification, UnreadCounter
+from datetime import date, time, timedelta
 
 User = get_user_model()
 
@@ -14,6 +32,7 @@ class LessonTests(TestCase):
     
     def setUp(self):
         self.client = APIClient()
+        cache.clear()
         
         # Create a test user
         self.user = User.objects.create_user(
@@ -130,4 +149,884 @@ class LessonTests(TestCase):
         response = self.client.post(url, data, format='json')
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         self.assertEqual(LessonException.objects.count(), 1)
-        self.assertEqual(LessonException.objects.first().exception_type, 'cancelled')
\ No newline at end of file
+        self.assertEqual(LessonException.objects.first().exception_type, 'cancelled')
+
+
+class CheckUpcomingLessonsTests(TestCase):
+    """Test suite for the upcoming lesson fan-out task"""
+    
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='teacher1',
+            email='teacher@example.com',
+            password='StrongPass123!'
+        )
+        self.target_date = timezone.localdate() + timedelta(days=1)
+        self.lessons = [
+            Lesson.objects.create(
+                title=f'Class {hour}',
+                subject='Mathematics',
+                teacher=self.user,
+                day=self.target_date.weekday(),
+                start_time=time(hour, 0),
+                end_time=time(hour, 45),
+                location='Room 101'
+            )
+            for hour in (8, 9, 10)
+        ]
+        LessonException.objects.create(
+            lesson=self.lessons[1],
+            date=self.target_date,
+            exception_type='cancelled'
+        )
+        Notification.objects.all().delete()
+        # Steady state: the teacher already has an unread counter
+        UnreadCounter.objects.create(user=self.user, count=0)
+    
+    def test_skips_cancelled_lessons_in_bulk(self):
+        """Test notifications are bulk created for lessons that are not cancelled"""
+        # Lessons, then one savepoint with the insert-returning and the unread counter update
+        with self.assertNumQueries(5):
+            result = check_upcoming_lessons()
+        
+        self.assertEqual(result, f"Checked 3 lessons for {self.target_date}, created 2 notifications")
+        self.assertEqual(
+            set(Notification.objects.values_list('lesson_id', flat=True)),
+            {self.lessons[0].id, self.lessons[2].id}
+        )
+    
+    def test_rerun_does_not_duplicate(self):
+        """Test running the task twice for the same date is idempotent"""
+        check_upcoming_lessons()
+        result = check_upcoming_lessons()
+        
+        self.assertEqual(result, f"Checked 3 lessons for {self.target_date}, created 0 notifications")
+        self.assertEqual(Notification.objects.count(), 2)
+
+
+
+class LessonOccurrenceTests(TestCase):
+    """Test suite for expanding lessons into dated occurrences"""
+    
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='teacher1',
+            email='teacher@example.com',
+            password='StrongPass123!'
+        )
+        self.client.force_authenticate(user=self.user)
+        
+        self.monday = Lesson.objects.create(
+            title='Math Class',
+            subject='Mathematics',
+            teacher=self.user,
+            day=0,
+            start_time=time(9, 0),
+            end_time=time(10, 0),
+            location='Room 101'
+        )
+        self.wednesday = Lesson.objects.create(
+            title='History Class',
+            subject='History',
+            teacher=self.user,
+            day=2,
+            start_time=time(8, 0),
+            end_time=time(9, 0),
+            location='Room 305'
+        )
+        # Mondays in range: 2024-01-01, 2024-01-08, 2024-01-15
+        LessonException.objects.create(lesson=self.monday, date=date(2024, 1, 8), exception_type='cancelled')
+        LessonException.objects.create(
+            lesson=self.monday,
+            date=date(2024, 1, 15),
+            exception_type='rescheduled',
+            start_time=time(11, 0),
+            end_time=time(12, 0),
+            location='Lab 2'
+        )
+        # Outside the requested range, must not be loaded
+        LessonException.objects.create(lesson=self.monday, date=date(2023, 1, 2), exception_type='cancelled')
+    
+    def test_expand_applies_exceptions(self):
+        """Test cancelled occurrences are dropped and reschedules applied"""
+        lessons = Lesson.objects.filter(teacher=self.user)
+        with self.assertNumQueries(2):
+            occurrences = expand_occurrences(lessons, date(2024, 1, 1), date(2024, 1, 15))
+        
+        self.assertEqual(
+            [(o.lesson.id, o.date, o.status) for o in occurrences],
+            [
+                (self.monday.id, date(2024, 1, 1), 'scheduled'),
+                (self.wednesday.id, date(2024, 1, 3), 'scheduled'),
+                (self.wednesday.id, date(2024, 1, 10), 'scheduled'),
+                (self.monday.id, date(2024, 1, 15), 'rescheduled'),
+            ]
+        )
+        self.assertEqual(occurrences[-1].start_time, time(11, 0))
+        self.assertEqual(occurrences[-1].location, 'Lab 2')
+    
+    def test_occurrences_endpoint(self):
+        """Test the occurrences endpoint, including cancelled occurrences on request"""
+        url = reverse('lesson-occurrences')
+        response = self.client.get(url, {'from': '2024-01-08', 'to': '2024-01-08', 'include_cancelled': 'true'})
+        
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 1)
+        self.assertEqual(response.data[0]['status'], 'cancelled')
+        self.assertEqual(response.data[0]['title'], 'Math Class')
+    
+    def test_occurrences_endpoint_validates_range(self):
+        """Test missing or inverted date ranges are rejected"""
+        url = reverse('lesson-occurrences')
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(url, {'from': '2024-02-01', 'to': '2024-01-01'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+    
+    def test_occurrences_endpoint_rejects_impossible_dates(self):
+        """Test well-formed dates that do not exist are rejected rather than failing"""
+        url = reverse('lesson-occurrences')
+        response = self.client.get(url, {'from': '2024-02-30', 'to': '2024-03-10'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('YYYY-MM-DD', response.data['detail'])
+
+
+
+class LessonResponseCacheTests(TestCase):
+    """Test suite for the versioned per-teacher lesson response cache"""
+    
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='teacher1',
+            email='teacher@example.com',
+            password='StrongPass123!'
+        )
+        self.client.force_authenticate(user=self.user)
+        self.lesson = Lesson.objects.create(
+            title='Math Class',
+            subject='Mathematics',
+            teacher=self.user,
+            day=0,
+            start_time=time(9, 0),
+            end_time=time(10, 0),
+            location='Room 101'
+        )
+    
+    def test_repeated_reads_are_served_from_cache(self):
+        """Test list, retrieve and by_day reads hit the cache the second time"""
+        urls = [
+            reverse('lesson-list'),
+            reverse('lesson-detail', args=[self.lesson.id]),
+            reverse('lesson-by-day', args=[0]),
+        ]
+        for url in urls:
+            first = self.client.get(url)
+            # Only the ETag validator query runs on a cache hit
+            with self.assertNumQueries(1):
+                second = self.client.get(url)
+            self.assertEqual(first.data, second.data)
+        
+        self.assertEqual(cache_stats()['hits'], 3)
+        self.assertEqual(cache_stats()['misses'], 3)
+    
+    def test_changes_invalidate_cached_responses(self):
+        """Test lesson and exception writes bump the teacher's cache version"""
+        url = reverse('lesson-detail', args=[self.lesson.id])
+        self.client.get(url)
+        
+        self.client.patch(url, {'title': 'Advanced Math'}, format='json')
+        self.assertEqual(self.client.get(url).data['title'], 'Advanced Math')
+        
+        LessonException.objects.create(lesson=self.lesson, date='2024-01-01', exception_type='cancelled')
+        self.assertEqual(len(self.client.get(url).data['exceptions']), 1)
+    
+    def test_cache_is_per_teacher(self):
+        """Test one teacher never receives another teacher's cached lessons"""
+        url = reverse('lesson-list')
+        self.client.get(url)
+        
+        other = User.objects.create_user(
+            username='teacher2',
+            email='teacher2@example.com',
+            password='StrongPass123!'
+        )
+        self.client.force_authenticate(user=other)
+        self.assertEqual(len(self.client.get(url).data['results']), 0)
+
+
+
+class LessonConditionalGetTests(TestCase):
+    """Test suite for ETag / If-None-Match handling on lesson reads"""
+    
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='teacher1',
+            email='teacher@example.com',
+            password='StrongPass123!'
+        )
+        self.client.force_authenticate(user=self.user)
+        self.lesson = Lesson.objects.create(
+            title='Math Class',
+            subject='Mathematics',
+            teacher=self.user,
+            day=0,
+            start_time=time(9, 0),
+            end_time=time(10, 0),
+            location='Room 101'
+        )
+    
+    def test_unchanged_list_returns_not_modified(self):
+        """Test a matching If-None-Match gets 304 with no body"""
+        url = reverse('lesson-list')
+        etag = self.client.get(url)['ETag']
+        
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['ETag'], etag)
+    
+    def test_changes_produce_a_new_etag(self):
+        """Test lesson and exception changes invalidate the validator"""
+        url = reverse('lesson-detail', args=[self.lesson.id])
+        etag = self.client.get(url)['ETag']
+        
+        LessonException.objects.create(lesson=self.lesson, date='2024-01-01', exception_type='cancelled')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+
+class LessonQueryTests(TestCase):
+    """Test suite for lesson list query counts and sparse fieldsets"""
+    
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='teacher1',
+            email='teacher@example.com',
+            password='StrongPass123!'
+        )
+        self.client.force_authenticate(user=self.user)
+        today = timezone.localdate()
+        for hour in (8, 9, 10):
+            lesson = Lesson.objects.create(
+                title=f'Class {hour}',
+                subject='Mathematics',
+                teacher=self.user,
+                day=0,
+                start_time=time(hour, 0),
+                end_time=time(hour, 45),
+                location='Room 101'
+            )
+            LessonException.objects.create(lesson=lesson, date=today - timedelta(days=7), exception_type='cancelled')
+            LessonException.objects.create(lesson=lesson, date=today + timedelta(days=7), exception_type='cancelled')
+        self.lesson = lesson
+    
+    def test_list_query_count_is_constant(self):
+        """Test nested relations are prefetched instead of queried per lesson"""
+        # ETag aggregate, lessons, attachments, exceptions
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('lesson-list'))
+        self.assertEqual(len(response.data['results']), 3)
+    
+    def test_list_only_includes_upcoming_exceptions(self):
+        """Test lists carry upcoming exceptions while the detail view has the full history"""
+        response = self.client.get(reverse('lesson-list'))
+        self.assertEqual(len(response.data['results'][0]['exceptions']), 1)
+        
+        response = self.client.get(reverse('lesson-detail', args=[self.lesson.id]))
+        self.assertEqual(len(response.data['exceptions']), 2)
+    
+    def test_sparse_fieldsets(self):
+        """Test ?fields= returns a flat representation and ?expand= adds nested data"""
+        url = reverse('lesson-list')
+        with self.assertNumQueries(2):
+            response = self.client.get(url, {'fields': 'id,title,day,start_time,end_time,color'})
+        self.assertEqual(
+            set(response.data['results'][0]),
+            {'id', 'title', 'day', 'start_time', 'end_time', 'color'}
+        )
+        
+        response = self.client.get(url, {'fields': 'id', 'expand': 'exceptions'})
+        self.assertEqual(set(response.data['results'][0]), {'id', 'exceptions'})
+    
+    def test_cursor_pagination(self):
+        """Test lessons are paged in weekly order by cursor"""
+        url = reverse('lesson-list')
+        response = self.client.get(url, {'page_size': 2, 'count': 'true'})
+        self.assertEqual(response.data['count'], 3)
+        self.assertEqual([lesson['title'] for lesson in response.data['results']], ['Class 8', 'Class 9'])
+        
+        response = self.client.get(response.data['next'])
+        self.assertEqual([lesson['title'] for lesson in response.data['results']], ['Class 10'])
+        self.assertIsNone(response.data['next'])
+        
+        response = self.client.get(url, {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+
+class LessonConflictTests(TestCase):
+    """Test suite for teacher and room double-booking detection"""
+    
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='teacher1',
+            email='teacher@example.com',
+            password='StrongPass123!'
+        )
+        self.other = User.objects.create_user(
+            username='teacher2',
+            email='teacher2@example.com',
+            password='StrongPass123!'
+        )
+        self.client.force_authenticate(user=self.user)
+        self.lesson = Lesson.objects.create(
+            title='Math Class',
+            subject='Mathematics',
+            teacher=self.user,
+            day=0,
+            start_time=time(9, 0),
+            end_time=time(10, 0),
+            location='Room 101'
+        )
+        Lesson.objects.create(
+            title='Art Class',
+            subject='Art',
+            teacher=self.other,
+            day=0,
+            start_time=time(11, 0),
+            end_time=time(12, 0),
+            location='Studio'
+        )
+    
+    def lesson_data(self, **overrides):
+        data = {
+            'title': 'Physics Class',
+            'subject': 'Physics',
+            'day': 0,
+            'start_time': '09:30:00',
+            'end_time': '10:30:00',
+            'location': 'Lab 202',
+        }
+        data.update(overrides)
+        return data
+    
+    def test_interval_index_overlaps(self):
+        """Test overlaps are half-open and found across long and short intervals"""
+        index = IntervalIndex([(0, 600, 'long'), (540, 600, 'a'), (600, 660, 'b'), (700, 720, 'c')])
+        self.assertEqual(sorted(index.overlapping(590, 610)), ['a', 'b', 'long'])
+        self.assertEqual(index.overlapping(660, 700), [])
+        self.assertEqual(index.overlapping(100, 200), ['long'])
+    
+    def test_rejects_teacher_double_booking(self):
+        """Test an overlapping lesson for the same teacher is rejected"""
+        response = self.client.post(reverse('lesson-list'), self.lesson_data(), format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('Math Class', response.data['conflicts'][0])
+        
+        response = self.client.post(
+            reverse('lesson-list'), self.lesson_data(start_time='10:00:00', end_time='11:00:00'), format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+    
+    def test_rejects_room_double_booking_across_teachers(self):
+        """Test a room is matched case-insensitively across teachers"""
+        response = self.client.post(
+            reverse('lesson-list'),
+            self.lesson_data(start_time='11:30:00', end_time='12:30:00', location=' studio '),
+            format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+    
+    def test_update_ignores_the_lesson_itself(self):
+        """Test moving a lesson within its own slot is not a conflict"""
+        response = self.client.patch(
+            reverse('lesson-detail', args=[self.lesson.id]), {'end_time': '10:15:00'}, format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+    
+    def test_reschedule_conflicts(self):
+        """Test rescheduled occurrences are checked on their date and block that weekday"""
+        monday = timezone.localdate() + timedelta(days=7 - timezone.localdate().weekday())
+        url = reverse('lesson-add-exception', args=[self.lesson.id])
+        response = self.client.post(url, {
+            'date': monday, 'exception_type': 'rescheduled', 'location': 'Studio',
+            'start_time': '11:15:00', 'end_time': '12:15:00'
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        
+        response = self.client.post(url, {
+            'date': monday, 'exception_type': 'rescheduled',
+            'start_time': '14:00:00', 'end_time': '15:00:00'
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        
+        response = self.client.post(
+            reverse('lesson-list'), self.lesson_data(start_time='14:30:00', end_time='15:30:00'), format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn(str(monday), response.data['conflicts'][0])
+    
+    @override_settings(LESSON_CONFLICT_POLICY='flag')
+    def test_flag_policy_saves_and_reports(self):
+        """Test the flag policy accepts the lesson and lists its conflicts"""
+        response = self.client.post(reverse('lesson-list'), self.lesson_data(), format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['conflicts'][0]['lesson'], self.lesson.id)
+        self.assertEqual(response.data['conflicts'][0]['kind'], 'teacher')
+    
+    def assertSameIndex(self, index, rebuilt):
+        for table in ('weekly', 'moved_by_weekday', 'moved_by_date'):
+            self.assertEqual(
+                {key: value.entries for key, value in getattr(index, table).items()},
+                {key: value.entries for key, value in getattr(rebuilt, table).items()},
+            )
+        self.assertEqual(set(index.displaced), set(rebuilt.displaced))
+    
+    def test_committed_writes_update_current_index_in_place(self):
+        """Test lesson and exception writes patch the current index instead of reloading the timetable"""
+        monday = timezone.localdate() + timedelta(days=7 - timezone.localdate().weekday())
+        index = build_index()
+        conflicts._cached = ((conflicts.get_timetable_version(), timezone.localdate()), index)
+        self.addCleanup(setattr, conflicts, '_cached', None)
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('lesson-list'), self.lesson_data(), format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse('lesson-list'), self.lesson_data(start_time='10:00:00', end_time='11:00:00'), format='json'
+            )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('lesson-add-exception', args=[self.lesson.id]), {
+                'date': monday, 'exception_type': 'rescheduled', 'start_time': '14:00:00', 'end_time': '15:00:00'
+            }, format='json')
+            self.lesson.location = 'Room 303'
+            self.lesson.save()
+        
+        self.assertIs(conflicts._cached[1], index)
+        self.assertEqual(conflicts._cached[0][0], conflicts.get_timetable_version())
+        self.assertSameIndex(index, build_index())
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            self.lesson.delete()
+        self.assertIs(conflicts._cached[1], index)
+        self.assertSameIndex(index, build_index())
+        
+        # No timetable load while checking a write against the current index
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(reverse('lesson-list'), self.lesson_data(day=1), format='json')
+        self.assertFalse(any('FROM "timetable_app_lesson"' in query['sql'] and 'WHERE' not in query['sql']
+                             for query in queries.captured_queries))
+
+
+
+class RoomAvailabilityTests(TestCase):
+    """Test suite for the room occupancy bitmaps and free room search"""
+    
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='teacher1',
+            email='teacher@example.com',
+            password='StrongPass123!'
+        )
+        self.client.force_authenticate(user=self.user)
+        self.lesson = Lesson.objects.create(
+            title='Math Class',
+            subject='Mathematics',
+            teacher=self.user,
+            day=0,
+            start_time=time(9, 0),
+            end_time=time(10, 0),
+            location='Room 101'
+        )
+        Lesson.objects.create(
+            title='Physics Class',
+            subject='Physics',
+            teacher=self.user,
+            day=0,
+            start_time=time(10, 0),
+            end_time=time(11, 0),
+            location='Lab 202'
+        )
+        self.url = reverse('room-free')
+    
+    def free(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data['rooms']
+    
+    def test_free_rooms_by_weekday(self):
+        """Test rooms are free outside their lessons, with half-open ranges"""
+        self.assertEqual(self.free(day=0, **{'from': '09:30', 'to': '10:00'}), ['Lab 202'])
+        self.assertEqual(self.free(day=0, **{'from': '10:00', 'to': '10:30'}), ['Room 101'])
+        self.assertEqual(self.free(day=1, **{'from': '09:00', 'to': '11:00'}), ['Lab 202', 'Room 101'])
+    
+    def test_free_rooms_on_a_date_follow_exceptions(self):
+        """Test a cancellation frees its room and a reschedule occupies its new one"""
+        monday = timezone.localdate() + timedelta(days=7 - timezone.localdate().weekday())
+        LessonException.objects.create(lesson=self.lesson, date=monday, exception_type='cancelled')
+        params = {'date': monday, 'from': '09:00', 'to': '10:00'}
+        self.assertEqual(self.free(**params), ['Lab 202', 'Room 101'])
+        
+        LessonException.objects.filter(lesson=self.lesson).update(
+            exception_type='rescheduled', location='Lab 202'
+        )
+        self.assertEqual(self.free(**params), ['Room 101'])
+    
+    def test_invalid_parameters(self):
+        """Test missing or malformed parameters are rejected"""
+        for params in (
+            {'from': '09:00', 'to': '10:00'},
+            {'day': 0, 'from': '10:00', 'to': '09:00'},
+            {'day': 0, 'from': '09:00', 'to': '25:00'},
+            {'date': '2024-02-30', 'from': '09:00', 'to': '10:00'},
+        ):
+            response = self.client.get(self.url, params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+    
+    def test_incremental_updates_match_a_rebuild(self):
+        """Test moving and removing lessons in place gives the same bitmaps as a rebuild"""
+        occupancy = build_occupancy()
+        occupancy.set_lesson(self.lesson.id, 2, time(8, 0), time(8, 50), 'Lab 202')
+        self.lesson.day, self.lesson.start_time, self.lesson.end_time = 2, time(8, 0), time(8, 50)
+        self.lesson.location = 'Lab 202'
+        self.lesson.save()
+        rebuilt = build_occupancy()
+        self.assertEqual(occupancy.weekly, rebuilt.weekly)
+        self.assertEqual(occupancy.names, rebuilt.names)
+        
+        occupancy.remove_lesson(self.lesson.id)
+        self.lesson.delete()
+        rebuilt = build_occupancy()
+        self.assertEqual(occupancy.weekly, rebuilt.weekly)
+        self.assertEqual(occupancy.names, rebuilt.names)
+    
+    def test_rooms_are_dropped_once_unused(self):
+        """Test a room stays listed while an exception names it and is dropped after"""
+        occupancy = build_occupancy()
+        occupancy.set_exception(1, self.lesson.id, timezone.localdate(), 'rescheduled', None, None, 'Hall 9')
+        occupancy.set_lesson(self.lesson.id, 0, time(9, 0), time(10, 0), 'Hall 9')
+        self.assertIn('hall 9', occupancy.names)
+        self.assertNotIn('room 101', occupancy.names)
+        
+        occupancy.remove_lesson(self.lesson.id)
+        self.assertIn('hall 9', occupancy.names)
+        occupancy.remove_exception(1)
+        self.assertNotIn('hall 9', occupancy.names)
+        self.assertNotIn('hall 9', occupancy.weekly)
+    
+    def test_committed_writes_update_current_bitmaps_in_place(self):
+        """Test the writing process patches its bitmaps when they were current"""
+        occupancy = build_occupancy()
+        rooms._state = (get_shared_version(rooms.VERSION_KEY), occupancy)
+        try:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.lesson.location = 'Room 303'
+                self.lesson.save()
+            self.assertIs(rooms._state[1], occupancy)
+            self.assertEqual(rooms._state[0], get_shared_version(rooms.VERSION_KEY))
+            self.assertIn('room 303', occupancy.weekly)
+            
+            # Another process moved the version on: the bitmaps are dropped
+            bump_shared_version(rooms.VERSION_KEY)
+            with self.captureOnCommitCallbacks(execute=True):
+                self.lesson.delete()
+            self.assertIsNone(rooms._state)
+        finally:
+            rooms._state = None
+
+
+
+class LessonBulkTests(TestCase):
+    """Test suite for bulk lesson import and streaming export"""
+    
+    CSV = (
+        "title,subject,day,start_time,end_time,location,color\n"
+        "Math,Mathematics,0,09:00,10:00,Room 101,blue\n"
+        "Physics,Physics,0,10:00,11:00,Lab 202,\n"
+        "Broken,Physics,9,10:00,11:00,Lab 202,\n"
+        "Overlap,Physics,0,09:30,10:30,Room 303,\n"
+    )
+    
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='teacher1',
+            email='teacher@example.com',
+            password='StrongPass123!'
+        )
+        self.client.force_authenticate(user=self.user)
+        self.url = reverse('lesson-bulk-import')
+    
+    def test_csv_upload(self):
+        """Test valid rows are inserted, bad rows reported and one notification sent"""
+        upload = SimpleUploadedFile('lessons.csv', self.CSV.encode(), content_type='text/csv')
+        response = self.client.post(self.url, {'file': upload}, format='multipart')
+        
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual([error['row'] for error in response.data['errors']], [4, 5])
+        self.assertIn('day', response.data['errors'][0]['errors'])
+        self.assertIn('conflicts', response.data['errors'][1]['errors'])
+        
+        physics = Lesson.objects.get(title='Physics')
+        self.assertEqual(physics.color, 'indigo')
+        self.assertEqual(physics.minute_of_week, 600)
+        self.assertEqual(
+            list(Notification.objects.filter(user=self.user).values_list('message', flat=True)),
+            ['Imported 2 lessons.']
+        )
+    
+    def test_ndjson_body_and_dry_run(self):
+        """Test NDJSON bodies are accepted and a dry run inserts nothing"""
+        body = '\n'.join([
+            json.dumps({'title': 'Math', 'subject': 'Mathematics', 'day': 1,
+                        'start_time': '09:00', 'end_time': '10:00', 'location': 'Room 101'}),
+            'not json',
+        ])
+        response = self.client.post(
+            f'{self.url}?dry_run=true', body, content_type='application/x-ndjson'
+        )
+        self.assertEqual(response.data['created'], 1)
+        self.assertEqual(response.data['failed'], 1)
+        self.assertFalse(Lesson.objects.exists())
+    
+    def test_export_round_trip(self):
+        """Test an export streams every lesson and imports back as-is"""
+        upload = SimpleUploadedFile('lessons.csv', self.CSV.encode(), content_type='text/csv')
+        self.client.post(self.url, {'file': upload}, format='multipart')
+        
+        response = self.client.get(reverse('lesson-export'), {'output': 'ndjson'})
+        self.assertTrue(response.streaming)
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([row['title'] for row in rows], ['Math', 'Physics'])
+        
+        response = self.client.get(reverse('lesson-export'))
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], 'id,title,subject,day,start_time,end_time,location,notes,color,is_recurring')
+        self.assertEqual(len(lines), 3)
+    
+    def test_unreadable_input_is_reported(self):
+        """Test a file that stops being UTF-8 or valid CSV keeps the rows before it and reports the rest"""
+        body = self.CSV.splitlines()[:3] + ['Caf\xe9,Cooking,1,09:00,10:00,Kitchen,', 'Later,Art,2,09:00,10:00,,']
+        upload = SimpleUploadedFile(
+            'lessons.csv', '\n'.join(body).encode('latin-1'), content_type='text/csv'
+        )
+        response = self.client.post(self.url, {'file': upload}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual(response.data['errors'][-1]['row'], 4)
+        self.assertIn('UTF-8', response.data['errors'][-1]['errors']['non_field_errors'][0])
+        self.assertEqual(Lesson.objects.count(), 2)
+        
+        # Longer than the csv module's field size limit
+        response = self.client.post(
+            self.url, 'title,subject\nMath,' + 'x' * 200000 + '\n', content_type='text/csv'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('CSV', response.data['errors'][-1]['errors']['non_field_errors'][0])
+    
+    def test_import_command(self):
+        """Test the management command imports a file for a teacher"""
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as handle:
+            handle.write(self.CSV)
+            handle.flush()
+            out, err = io.StringIO(), io.StringIO()
+            call_command('import_lessons', handle.name, teacher='teacher@example.com', stdout=out, stderr=err)
+        self.assertEqual(Lesson.objects.filter(teacher=self.user).count(), 2)
+        self.assertIn('Imported 2 lessons, 2 rows failed', out.getvalue())
+        self.assertIn('Row 4:', err.getvalue())
+
+
+
+class LessonCalendarFeedTests(TestCase):
+    """Test suite for the iCalendar subscription feed"""
+    
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='teacher1',
+            email='teacher@example.com',
+            password='StrongPass123!'
+        )
+        self.client.force_authenticate(user=self.user)
+        self.lesson = Lesson.objects.create(
+            title='Math, Algebra',
+            subject='Mathematics',
+            teacher=self.user,
+            day=0,
+            start_time=time(9, 0),
+            end_time=time(10, 0),
+            location='Room 101',
+            notes='Bring a calculator; ' + 'long notes ' * 10
+        )
+        self.monday = timezone.localdate() + timedelta(days=7 - timezone.localdate().weekday())
+        LessonException.objects.create(lesson=self.lesson, date=self.monday, exception_type='cancelled')
+        LessonException.objects.create(
+            lesson=self.lesson, date=self.monday + timedelta(days=7), exception_type='rescheduled',
+            start_time=time(11, 0), end_time=time(12, 0)
+        )
+        self.url = self.client.get(reverse('lesson-feed')).data['url']
+    
+    def fetch(self, url=None, **headers):
+        # Calendar apps fetch the feed without any credentials
+        return Client().get(url or self.url, **headers)
+    
+    def test_feed_has_rrule_exdate_and_override(self):
+        """Test a weekly lesson is one RRULE event with its exceptions applied"""
+        response = self.fetch()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        body = b''.join(response.streaming_content).decode()
+        lines = body.split('\r\n')
+        
+        self.assertEqual(body.count('BEGIN:VEVENT'), 2)
+        self.assertIn('RRULE:FREQ=WEEKLY;BYDAY=MO', lines)
+        self.assertIn(f"EXDATE;TZID=Africa/Harare:{self.monday:%Y%m%d}T090000", lines)
+        override = self.monday + timedelta(days=7)
+        self.assertIn(f"RECURRENCE-ID;TZID=Africa/Harare:{override:%Y%m%d}T090000", lines)
+        self.assertIn(f"DTSTART;TZID=Africa/Harare:{override:%Y%m%d}T110000", lines)
+        self.assertIn('SUMMARY:Math\\, Algebra', lines)
+        self.assertTrue(all(len(line.encode()) <= 75 for line in lines))
+        self.assertIn('\r\n ', body)
+    
+    def test_unchanged_feed_is_not_modified(self):
+        """Test calendar apps revalidating an unchanged feed get 304"""
+        etag = self.fetch()['ETag']
+        with self.assertNumQueries(2):
+            response = self.fetch(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        
+        self.lesson.title = 'Geometry'
+        self.lesson.save()
+        self.assertEqual(self.fetch(HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_200_OK)
+    
+    def test_tampered_token_is_rejected(self):
+        """Test a feed URL with a forged token is not found"""
+        response = self.fetch(self.url.replace(f'/{self.user.pk}:', f'/{self.user.pk + 1}:'))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+    
+    def test_rotated_feed_url_is_revoked(self):
+        """Test rotating the feed revokes the old URL and hands out a working new one"""
+        response = self.client.post(reverse('lesson-rotate-feed'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.data['url'], self.url)
+        self.assertEqual(self.fetch().status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.fetch(response.data['url']).status_code, status.HTTP_200_OK)
+    
+    def test_password_change_revokes_feed_url(self):
+        """Test a feed URL stops working once the teacher changes their password"""
+        self.user.set_password('NewStrongPass456!')
+        self.user.save()
+        self.assertEqual(self.fetch().status_code, status.HTTP_404_NOT_FOUND)
+    
+    def test_inactive_teacher_feed_is_not_served(self):
+        """Test a deactivated teacher's feed is not found, even when revalidated"""
+        etag = self.fetch()['ETag']
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        self.assertEqual(self.fetch().status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.fetch(HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_404_NOT_FOUND)
+
+
+class LessonSearchTests(TestCase):
+    """Test suite for the full-text lesson search"""
+    
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='teacher1',
+            email='teacher@example.com',
+            password='StrongPass123!'
+        )
+        self.other = User.objects.create_user(
+            username='teacher2',
+            email='other@example.com',
+            password='StrongPass123!'
+        )
+        self.client.force_authenticate(user=self.user)
+        for title, subject, location, day in [
+            ('Algebra', 'Mathematics', 'Room 101', 0),
+            ('Geometry', 'Mathematics', 'Algebra Hall', 1),
+            ('Café chemistry', 'Science', 'Lab 202', 2),
+        ]:
+            Lesson.objects.create(
+                title=title, subject=subject, teacher=self.user, day=day,
+                start_time=time(9, 0), end_time=time(10, 0), location=location
+            )
+        Lesson.objects.create(
+            title='Algebra', subject='Mathematics', teacher=self.other, day=0,
+            start_time=time(9, 0), end_time=time(10, 0), location='Room 303'
+        )
+    
+    def test_prefix_search_is_ranked(self):
+        """Test partial words match and title matches rank first"""
+        response = self.client.get(reverse('lesson-search'), {'q': 'alg'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([lesson['title'] for lesson in response.data], ['Algebra', 'Geometry'])
+    
+    def test_search_prefetches_nested_data(self):
+        """Test search results load their attachments and exceptions in bulk"""
+        for index in range(20):
+            lesson = Lesson.objects.create(
+                title=f'Algebra {index}', subject='Mathematics', teacher=self.user, day=3,
+                start_time=time(9, 0), end_time=time(10, 0), location='Room 101'
+            )
+            LessonException.objects.create(
+                lesson=lesson, date=timezone.localdate() + timedelta(days=7), exception_type='cancelled'
+            )
+        
+        # Ranking, the lessons, their attachments and their exceptions
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('lesson-search'), {'q': 'alg', 'limit': 50})
+        self.assertEqual(len(response.data), 22)
+        nested = [len(lesson['exceptions']) for lesson in response.data if lesson['title'].startswith('Algebra ')]
+        self.assertEqual(nested, [1] * 20)
+    
+    def test_search_filter(self):
+        """Test every word must match, ignoring accents and case"""
+        response = self.client.get(reverse('lesson-list'), {'search': 'CAFE sci'})
+        self.assertEqual([lesson['title'] for lesson in response.data['results']], ['Café chemistry'])
+        
+        response = self.client.get(reverse('lesson-list'), {'search': 'math room'})
+        self.assertEqual([lesson['title'] for lesson in response.data['results']], ['Algebra'])
+    
+    def test_index_follows_writes(self):
+        """Test updates, deletes and bulk inserts are reflected in the index"""
+        lesson = Lesson.objects.get(title='Geometry')
+        lesson.title = 'Trigonometry'
+        lesson.save()
+        Lesson.objects.filter(title='Algebra', teacher=self.user).delete()
+        Lesson.objects.bulk_create([Lesson(
+            title='Trigonometry II', subject='Mathematics', teacher=self.user, day=3,
+            start_time=time(9, 0), end_time=time(10, 0), location='Room 101', minute_of_week=4860
+        )])
+        
+        response = self.client.get(reverse('lesson-search'), {'q': 'trig'})
+        self.assertEqual([lesson['title'] for lesson in response.data], ['Trigonometry', 'Trigonometry II'])
+        response = self.client.get(reverse('lesson-search'), {'q': 'geometry'})
+        self.assertEqual(response.data, [])
+        response = self.client.get(reverse('lesson-search'), {'q': 'algebra'})
+        self.assertEqual([lesson['location'] for lesson in response.data], ['Algebra Hall'])
+    
+    def test_punctuation_is_not_query_syntax(self):
+        """Test FTS operators and quotes in the input are treated as text"""
+        response = self.client.get(reverse('lesson-search'), {'q': '"alg* OR NOT ('})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(reverse('lesson-search'), {'q': '***'})
+        self.assertEqual(response.data, [])
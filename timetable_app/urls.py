@@ -3,14 +3,18 @@ from rest_framework.routers import DefaultRouter
 from .views import (
     LessonViewSet,
     LessonAttachmentViewSet,
-    LessonExceptionViewSet
+    LessonExceptionViewSet,
+    RoomViewSet,
+    lesson_ical_feed
 )
 
 router = DefaultRouter()
 router.register(r'lessons', LessonViewSet, basename='lesson')
 router.register(r'attachments', LessonAttachmentViewSet, basename='attachment')
 router.register(r'exceptions', LessonExceptionViewSet, basename='exception')
+router.register(r'rooms', RoomViewSet, basename='room')
 
 urlpatterns = [
+    path('calendar/<str:token>.ics', lesson_ical_feed, name='lesson-ical-feed'),
     path('', include(router.urls)),
 ]
\ No newline at end of file
@@ -1,17 +1,51 @@
 from rest_framework import viewsets, permissions, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from django.db.models import Q
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.http import Http404, HttpResponseNotModified, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import require_GET
+from django.db.models import Count, F, Max, Prefetch
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_time
 from .models import Lesson, LessonAttachment, LessonException
 from .serializers import (
+    get_expanded_fields,
     LessonSerializer, 
     LessonDetailSerializer,
     LessonAttachmentSerializer,
-    LessonExceptionSerializer
+    LessonExceptionSerializer,
+    LessonOccurrenceSerializer
 )
+from .bulk import FORMATS, export_lessons, import_lessons
+from .cache import cached_response, get_version
+from .etags import conditional_response, etag_matches, make_etag
+from .ical import generate_feed, make_feed_token, read_feed_token
+from .occurrences import expand_occurrences
+from .pagination import LessonPagination
+from .rooms import get_occupancy
+from .search import filter_lessons, rank_lessons
 from timetable_app.tasks import schedule_lesson_notifications
 
 
+def parse_date_param(value):
+    """Parse a YYYY-MM-DD query parameter, or return None if it is malformed or not a real date"""
+    try:
+        return parse_date(value or '')
+    except ValueError:
+        return None
+
+
+def parse_time_param(value):
+    """Parse an HH:MM query parameter, or return None if it is malformed or out of range"""
+    try:
+        return parse_time(value or '')
+    except ValueError:
+        return None
+
+
 class IsOwnerOrReadOnly(permissions.BasePermission):
     """
     Custom permission to only allow owners of an object to edit it.
@@ -30,6 +64,7 @@ class LessonViewSet(viewsets.ModelViewSet):
     """ViewSet for Lesson model"""
     serializer_class = LessonSerializer
     permission_classes = [permissions.IsAuthenticated, IsOwnerOrReadOnly]
+    pagination_class = LessonPagination
     
     def get_queryset(self):
         """
@@ -47,27 +82,175 @@ class LessonViewSet(viewsets.ModelViewSet):
         # Search by title, subject, or location
         search = self.request.query_params.get('search')
         if search:
-            queryset = queryset.filter(
-                Q(title__icontains=search) | 
-                Q(subject__icontains=search) |
-                Q(location__icontains=search)
-            )
+            queryset = filter_lessons(queryset, search)
+        
+        if self.action in ('list', 'retrieve', 'by_day', 'search'):
+            queryset = self.prefetch_nested(queryset)
             
         return queryset
     
+    def prefetch_nested(self, queryset):
+        """
+        Prefetch the nested relations the serializer will render. List
+        views only include upcoming exceptions; the detail view has them all.
+        """
+        lookups = []
+        expand = get_expanded_fields(self.request)
+        if 'attachments' in expand:
+            lookups.append('attachments')
+        if 'exceptions' in expand:
+            exceptions = LessonException.objects.order_by('date')
+            if self.action != 'retrieve':
+                exceptions = exceptions.filter(date__gte=timezone.localdate())
+            lookups.append(Prefetch('exceptions', queryset=exceptions))
+        return queryset.prefetch_related(*lookups)
+    
     def get_serializer_class(self):
         """Return appropriate serializer class"""
         if self.action == 'retrieve':
             return LessonDetailSerializer
         return LessonSerializer
     
+    def get_etag(self, queryset):
+        """
+        Build a validator for a lesson read from one aggregate query and the
+        teacher's cache version, which also covers attachments and exceptions
+        """
+        stats = queryset.order_by().aggregate(last_updated=Max('updated_at'), count=Count('id'))
+        return make_etag(
+            'lessons',
+            self.request.user.pk,
+            get_version(self.request.user.pk),
+            stats['last_updated'],
+            stats['count'],
+            self.request.get_full_path(),
+        )
+    
+    def conditional_read(self, queryset, build):
+        """Answer 304 if the client is up to date, otherwise serve from the response cache"""
+        return conditional_response(
+            self.request,
+            self.get_etag(queryset),
+            lambda: cached_response(self.request, build),
+        )
+    
+    def list(self, request, *args, **kwargs):
+        """List lessons, served from the teacher's response cache when possible"""
+        return self.conditional_read(
+            self.get_queryset(),
+            lambda: super(LessonViewSet, self).list(request, *args, **kwargs),
+        )
+    
+    def retrieve(self, request, *args, **kwargs):
+        """Retrieve a lesson, served from the teacher's response cache when possible"""
+        return self.conditional_read(
+            self.get_queryset(),
+            lambda: super(LessonViewSet, self).retrieve(request, *args, **kwargs),
+        )
+    
     @action(detail=False, methods=['get'], url_path=r'day/(?P<day>\d+)')
     def by_day(self, request, day=None):
         """Custom action to get lessons by day via URL path"""
         lessons = self.get_queryset().filter(day=day)
+        
+        def build():
+            serializer = self.get_serializer(lessons, many=True)
+            return Response(serializer.data)
+        return self.conditional_read(lessons, build)
+    
+    @action(detail=False, methods=['get'])
+    def occurrences(self, request):
+        """List concrete lesson occurrences between the 'from' and 'to' dates"""
+        start = parse_date_param(request.query_params.get('from'))
+        end = parse_date_param(request.query_params.get('to'))
+        if start is None or end is None:
+            return Response(
+                {'detail': "Both 'from' and 'to' must be dates in YYYY-MM-DD format."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        max_days = getattr(settings, 'LESSON_OCCURRENCES_MAX_DAYS', 366)
+        if end < start or (end - start).days >= max_days:
+            return Response(
+                {'detail': f"'to' must be on or after 'from' and at most {max_days} days later."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        include_cancelled = request.query_params.get('include_cancelled', '').lower() == 'true'
+        occurrences = expand_occurrences(self.get_queryset(), start, end, include_cancelled)
+        serializer = LessonOccurrenceSerializer(occurrences, many=True)
+        return Response(serializer.data)
+    
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        """
+        Type-ahead search: the best matches for the words in 'q', each
+        matched as a prefix, ranked by relevance
+        """
+        limit = request.query_params.get('limit', '')
+        limit = min(int(limit), 50) if limit.isdigit() and int(limit) > 0 else 10
+        lessons = rank_lessons(self.get_queryset(), request.query_params.get('q'), limit)
         serializer = self.get_serializer(lessons, many=True)
         return Response(serializer.data)
     
+    @action(detail=False, methods=['post'], url_path='import')
+    def bulk_import(self, request):
+        """
+        Import lessons from a CSV or NDJSON upload ('file' field) or request
+        body, validated and inserted in batches with a single notification
+        """
+        if request.content_type.startswith('multipart/'):
+            upload = request.FILES.get('file')
+            if upload is None:
+                return Response({'detail': "Upload the lessons in a 'file' field."},
+                                status=status.HTTP_400_BAD_REQUEST)
+            stream, name = upload, upload.name
+        else:
+            stream, name = request.stream, ''
+        
+        input_format = request.query_params.get('input') or (
+            'ndjson' if name.endswith(('.ndjson', '.jsonl')) or 'ndjson' in request.content_type else 'csv'
+        )
+        if input_format not in FORMATS or stream is None:
+            return Response({'detail': f"'input' must be one of {', '.join(FORMATS)}, with a non-empty body."},
+                            status=status.HTTP_400_BAD_REQUEST)
+        
+        dry_run = request.query_params.get('dry_run', '').lower() == 'true'
+        result = import_lessons(stream, input_format, request.user, dry_run=dry_run)
+        return Response(result.as_dict(), status=status.HTTP_200_OK)
+    
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        """Stream the lessons as CSV or NDJSON (?output=csv|ndjson)"""
+        output_format = request.query_params.get('output', 'csv')
+        if output_format not in FORMATS:
+            return Response({'detail': f"'output' must be one of {', '.join(FORMATS)}."},
+                            status=status.HTTP_400_BAD_REQUEST)
+        
+        content_type = 'text/csv' if output_format == 'csv' else 'application/x-ndjson'
+        response = StreamingHttpResponse(export_lessons(self.get_queryset(), output_format),
+                                         content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="lessons.{output_format}"'
+        return response
+    
+    def get_feed_url(self, teacher):
+        url = reverse('lesson-ical-feed', args=[make_feed_token(teacher)])
+        return self.request.build_absolute_uri(url)
+    
+    @action(detail=False, methods=['get'])
+    def feed(self, request):
+        """Return the URL of the teacher's iCalendar subscription feed"""
+        teacher = get_user_model().objects.only('password', 'feed_version').get(pk=request.user.pk)
+        return Response({'url': self.get_feed_url(teacher)})
+    
+    @action(detail=False, methods=['post'], url_path='feed/rotate')
+    def rotate_feed(self, request):
+        """Revoke the teacher's feed URL and return a new one"""
+        User = get_user_model()
+        User.objects.filter(pk=request.user.pk).update(feed_version=F('feed_version') + 1)
+        teacher = User.objects.only('password', 'feed_version').get(pk=request.user.pk)
+        return Response({'url': self.get_feed_url(teacher)})
+    
     @action(detail=True, methods=['post'], url_path='add-attachment')
     def add_attachment(self, request, pk=None):
         """Add an attachment to a lesson"""
@@ -83,7 +266,7 @@ class LessonViewSet(viewsets.ModelViewSet):
     def add_exception(self, request, pk=None):
         """Add an exception to a lesson"""
         lesson = self.get_object()
-        serializer = LessonExceptionSerializer(data=request.data)
+        serializer = LessonExceptionSerializer(data=request.data, context={'request': request, 'lesson': lesson})
         
         if serializer.is_valid():
             serializer.save(lesson=lesson)
@@ -98,6 +281,33 @@ class LessonViewSet(viewsets.ModelViewSet):
         return Response({'status': 'Notifications scheduled'}, status=status.HTTP_200_OK)
 
 
+@require_GET
+def lesson_ical_feed(request, token):
+    """
+    Serve a teacher's timetable as a streamed iCalendar feed. Calendar apps
+    poll it, so an unchanged feed is answered with 304 from the teacher
+    lookup that checks the token, one aggregate query and the teacher's
+    cache version.
+    """
+    teacher = read_feed_token(token)
+    if teacher is None:
+        raise Http404
+    
+    stats = Lesson.objects.filter(teacher=teacher).aggregate(last_updated=Max('updated_at'), count=Count('id'))
+    etag = make_etag('ical', teacher.pk, get_version(teacher.pk), stats['last_updated'], stats['count'])
+    if etag_matches(request, etag):
+        response = HttpResponseNotModified()
+    else:
+        response = StreamingHttpResponse(
+            generate_feed(teacher, request.get_host().split(':')[0]),
+            content_type='text/calendar; charset=utf-8'
+        )
+        response['Content-Disposition'] = 'inline; filename="timetable.ics"'
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, max_age=getattr(settings, 'LESSON_FEED_MAX_AGE', 900))
+    return response
+
+
 class LessonAttachmentViewSet(viewsets.ModelViewSet):
     """ViewSet for LessonAttachment model"""
     serializer_class = LessonAttachmentSerializer
@@ -130,3 +340,54 @@ class LessonExceptionViewSet(viewsets.ModelViewSet):
         if instance.lesson.teacher != self.request.user:
             raise permissions.PermissionDenied("You do not have permission to delete this exception.")
         instance.delete()
+
+
+class RoomViewSet(viewsets.ViewSet):
+    """Rooms known from lesson locations and their availability"""
+    permission_classes = [permissions.IsAuthenticated]
+    
+    def list(self, request):
+        """List every room used by a lesson or exception"""
+        occupancy = get_occupancy()
+        return Response(sorted(occupancy.names.values(), key=str.casefold))
+    
+    @action(detail=False, methods=['get'])
+    def free(self, request):
+        """
+        List the rooms free on a weekday ('day', 0-6) or a specific 'date'
+        between the 'from' and 'to' times (HH:MM)
+        """
+        start = parse_time_param(request.query_params.get('from'))
+        end = parse_time_param(request.query_params.get('to'))
+        if start is None or end is None or start >= end:
+            return Response(
+                {'detail': "'from' and 'to' must be times in HH:MM format with 'from' before 'to'."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        on_date = None
+        if request.query_params.get('date'):
+            on_date = parse_date_param(request.query_params['date'])
+            if on_date is None:
+                return Response(
+                    {'detail': "'date' must be in YYYY-MM-DD format."},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            day = on_date.weekday()
+        else:
+            day = request.query_params.get('day', '')
+            if not day.isdigit() or int(day) > 6:
+                return Response(
+                    {'detail': "'day' must be 0 (Monday) to 6 (Sunday), or give a 'date'."},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            day = int(day)
+        
+        rooms = get_occupancy().free_rooms(day, start, end, on_date)
+        return Response({
+            'day': day,
+            'date': on_date,
+            'from': start,
+            'to': end,
+            'rooms': rooms,
+        })
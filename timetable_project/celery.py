@@ -1,5 +1,9 @@
 import os
 from celery import Celery
+from celery.signals import before_task_publish, task_prerun
+from django.conf import settings
+
+from .queue_metrics import get_queue, queue_wait, record_wait, stamp_headers
 
 # Set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'timetable_project.settings')
@@ -14,15 +18,39 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks()
 
 
-# Celery Beat schedule for lesson reminders
+# Celery Beat schedule. Lesson reminders are ETA tasks scheduled ahead by
+# the planner, so nothing polls the lesson table every minute
 app.conf.beat_schedule = {
-    'send-lesson-reminders-every-minute': {
-        'task': 'notifications.tasks.send_lesson_reminders_task',
-        'schedule': 60.0,  # every minute
+    'plan-lesson-reminders': {
+        'task': 'notifications.tasks.plan_lesson_reminders_task',
+        'schedule': float(getattr(settings, 'LESSON_REMINDER_PLAN_INTERVAL', 1800)),
+    },
+    'drain-email-outbox': {
+        'task': 'notifications.tasks.drain_email_outbox',
+        'schedule': float(getattr(settings, 'EMAIL_OUTBOX_DRAIN_INTERVAL', 30)),
+    },
+    'reconcile-unread-counts-hourly': {
+        'task': 'notifications.tasks.reconcile_unread_counts_task',
+        'schedule': 3600.0,  # every hour
     },
 }
 
 
+@before_task_publish.connect
+def stamp_task_published_at(headers=None, **kwargs):
+    """Stamp outgoing tasks with their publish time to measure queue wait"""
+    if headers is not None:
+        stamp_headers(headers)
+
+
+@task_prerun.connect
+def record_task_queue_wait(task=None, **kwargs):
+    """Record how long a task waited in its queue before a worker started it"""
+    wait = queue_wait(task.request)
+    if wait is not None:
+        record_wait(get_queue(task.request), wait)
+
+
 @app.task(bind=True, ignore_result=True)
 def debug_task(self):
     print(f'Request: {self.request!r}')
\ No newline at end of file
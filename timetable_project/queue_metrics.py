@@ -0,0 +1,144 @@
+"""
+Queue wait time of Celery tasks, per queue.
+
+Every task message is stamped with its publish time in a header. When a
+worker starts the task, the time since then (or since its ETA, for delayed
+tasks) is added to counters in the cache: a total and a histogram with
+fixed bucket bounds, two atomic increments per task. The count is the sum
+of the histogram, and the percentiles and maximum are read off it as
+bucket bounds. The queues are the fixed ones in CELERY_QUEUE_WORKER_OPTIONS,
+with tasks from any other queue counted under 'other'. With a shared cache
+(REDIS_CACHE_URL) the counters cover every worker; with the local memory
+cache they are per process.
+"""
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+
+PUBLISHED_HEADER = 'published_at'
+STATS_KEY = 'celery:queue_wait:{queue}:{name}'
+OTHER_QUEUE = 'other'
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.1, 0.5, 1, 5, 30, 60, 300)
+HISTOGRAM = tuple(f'le_{bound}' for bound in BUCKETS) + ('inf',)
+COUNTERS = ('total_ms',) + HISTOGRAM
+
+
+def get_queues():
+    """Return the queues whose waits are counted"""
+    queues = list(getattr(settings, 'CELERY_QUEUE_WORKER_OPTIONS', None) or ('default',))
+    return queues + [OTHER_QUEUE]
+
+
+def stamp_headers(headers):
+    """Record the publish time in an outgoing task message's headers"""
+    headers.setdefault(PUBLISHED_HEADER, time.time())
+
+
+def get_published_at(request):
+    """Return when a task's message was published, from its headers"""
+    value = getattr(request, PUBLISHED_HEADER, None)
+    if value is None:
+        value = (getattr(request, 'headers', None) or {}).get(PUBLISHED_HEADER)
+    return value
+
+
+def get_queue(request):
+    delivery_info = getattr(request, 'delivery_info', None) or {}
+    return delivery_info.get('routing_key') or 'default'
+
+
+def queue_wait(request, now=None):
+    """
+    Return the seconds a task waited in its queue, counting from its ETA
+    for delayed tasks, or None if the message was not stamped
+    """
+    published_at = get_published_at(request)
+    if published_at is None:
+        return None
+    now = time.time() if now is None else now
+    ready_at = float(published_at)
+    eta = getattr(request, 'eta', None)
+    if eta:
+        if isinstance(eta, str):
+            eta = datetime.fromisoformat(eta)
+        ready_at = max(ready_at, eta.timestamp())
+    return max(now - ready_at, 0.0)
+
+
+def bucket_name(seconds):
+    for bound, name in zip(BUCKETS, HISTOGRAM):
+        if seconds <= bound:
+            return name
+    return 'inf'
+
+
+def increment(key, delta=1):
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        if not cache.add(key, delta, timeout=None):
+            cache.incr(key, delta)
+
+
+def record_wait(queue, seconds):
+    """Add one task's queue wait to the counters of its queue"""
+    if queue not in get_queues():
+        queue = OTHER_QUEUE
+    # Counters are integers, so totals are kept in milliseconds
+    increment(STATS_KEY.format(queue=queue, name='total_ms'), int(seconds * 1000))
+    increment(STATS_KEY.format(queue=queue, name=bucket_name(seconds)))
+
+
+def percentile(histogram, count, fraction):
+    """Return the upper bound of the bucket holding the given fraction of tasks"""
+    seen = 0
+    for bound, name in zip(BUCKETS, HISTOGRAM):
+        seen += histogram[name]
+        if seen >= count * fraction:
+            return bound
+    return None
+
+
+def stats_keys():
+    """Return the cache key of every counter, mapped to its (queue, name)"""
+    return {
+        STATS_KEY.format(queue=queue, name=name): (queue, name)
+        for queue in get_queues() for name in COUNTERS
+    }
+
+
+def queue_wait_stats():
+    """
+    Return the queue wait counters of every queue that has run tasks. The
+    maximum, like the percentiles, is the upper bound of its bucket (None
+    past the last one).
+    """
+    keys = stats_keys()
+    values = {queue: dict.fromkeys(COUNTERS, 0) for queue in get_queues()}
+    for key, count in cache.get_many(list(keys)).items():
+        queue, name = keys[key]
+        values[queue][name] = count
+
+    stats = {}
+    for queue in sorted(values):
+        histogram = {name: values[queue][name] for name in HISTOGRAM}
+        count = sum(histogram.values())
+        if not count:
+            continue
+        stats[queue] = {
+            'count': count,
+            'mean': values[queue]['total_ms'] / count / 1000,
+            'max': percentile(histogram, count, 1.0),
+            'p95': percentile(histogram, count, 0.95),
+            'p99': percentile(histogram, count, 0.99),
+            'histogram': histogram,
+        }
+    return stats
+
+
+def reset_queue_wait_stats():
+    """Clear the counters of every queue"""
+    cache.delete_many(list(stats_keys()))
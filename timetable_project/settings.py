@@ -66,6 +66,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'timetable_project.wsgi.application'
+ASGI_APPLICATION = 'timetable_project.asgi.application'
 
 # Database
 DATABASES = {
@@ -114,7 +115,7 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # REST Framework settings
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'authentication.authentication.CachedJWTAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
@@ -123,6 +124,12 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 20,
 }
 
+# Longest date range served by /api/lessons/occurrences/
+LESSON_OCCURRENCES_MAX_DAYS = 366
+
+# Seconds the user behind a JWT is served from the cache instead of the database
+AUTH_USER_CACHE_TIMEOUT = 60
+
 # JWT settings
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=60),
@@ -140,12 +147,105 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
 
+# Task queues: time-critical reminders, bulk email and maintenance each get
+# their own queue so a long summary or purge run never delays a reminder.
+# Run one worker per queue with `python manage.py run_queue_worker <queue>`
+CELERY_TASK_DEFAULT_QUEUE = 'default'
+# Redis redelivers unacknowledged messages after the visibility timeout, and
+# ETA tasks stay unacknowledged until they run, so it must exceed the
+# reminder horizon (LESSON_REMINDER_HORIZON, below) with room to spare
+CELERY_BROKER_TRANSPORT_OPTIONS = {'visibility_timeout': 4 * 3600}
+CELERY_TASK_ROUTES = {
+    'notifications.tasks.plan_lesson_reminders_task': {'queue': 'reminders'},
+    'notifications.tasks.send_scheduled_reminder': {'queue': 'reminders'},
+    'timetable_app.tasks.schedule_lesson_notifications': {'queue': 'reminders'},
+    'notifications.tasks.send_notification_summary': {'queue': 'email'},
+    'notifications.tasks.send_notification_summary_chunk': {'queue': 'email'},
+    'notifications.tasks.combine_notification_summaries': {'queue': 'email'},
+    'timetable_app.tasks.send_email_notifications': {'queue': 'email'},
+    'notifications.tasks.drain_email_outbox': {'queue': 'email'},
+    'timetable_app.tasks.clean_old_notifications': {'queue': 'maintenance'},
+    'notifications.tasks.reconcile_unread_counts_task': {'queue': 'maintenance'},
+}
+# Options of the worker run_queue_worker starts for each queue. Reminder
+# workers prefetch one task at a time so a reminder is never held locally
+# behind another
+CELERY_QUEUE_WORKER_OPTIONS = {
+    'reminders': {'concurrency': 4, 'prefetch_multiplier': 1},
+    'email': {'concurrency': 4, 'prefetch_multiplier': 4},
+    'maintenance': {'concurrency': 1, 'prefetch_multiplier': 1},
+    'default': {'concurrency': 2, 'prefetch_multiplier': 4},
+}
+
+# Cache: Redis when REDIS_CACHE_URL is set (e.g. redis://localhost:6379/1),
+# otherwise a per-process local memory cache
+REDIS_CACHE_URL = os.environ.get('REDIS_CACHE_URL')
+if REDIS_CACHE_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_CACHE_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Seconds a cached lesson list/detail response is kept for a teacher
+LESSON_CACHE_TIMEOUT = 300
+
+# What to do with a lesson that double-books its teacher or room:
+# 'reject' answers 400, 'flag' saves it and lists the conflicts in the response
+LESSON_CONFLICT_POLICY = 'reject'
+
+# Seconds calendar apps may reuse the .ics feed before revalidating it
+LESSON_FEED_MAX_AGE = 900
+
+# Bulk lesson import
+LESSON_IMPORT_BATCH_SIZE = 500  # rows validated and inserted per transaction
+LESSON_IMPORT_MAX_ERRORS = 100  # row errors reported in detail
+
+# Lesson reminder settings
+LESSON_REMINDER_OFFSETS = [30, 10]  # minutes before the lesson starts
+# Reminders are Celery ETA tasks scheduled this many minutes ahead by a
+# planner that runs every LESSON_REMINDER_PLAN_INTERVAL seconds
+LESSON_REMINDER_HORIZON = 120
+LESSON_REMINDER_PLAN_INTERVAL = 1800
+# A firing reminder also sends the teacher's reminders due within this many
+# minutes, as one digest email and notification; 0 sends each on its own
+LESSON_REMINDER_DIGEST_WINDOW = 15
+NOTIFICATION_BULK_BATCH_SIZE = 500  # rows per bulk_create statement
+# How notifications raised by lesson signals are written once the transaction
+# commits: 'commit' inserts them in-process, 'celery' hands them to a worker
+NOTIFICATION_SIGNAL_DELIVERY = 'commit'
+
+# Users per daily summary task; chunks run in parallel across workers
+NOTIFICATION_SUMMARY_CHUNK_SIZE = 500
+
+# Retention of old read notifications (clean_old_notifications)
+NOTIFICATION_RETENTION_BATCH_SIZE = 1000  # rows deleted per transaction
+NOTIFICATION_RETENTION_PAUSE = 0.05  # seconds between batches
+# Directory purged rows are archived to as gzipped NDJSON; unset to skip archiving
+NOTIFICATION_ARCHIVE_DIR = os.environ.get('NOTIFICATION_ARCHIVE_DIR')
+
+# Notification stream: Redis pub/sub feeding /api/notifications/stream/.
+# Disabled unless set (e.g. redis://localhost:6379/2); clients then keep polling
+NOTIFICATION_STREAM_REDIS_URL = os.environ.get('NOTIFICATION_STREAM_REDIS_URL')
+NOTIFICATION_STREAM_HEARTBEAT = 15  # seconds between keepalive comments
+NOTIFICATION_STREAM_QUEUE_SIZE = 100  # events buffered per open stream
+NOTIFICATION_STREAM_TICKET_MAX_AGE = 30  # seconds a stream ticket can open streams
+
 # CORS settings
 CORS_ALLOW_ALL_ORIGINS = True  # Set to False in production
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:3000",
     "http://127.0.0.1:3000",
 ]
+# Let the frontend read validators for conditional requests
+CORS_EXPOSE_HEADERS = ['ETag']
 
 # ---------------------------------------
 # Email settings (No Reply configuration)
@@ -162,6 +262,25 @@ EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_PASS', 'gtsp llqv pnpv rnfe')
 # Recommended "No Reply" display format
 DEFAULT_FROM_EMAIL = 'No Reply <teachertimetable82@gmail.com>'
 
+# Pooled delivery: one SMTP connection per worker, reused across tasks
+EMAIL_BATCH_SIZE = 50  # messages sent between rate limit checks
+EMAIL_RATE_LIMIT = 0  # messages per second, 0 for unlimited
+EMAIL_CONNECTION_IDLE_TIMEOUT = 60  # seconds before an idle connection is reopened
+# 'pooled' sends over one connection at a time; 'async' keeps up to
+# EMAIL_CONCURRENCY messages in flight over as many connections
+EMAIL_DELIVERY_BACKEND = os.environ.get('EMAIL_DELIVERY_BACKEND', 'pooled')
+EMAIL_CONCURRENCY = 4
+EMAIL_SEND_TIMEOUT = 30  # seconds allowed per message with the async backend
+
+# Email outbox: emails are queued in the database and sent by drain tasks
+EMAIL_OUTBOX_BATCH_SIZE = 100  # emails claimed per drain batch
+EMAIL_OUTBOX_LEASE = 300  # seconds a claimed batch is held; must exceed its send time
+EMAIL_OUTBOX_MAX_ATTEMPTS = 8  # failed sends before an email is dead-lettered
+EMAIL_OUTBOX_RETRY_BASE = 30  # seconds before the first retry, doubled on each failure
+EMAIL_OUTBOX_RETRY_MAX = 3600  # longest wait between retries
+EMAIL_OUTBOX_DRAIN_INTERVAL = 30  # seconds between beat drains picking up retries
+EMAIL_OUTBOX_RETENTION_DAYS = 7  # sent emails kept for inspection
+
 # ---------------------------------------
 # Swagger settings
 # ---------------------------------------